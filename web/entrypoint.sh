@@ -41,4 +41,9 @@ fi
 # Set Defaults for gunicorn and start
 export GUNICORN_PROCESSES=${GUNICORN_PROCESSES:-16}
 export GUNICORN_THREADS=${GUNICORN_THREADS:-1}
-gunicorn -c ${GUNICORN_PATH} jupyterjsc_unicoremgr.wsgi
+if [ "${ASYNC_VIEWS,,}" == "true" ]; then
+    export GUNICORN_WORKER_CLASS=${GUNICORN_WORKER_CLASS:-uvicorn.workers.UvicornWorker}
+    gunicorn -c ${GUNICORN_PATH} jupyterjsc_unicoremgr.asgi:application
+else
+    gunicorn -c ${GUNICORN_PATH} jupyterjsc_unicoremgr.wsgi
+fi
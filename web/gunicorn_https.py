@@ -1,3 +1,4 @@
+import gc
 import os
 
 # https://github.com/benoitc/gunicorn/blob/master/examples/example_config.py
@@ -77,7 +78,8 @@ preload_app = True
 
 workers = int(os.environ.get("GUNICORN_PROCESSES", 4))
 threads = int(os.environ.get("GUNICORN_THREADS", 25))
-worker_class = "sync"
+# uvicorn.workers.UvicornWorker for the async views (ASYNC_VIEWS=true)
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
 # worker_connections = 1000
 timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
 keepalive = 2
@@ -194,6 +196,24 @@ access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"
 #
 
 
+def pre_fork(server, worker):
+    # The app (including the parsed configuration) is preloaded in the
+    # master. Move these objects out of the garbage collector's reach, so
+    # the workers keep sharing their memory pages copy-on-write.
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    # Each worker runs a status poller thread. It only polls if
+    # status_poller.enabled is set in the configuration.
+    from services.utils.poller import start_poller_thread
+    from services.utils.tasks import start_stop_workers
+
+    start_poller_thread()
+    # And the threads that process the stop tasks of DELETE requests
+    start_stop_workers()
+
+
 # Max Requests used to reduce memory consumption
 max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
 max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 0))
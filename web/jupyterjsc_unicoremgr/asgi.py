@@ -6,10 +6,86 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 """
+import asyncio
+import contextlib
+import contextvars
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jupyterjsc_unicoremgr.settings")
 
+_receive = contextvars.ContextVar("asgi_receive")
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    """
+    Django 3.2 iterates streaming responses synchronously, within the event
+    loop. A response with async_streaming_content (see
+    services.utils.logstream) is sent asynchronously instead, and stopped as
+    soon as the client disconnects.
+    """
+
+    async def __call__(self, scope, receive, send):
+        _receive.set(receive)
+        return await super().__call__(scope, receive, send)
+
+    async def send_response(self, response, send):
+        content = getattr(response, "async_streaming_content", None)
+        if content is None:
+            return await super().send_response(response, send)
+        response_headers = []
+        for header, value in response.items():
+            response_headers.append((header.encode("ascii"), value.encode("latin1")))
+        for c in response.cookies.values():
+            response_headers.append(
+                (b"Set-Cookie", c.output(header="").encode("ascii").strip())
+            )
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": response_headers,
+            }
+        )
+        events = content.__aiter__()
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(_receive.get()))
+        try:
+            while True:
+                event = asyncio.ensure_future(events.__anext__())
+                await asyncio.wait(
+                    [event, disconnect], return_when=asyncio.FIRST_COMPLETED
+                )
+                if not event.done():
+                    event.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await event
+                    break
+                try:
+                    chunk = event.result()
+                except StopAsyncIteration:
+                    await send({"type": "http.response.body"})
+                    break
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+        finally:
+            disconnect.cancel()
+            await events.aclose()
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application():
+    # django.core.asgi.get_asgi_application() with the handler above
+    django.setup(set_prefix=False)
+    return ASGIHandler()
+
+
 application = get_asgi_application()
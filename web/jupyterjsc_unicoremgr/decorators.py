@@ -1,11 +1,15 @@
 import copy
+import functools
 import logging
 
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
 from logs.utils import create_logging_handler
 from logs.utils import remove_logging_handler
 from rest_framework.response import Response
 from services.utils import _config
 from services.utils import MgrException
+from services.utils import pinned_config
 
 from .settings import LOGGER_NAME
 
@@ -26,66 +30,94 @@ handlers.
 current_logger_configuration_mem = {}
 
 
-def request_decorator(func):
-    def update_logging_handler(*args, **kwargs):
-        global current_logger_configuration_mem
-        from logs.models import HandlerModel
-
-        logger = logging.getLogger(LOGGER_NAME)
-        assert logger.__class__.__name__ == "ExtraLoggerClass"
-        active_handler = HandlerModel.objects.all()
-        active_handler_dict = {x.handler: x.configuration for x in active_handler}
-        if active_handler_dict != current_logger_configuration_mem:
-            logger_handlers = logger.handlers
-            logger.handlers = [
-                handler
-                for handler in logger_handlers
-                if handler.name in active_handler_dict.keys()
-            ]
-            for name, configuration in active_handler_dict.items():
-                if configuration != current_logger_configuration_mem.get(name, {}):
-                    remove_logging_handler(name)
-                    create_logging_handler(name, **configuration)
-            current_logger_configuration_mem = copy.deepcopy(active_handler_dict)
-        return func(*args, **kwargs)
+def update_logging_handler():
+    global current_logger_configuration_mem
+    from logs.models import HandlerModel
+
+    logger = logging.getLogger(LOGGER_NAME)
+    assert logger.__class__.__name__ == "ExtraLoggerClass"
+    active_handler = HandlerModel.objects.all()
+    active_handler_dict = {x.handler: x.configuration for x in active_handler}
+    if active_handler_dict != current_logger_configuration_mem:
+        logger_handlers = logger.handlers
+        logger.handlers = [
+            handler
+            for handler in logger_handlers
+            if handler.name in active_handler_dict.keys()
+        ]
+        for name, configuration in active_handler_dict.items():
+            if configuration != current_logger_configuration_mem.get(name, {}):
+                remove_logging_handler(name)
+                create_logging_handler(name, **configuration)
+        current_logger_configuration_mem = copy.deepcopy(active_handler_dict)
+
+
+def is_framework_exception(e):
+    # Exceptions Django / DRF turn into a response themselves (404, 400, ...)
+    return hasattr(e, "__module__") and e.__module__ in [
+        "django.http.response",
+        "rest_framework.exceptions",
+    ]
+
+
+def error_response_data(e):
+    if e.__class__.__name__ == "MgrException":
+        summary = e.args[0]
+        details = e.args[1]
+    else:
+        summary = "Unexpected Error"
+        details = str(e)
+
+    try:
+        config = _config()
+
+        for key, value in config.get("unicore_status_message_prefix", {}).items():
+            if key in details:
+                summary = f"{value} {summary}"
 
+        for key, value in config.get("unicore_status_message_suffix", {}).items():
+            if key in details:
+                summary = f"{summary} {value}"
+    except:
+        print("Could not update error messages")
+        import traceback
+
+        print(traceback.format_exc())
+    return {"error": summary, "detailed_error": details}
+
+
+def request_decorator(func):
     def catch_all_exceptions(*args, **kwargs):
         try:
-            return update_logging_handler(*args, **kwargs)
+            update_logging_handler()
+            return func(*args, **kwargs)
         except (MgrException, Exception) as e:
-            if hasattr(e, "__module__") and e.__module__ in [
-                "django.http.response",
-                "rest_framework.exceptions",
-            ]:
+            if is_framework_exception(e):
                 raise e
             log.exception("Unexpected Error")
-            if e.__class__.__name__ == "MgrException":
-                summary = e.args[0]
-                details = e.args[1]
-            else:
-                summary = "Unexpected Error"
-                details = str(e)
+            return Response(error_response_data(e), status=500)
 
+    @functools.wraps(func)
+    def with_pinned_config(*args, **kwargs):
+        # All _config() calls during this request use the same snapshot
+        with pinned_config():
+            return catch_all_exceptions(*args, **kwargs)
+
+    return with_pinned_config
+
+
+def async_request_decorator(func):
+    # request_decorator for the async views
+    @functools.wraps(func)
+    async def with_pinned_config(*args, **kwargs):
+        with pinned_config():
             try:
-                config = _config()
-
-                for key, value in config.get(
-                    "unicore_status_message_prefix", {}
-                ).items():
-                    if key in details:
-                        summary = f"{value} {summary}"
-
-                for key, value in config.get(
-                    "unicore_status_message_suffix", {}
-                ).items():
-                    if key in details:
-                        summary = f"{summary} {value}"
-            except:
-                print("Could not update error messages")
-                import traceback
-
-                print(traceback.format_exc())
-            ret = {"error": summary, "detailed_error": details}
-            return Response(ret, status=500)
-
-    return catch_all_exceptions
+                await sync_to_async(update_logging_handler)()
+                return await func(*args, **kwargs)
+            except (MgrException, Exception) as e:
+                if is_framework_exception(e):
+                    raise e
+                log.exception("Unexpected Error")
+                return JsonResponse(error_response_data(e), status=500)
+
+    return with_pinned_config
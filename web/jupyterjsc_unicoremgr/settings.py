@@ -74,6 +74,10 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "jupyterjsc_unicoremgr.wsgi.application"
+ASGI_APPLICATION = "jupyterjsc_unicoremgr.asgi.application"
+
+# Serve the services API with the async views (requires an ASGI server)
+ASYNC_VIEWS = os.environ.get("ASYNC_VIEWS", "False").lower() == "true"
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
@@ -8,6 +8,7 @@ from services.utils import _config
 log = logging.getLogger(LOGGER_NAME)
 assert log.__class__.__name__ == "ExtraLoggerClass"
 
+
 class ServicesConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "services"
@@ -66,9 +67,32 @@ class ServicesConfig(AppConfig):
                     extra={"uuidcode": "StartUp"},
                 )
 
-    
+    def setup_config(self):
+        from services.utils.pyunicore import warm_job_descriptions
+        from services.utils.transports import warm_ssl_contexts
+
+        # With gunicorn's preload_app this runs in the master process. The
+        # parsed and compiled configuration is then inherited by all forked
+        # workers, which only parse it again when the file changes.
+        config = _config()
+        log.info(
+            f"Configuration preloaded - version {config.version}",
+            extra={"uuidcode": "StartUp"},
+        )
+        skeletons = warm_job_descriptions(config)
+        log.info(
+            f"Job descriptions preloaded - {skeletons} skeletons",
+            extra={"uuidcode": "StartUp"},
+        )
+        ssl_context_count = warm_ssl_contexts(config)
+        log.info(
+            f"SSL contexts preloaded - {ssl_context_count} CA bundles",
+            extra={"uuidcode": "StartUp"},
+        )
+
     def ready(self):
         if os.environ.get("GUNICORN_START", "false").lower() == "true":
             self.setup_logger()
+            self.setup_config()
             self.setup_db()
         return super().ready()
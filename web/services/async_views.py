@@ -0,0 +1,287 @@
+import logging
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.http import JsonResponse
+from jupyterjsc_unicoremgr.decorators import async_request_decorator
+from jupyterjsc_unicoremgr.settings import LOGGER_NAME
+from rest_framework.exceptions import APIException
+from rest_framework.exceptions import MethodNotAllowed
+from rest_framework.exceptions import NotFound
+from rest_framework.parsers import JSONParser
+from rest_framework.views import APIView
+from rest_framework.views import exception_handler
+
+from .models import ServicesModel
+from .serializers import ServicesSerializer
+from .serializers import status_messages
+from .utils import _config
+from .utils import aio
+from .utils import get_custom_headers
+from .utils import MgrException
+from .utils.common import initial_data_to_logs_extra
+from .utils.common import instance_dict_and_custom_headers_to_logs_extra
+from .utils.logstream import event_stream_response
+from .utils.logstream import open_stream
+from .utils.poller import create_snapshot
+from .utils.poller import fresh_snapshot
+from .utils.poller import poller_config
+from .utils.poller import remember_token
+from .utils.poller import store_status
+from .utils.poller import token_store
+from .utils.tasks import enqueue_stop
+from .utils.tasks import stop_queue_config
+from .views import ServicesViewSet
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Async versions of the create, retrieve, destroy, list and logs actions of
+ServicesViewSet. They're used instead of the viewset if ASYNC_VIEWS is
+set and the app runs on an ASGI server (see jupyterjsc_unicoremgr/asgi.py).
+
+Authentication, permissions, validation and everything else that touches
+the database runs in sync_to_async, exactly like in the viewset. Only the
+UNICORE calls are awaited (services.utils.aio).
+"""
+
+
+class ServicesAPIView(APIView):
+    # Authentication and permissions of ServicesViewSet
+    parser_classes = [JSONParser]
+    permission_classes = ServicesViewSet.permission_classes
+    required_groups = ServicesViewSet.required_groups
+
+
+def csrf_exempt(view):
+    # django's csrf_exempt would turn the view into a sync one
+    view.csrf_exempt = True
+    return view
+
+
+def _initial_request(request):
+    view = ServicesAPIView()
+    view.args = ()
+    view.kwargs = {}
+    drf_request = view.initialize_request(request)
+    view.request = drf_request
+    view.headers = {}
+    view.initial(drf_request)
+    return drf_request
+
+
+def _api_exception_response(exc):
+    response = exception_handler(exc, {})
+    ret = JsonResponse(response.data, status=response.status_code, safe=False)
+    for key, value in response.items():
+        # e.g. WWW-Authenticate
+        if key.lower() != "content-type":
+            ret[key] = value
+    return ret
+
+
+def _get_instance(drf_request, servername):
+    # Like ServicesViewSet.get_object(), the latest service wins
+    instance = (
+        ServicesModel.objects.filter(
+            jhub_credential=drf_request.user, servername=servername
+        )
+        .order_by("-id")
+        .first()
+    )
+    if instance is None:
+        raise NotFound()
+    return instance
+
+
+def _list(request):
+    drf_request = _initial_request(request)
+    queryset = ServicesModel.objects.filter(jhub_credential=drf_request.user)
+    return ServicesSerializer(
+        queryset, many=True, context={"request": drf_request}
+    ).data
+
+
+def _create_prepare(request):
+    drf_request = _initial_request(request)
+    serializer = ServicesSerializer(
+        data=drf_request.data, context={"request": drf_request}
+    )
+    serializer.is_valid(raise_exception=True)
+    custom_headers = get_custom_headers(request.META)
+    logs_extra = initial_data_to_logs_extra(
+        serializer.validated_data["servername"],
+        serializer.initial_data,
+        custom_headers,
+    )
+    return serializer, custom_headers, logs_extra
+
+
+def _create_save(serializer, custom_headers, start_service_values):
+    serializer.save(**start_service_values)
+    config = _config()
+    if poller_config(config)["enabled"]:
+        create_snapshot(config, serializer.instance)
+        remember_token(config, serializer.instance, custom_headers)
+    return serializer.data
+
+
+async def _create(request):
+    serializer, custom_headers, logs_extra = await sync_to_async(_create_prepare)(
+        request
+    )
+    log.debug("Service start", extra=logs_extra)
+    start_service_values = await aio.start_service(
+        _config(),
+        serializer.initial_data,
+        serializer.validated_data,
+        custom_headers,
+        serializer.validated_data["jhub_credential"],
+        logs_extra,
+    )
+    log.info(f"Service start finished - {start_service_values}", extra=logs_extra)
+    data = await sync_to_async(_create_save)(
+        serializer, custom_headers, start_service_values or {}
+    )
+    return JsonResponse(data, status=201)
+
+
+def _retrieve_prepare(request, servername):
+    drf_request = _initial_request(request)
+    instance = _get_instance(drf_request, servername)
+    data = ServicesSerializer(
+        instance, context={"request": drf_request, "with_status": False}
+    ).data
+    custom_headers = get_custom_headers(request.META)
+    snapshot = None
+    if not instance.stop_pending and "access-token" in custom_headers.keys():
+        config = _config()
+        if poller_config(config)["enabled"]:
+            remember_token(config, instance, custom_headers)
+        if custom_headers.get("DOWNLOAD", "false").lower() == "true":
+            # status_service downloads the job's files
+            snapshot = None
+        else:
+            snapshot = fresh_snapshot(config, instance)
+    return instance, data, custom_headers, snapshot
+
+
+async def _retrieve(request, servername):
+    instance, data, custom_headers, status = await sync_to_async(_retrieve_prepare)(
+        request, servername
+    )
+    logs_extra = instance_dict_and_custom_headers_to_logs_extra(
+        instance.__dict__, custom_headers
+    )
+    logs_extra["start_date"] = data["start_date"]
+    config = _config()
+    if instance.stop_pending:
+        log.debug("Service is already stopping. Return false", extra=logs_extra)
+        status = {"running": False}
+    elif "access-token" not in custom_headers.keys():
+        log.debug("No access token available. Return true", extra=logs_extra)
+        status = {"running": True}
+    elif status is not None:
+        log.debug("Use status snapshot", extra=logs_extra)
+    else:
+        try:
+            status = await aio.status_service(
+                config, instance.__dict__, custom_headers, logs_extra
+            )
+            await sync_to_async(store_status)(config, instance, status)
+        except MgrException as e:
+            log.critical(
+                "Could not check status of service", extra=logs_extra, exc_info=True
+            )
+            status = {
+                "running": True,
+                "details": {"error": e.args[0], "detailed_error": e.args[1]},
+            }
+    data.update(status_messages(config, status))
+    return JsonResponse(data)
+
+
+def _destroy_prepare(request, servername):
+    drf_request = _initial_request(request)
+    instance = _get_instance(drf_request, servername)
+    custom_headers = get_custom_headers(request.META)
+    logs_extra = instance_dict_and_custom_headers_to_logs_extra(
+        instance.__dict__, custom_headers
+    )
+    if instance.stop_pending:
+        log.debug("Service is already stopping. Do nothing.", extra=logs_extra)
+        return None, custom_headers, logs_extra
+    token_store.discard(instance.id)
+    instance.stop_pending = True
+    instance.save()
+    if stop_queue_config(_config())["enabled"]:
+        task = enqueue_stop(instance, custom_headers)
+        log.debug(f"Stop task {task.id} created", extra=logs_extra)
+        instance.delete()
+        return None, custom_headers, logs_extra
+    return instance, custom_headers, logs_extra
+
+
+async def _destroy(request, servername):
+    instance, custom_headers, logs_extra = await sync_to_async(_destroy_prepare)(
+        request, servername
+    )
+    if instance is None:
+        return HttpResponse(status=204)
+    try:
+        await aio.stop_service(_config(), instance.__dict__, custom_headers, logs_extra)
+    except Exception:
+        log.critical("Could not stop service.", extra=logs_extra, exc_info=True)
+    await sync_to_async(instance.delete)()
+    return HttpResponse(status=204)
+
+
+def _logs_prepare(request, servername):
+    drf_request = _initial_request(request)
+    instance = _get_instance(drf_request, servername)
+    custom_headers = get_custom_headers(request.META)
+    config = _config()
+    file, offset, release = open_stream(config, drf_request, instance, custom_headers)
+    logs_extra = instance_dict_and_custom_headers_to_logs_extra(
+        instance.__dict__, custom_headers
+    )
+    return config, instance.__dict__, custom_headers, file, offset, logs_extra, release
+
+
+@csrf_exempt
+@async_request_decorator
+async def services_list(request):
+    try:
+        if request.method == "GET":
+            return JsonResponse(await sync_to_async(_list)(request), safe=False)
+        if request.method == "POST":
+            return await _create(request)
+        raise MethodNotAllowed(request.method)
+    except APIException as exc:
+        return _api_exception_response(exc)
+
+
+@csrf_exempt
+@async_request_decorator
+async def services_detail(request, servername):
+    try:
+        if request.method == "GET":
+            return await _retrieve(request, servername)
+        if request.method == "DELETE":
+            return await _destroy(request, servername)
+        raise MethodNotAllowed(request.method)
+    except APIException as exc:
+        return _api_exception_response(exc)
+
+
+@csrf_exempt
+@async_request_decorator
+async def services_logs(request, servername):
+    try:
+        if request.method != "GET":
+            raise MethodNotAllowed(request.method)
+        *args, release = await sync_to_async(_logs_prepare)(request, servername)
+    except APIException as exc:
+        return _api_exception_response(exc)
+    return event_stream_response(aio.stream_logs(*args), release)
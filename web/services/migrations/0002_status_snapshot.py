@@ -0,0 +1,57 @@
+# Generated by Django 3.2.16 on 2026-10-18 00:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("services", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StatusSnapshotModel",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("status", models.JSONField(default=dict, verbose_name="status")),
+                (
+                    "unicore_status",
+                    models.TextField(default="", verbose_name="unicore_status"),
+                ),
+                ("updated", models.DateTimeField(null=True, verbose_name="updated")),
+                (
+                    "next_poll",
+                    models.DateTimeField(
+                        db_index=True, null=True, verbose_name="next_poll"
+                    ),
+                ),
+                ("terminal", models.BooleanField(default=False)),
+                (
+                    "lease_owner",
+                    models.TextField(default="", verbose_name="lease_owner"),
+                ),
+                (
+                    "lease_until",
+                    models.DateTimeField(null=True, verbose_name="lease_until"),
+                ),
+                (
+                    "service",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="status_snapshot",
+                        to="services.servicesmodel",
+                    ),
+                ),
+            ],
+        ),
+    ]
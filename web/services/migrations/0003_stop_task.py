@@ -0,0 +1,55 @@
+# Generated by Django 3.2.16 on 2026-10-18 00:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("services", "0002_status_snapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StopTaskModel",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("servername", models.TextField(default="", verbose_name="servername")),
+                (
+                    "jhub_credential",
+                    models.TextField(default="", verbose_name="jhub_credential"),
+                ),
+                ("instance", models.JSONField(default=dict, verbose_name="instance")),
+                (
+                    "custom_headers",
+                    models.JSONField(default=dict, verbose_name="custom_headers"),
+                ),
+                (
+                    "state",
+                    models.TextField(
+                        db_index=True, default="pending", verbose_name="state"
+                    ),
+                ),
+                ("attempts", models.IntegerField(default=0, verbose_name="attempts")),
+                (
+                    "available_at",
+                    models.DateTimeField(db_index=True, verbose_name="available_at"),
+                ),
+                ("locked_by", models.TextField(default="", verbose_name="locked_by")),
+                ("last_error", models.TextField(default="", verbose_name="last_error")),
+                (
+                    "created",
+                    models.DateTimeField(auto_now_add=True, verbose_name="created"),
+                ),
+                ("finished", models.DateTimeField(null=True, verbose_name="finished")),
+            ],
+        ),
+    ]
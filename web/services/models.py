@@ -10,3 +10,40 @@ class ServicesModel(models.Model):
     jhub_credential = models.TextField("jhub_credential", default="jupyterhub")
     resource_url = models.TextField("resource_url", default="")
     stop_pending = models.BooleanField(null=False, default=False)
+
+
+class StatusSnapshotModel(models.Model):
+    service = models.OneToOneField(
+        ServicesModel, on_delete=models.CASCADE, related_name="status_snapshot"
+    )
+    # Status as returned by status_service
+    status = models.JSONField("status", default=dict)
+    unicore_status = models.TextField("unicore_status", default="")
+    updated = models.DateTimeField("updated", null=True)
+    next_poll = models.DateTimeField("next_poll", null=True, db_index=True)
+    terminal = models.BooleanField(default=False)
+    # Only the owner of an active lease polls this service
+    lease_owner = models.TextField("lease_owner", default="")
+    lease_until = models.DateTimeField("lease_until", null=True)
+
+
+class StopTaskModel(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    servername = models.TextField("servername", default="")
+    jhub_credential = models.TextField("jhub_credential", default="")
+    # The stopped service (it's deleted when the task is created)
+    instance = models.JSONField("instance", default=dict)
+    # Needed to talk to UNICORE, removed as soon as the task is finished
+    custom_headers = models.JSONField("custom_headers", default=dict)
+    state = models.TextField("state", default=PENDING, db_index=True)
+    attempts = models.IntegerField("attempts", default=0)
+    # Next attempt, or end of the visibility timeout of a running task
+    available_at = models.DateTimeField("available_at", db_index=True)
+    locked_by = models.TextField("locked_by", default="")
+    last_error = models.TextField("last_error", default="")
+    created = models.DateTimeField("created", auto_now_add=True)
+    finished = models.DateTimeField("finished", null=True)
@@ -12,6 +12,10 @@ from .models import ServicesModel
 from .utils import get_custom_headers
 from .utils.common import instance_dict_and_custom_headers_to_logs_extra
 from .utils.common import status_service
+from .utils.poller import fresh_snapshot
+from .utils.poller import poller_config
+from .utils.poller import remember_token
+from .utils.poller import store_status
 
 log = logging.getLogger(LOGGER_NAME)
 assert log.__class__.__name__ == "ExtraLoggerClass"
@@ -85,6 +89,9 @@ class ServicesSerializer(serializers.ModelSerializer):
         # For create or list we don't want to update status
         if self.context["request"].path == reverse("services-list"):
             return ret
+        # The async views get the status themselves
+        if not self.context.get("with_status", True):
+            return ret
         custom_headers = get_custom_headers(self.context["request"]._request.META)
         logs_extra = instance_dict_and_custom_headers_to_logs_extra(
             instance.__dict__, custom_headers
@@ -98,12 +105,26 @@ class ServicesSerializer(serializers.ModelSerializer):
             log.debug("No access token available. Return true", extra=logs_extra)
             status = {"running": True}
         else:
+            config = _config()
+            pconfig = poller_config(config)
+            if pconfig["enabled"]:
+                # Let the status poller use the latest token of this service
+                remember_token(config, instance, custom_headers)
+            if custom_headers.get("DOWNLOAD", "false").lower() == "true":
+                # status_service downloads the job's files
+                status = None
+            else:
+                status = fresh_snapshot(config, instance)
             try:
-                status = status_service(
-                    instance.__dict__,
-                    custom_headers,
-                    logs_extra=logs_extra,
-                )
+                if status is not None:
+                    log.debug("Use status snapshot", extra=logs_extra)
+                else:
+                    status = status_service(
+                        instance.__dict__,
+                        custom_headers,
+                        logs_extra=logs_extra,
+                    )
+                    store_status(config, instance, status)
             except MgrException as e:
                 log.critical(
                     "Could not check status of service", extra=logs_extra, exc_info=True
@@ -112,21 +133,24 @@ class ServicesSerializer(serializers.ModelSerializer):
                     "running": True,
                     "details": {"error": e.args[0], "detailed_error": e.args[1]},
                 }
-        if not status:
-            status = {"running": True}
-        if "detailed_error" in status.get("details", {}).keys():
-            summary = status.get("details", {}).get("error", "")
-            details = status.get("details", {}).get("detailed_error", "")
-            config = _config()
-            for key, value in config.get("unicore_status_message_prefix", {}).items():
-                if key in details:
-                    summary = f"{value} {summary}"
+        ret.update(status_messages(_config(), status))
+        return ret
 
-            for key, value in config.get("unicore_status_message_suffix", {}).items():
-                if key in details:
-                    summary = f"{summary} {value}"
 
-            status["details"] = {"error": summary, "detailed_error": details}
+def status_messages(config, status):
+    # Adds the configured prefixes and suffixes to the error summary
+    if not status:
+        status = {"running": True}
+    if "detailed_error" in status.get("details", {}).keys():
+        summary = status.get("details", {}).get("error", "")
+        details = status.get("details", {}).get("detailed_error", "")
+        for key, value in config.get("unicore_status_message_prefix", {}).items():
+            if key in details:
+                summary = f"{value} {summary}"
 
-        ret.update(status)
-        return ret
+        for key, value in config.get("unicore_status_message_suffix", {}).items():
+            if key in details:
+                summary = f"{summary} {value}"
+
+        status["details"] = {"error": summary, "detailed_error": details}
+    return status
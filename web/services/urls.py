@@ -1,10 +1,38 @@
+from django.conf import settings
 from django.urls import include
 from django.urls import path
+from django.urls import re_path
 from rest_framework.routers import DefaultRouter
 
+from .async_views import services_detail
+from .async_views import services_list
+from .async_views import services_logs
 from .views import ServicesViewSet
 
 router = DefaultRouter()
 router.register("services", ServicesViewSet, basename="services")
 
-urlpatterns = [path("", include(router.urls))]
+# Outside of services/, so it can't collide with a servername
+services_status = ServicesViewSet.as_view({"post": "status"})
+
+# Take precedence over the viewset
+async_urlpatterns = [
+    re_path(r"^services/$", services_list, name="services-async-list"),
+    re_path(
+        r"^services/(?P<servername>[^/.]+)/$",
+        services_detail,
+        name="services-async-detail",
+    ),
+    re_path(
+        r"^services/(?P<servername>[^/.]+)/logs/$",
+        services_logs,
+        name="services-async-logs",
+    ),
+]
+
+urlpatterns = [
+    path("status/", services_status, name="services-status"),
+    path("", include(router.urls)),
+]
+if settings.ASYNC_VIEWS:
+    urlpatterns = async_urlpatterns + urlpatterns
@@ -1,11 +1,14 @@
+import contextlib
+import contextvars
 import copy
+import itertools
 import json
 import logging
 import os
-from datetime import datetime
-from datetime import timedelta
+import threading
 
 from jupyterjsc_unicoremgr.settings import LOGGER_NAME
+from services.utils.config import Config
 
 log = logging.getLogger(LOGGER_NAME)
 assert log.__class__.__name__ == "ExtraLoggerClass"
@@ -27,24 +30,90 @@ def get_error_message(config, logs_extra, key, default):
     return user_error_msg
 
 
-global_config = {"last_lookup": datetime.min, "cached_value": {}}
+"""
+The configuration is reloaded whenever CONFIG_PATH changes on disk. We
+compare device, inode, size and mtime of the file, so a Kubernetes
+ConfigMap update (which swaps a symlink) is detected as well.
+Each reload creates a new immutable Config snapshot, which replaces the
+previous one in a single assignment. Readers never see a half-updated
+configuration.
 
+The request_decorator pins one snapshot for the whole request, so all
+_config() calls within a request return the same version.
+"""
+# (signature of the loaded file, Config snapshot)
+global_config = (None, None)
+_config_lock = threading.Lock()
+_config_versions = itertools.count(1)
+_request_config = contextvars.ContextVar("request_config", default=None)
 
-def _config(timeout=60):
+
+def _config_signature(stat_result):
+    return (
+        stat_result.st_dev,
+        stat_result.st_ino,
+        stat_result.st_size,
+        stat_result.st_mtime_ns,
+    )
+
+
+def _load_config():
     global global_config
-    now = datetime.now()
-    if timedelta(seconds=timeout) < now - global_config["last_lookup"]:
+    config_path = os.environ.get("CONFIG_PATH", "<CONFIG_PATH in Env not set>")
+    try:
+        signature = _config_signature(os.stat(config_path))
+    except OSError:
+        signature = None
+    current_signature, current_config = global_config
+    if current_config is not None and signature == current_signature:
+        return current_config
+
+    with _config_lock:
+        current_signature, current_config = global_config
+        if current_config is not None and signature == current_signature:
+            return current_config
         try:
-            config_path = os.environ.get("CONFIG_PATH", "<CONFIG_PATH in Env not set>")
             log.debug(f"Reload configuration. - {config_path}")
             with open(config_path, "r") as f:
-                config = json.load(f)
-        except FileNotFoundError:
+                signature = _config_signature(os.fstat(f.fileno()))
+                data = json.load(f)
+            config = Config(data, version=next(_config_versions))
+        except (OSError, ValueError):
             log.critical(f"Could not load config ({config_path})", exc_info=True)
-            config = {}
-        global_config["cached_value"] = config
-        global_config["last_lookup"] = now
-    return global_config["cached_value"]
+            if current_config is None:
+                current_config = Config({}, version=next(_config_versions))
+            # Keep the last valid configuration until the file changes again
+            global_config = (signature, current_config)
+            return current_config
+        log.info(
+            f"Configuration loaded - version {config.version}",
+            extra={"uuidcode": "Config"},
+        )
+        global_config = (signature, config)
+        return config
+
+
+def _config():
+    config = _request_config.get()
+    if config is None:
+        config = _load_config()
+    return config
+
+
+def config_version():
+    return _config().version
+
+
+@contextlib.contextmanager
+def pinned_config():
+    if _request_config.get() is not None:
+        yield _request_config.get()
+        return
+    token = _request_config.set(_load_config())
+    try:
+        yield _request_config.get()
+    finally:
+        _request_config.reset(token)
 
 
 def get_custom_headers(request_headers):
@@ -63,22 +132,12 @@ def get_custom_headers(request_headers):
     return ret
 
 
-def get_download_delete(config, instance_dict, mapped_system, logs_extra):
-    download = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("download_after_stop", False)
-    )
+def get_download_delete(system_config, logs_extra):
+    download = system_config.download_after_stop
     log.debug(
         f"Stop pyunicore Service - download setting: {download}", extra=logs_extra
     )
 
-    delete = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("delete_after_stop", False)
-    )
+    delete = system_config.delete_after_stop
     log.debug(f"Stop pyunicore Service - delete setting: {delete}", extra=logs_extra)
     return download, delete
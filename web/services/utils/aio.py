@@ -0,0 +1,629 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import weakref
+
+import httpx
+from asgiref.sync import sync_to_async
+from pyunicore.credentials import AuthenticationFailedException
+from jupyterjsc_unicoremgr.settings import LOGGER_NAME
+from services.utils import get_download_delete
+from services.utils import get_error_message
+from services.utils import MgrException
+from services.utils import pyunicore
+from services.utils.breaker import CircuitOpen
+from services.utils.config import get_system_config
+from services.utils.deadline import deadline_config
+from services.utils.deadline import may_retry
+from services.utils.deadline import request_timeout
+from services.utils.deadline import retry_delay
+from services.utils.deadline import RETRY_STATUS_CODES
+from services.utils.deadline import tictoc_extra
+from services.utils.deadline import with_deadline
+from services.utils.logstream import error_event
+from services.utils.logstream import FINISHED_STATUSES
+from services.utils.logstream import KEEP_ALIVE
+from services.utils.logstream import log_stream_config
+from services.utils.logstream import LogTail
+from services.utils.logstream import sse_event
+from services.utils.sites import AUTHENTICATION_STATUS_CODES
+from services.utils.sites import SiteUnavailable
+from services.utils.tail import decode_tail
+from services.utils.tail import range_headers
+from services.utils.tail import REJECTED_STATUS_CODES
+from services.utils.tail import tail_headers
+from services.utils.tail import tail_stats
+from services.utils.tail import TailBuffer
+from services.utils.transports import ca_bundle
+from services.utils.transports import ssl_contexts
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Async versions of start_service, status_service and stop_service of
+services.utils.pyunicore, used by the async views (ASYNC_VIEWS=true, served
+by an ASGI server). They send the same UNICORE REST calls with httpx, so a
+request waiting for a slow site holds a coroutine instead of a thread.
+
+Each event loop has one httpx.AsyncClient per CA bundle and timeout. Its
+connection pool is shared by all users; the credentials are sent per
+request. Building the job description and downloading the job's files on
+stop still use the synchronous code, the latter in a thread.
+"""
+
+# event loop -> {(certificate_path, timeout): (ssl context, AsyncClient)}
+_clients = weakref.WeakKeyDictionary()
+
+_limits = httpx.Limits(
+    max_connections=int(os.environ.get("ASYNC_MAX_CONNECTIONS", 1000)),
+    max_keepalive_connections=int(os.environ.get("ASYNC_MAX_KEEPALIVE", 100)),
+)
+
+
+def _get_async_client(certificate_path, timeout):
+    loop = asyncio.get_running_loop()
+    clients = _clients.setdefault(loop, {})
+    bundle = ca_bundle(certificate_path)
+    ssl_context = ssl_contexts.get(bundle) if bundle else False
+    key = (certificate_path, timeout)
+    entry = clients.get(key)
+    if entry is None or entry[0] is not ssl_context:
+        if entry is not None:
+            # The CA bundle has changed on disk
+            loop.create_task(entry[1].aclose())
+        entry = (
+            ssl_context,
+            httpx.AsyncClient(verify=ssl_context, timeout=timeout, limits=_limits),
+        )
+        clients[key] = entry
+    return entry[1]
+
+
+class AsyncTransport:
+    """
+    The async counterpart of pyunicore.Transport: same headers, same
+    security session handling and same error messages.
+    """
+
+    def __init__(
+        self,
+        client,
+        credential,
+        oidc=True,
+        preferences=None,
+        timeout=None,
+        breaker=None,
+        retries=0,
+        backoff=0.5,
+        backoff_max=5,
+    ):
+        self.client = client
+        if oidc:
+            self.auth_header = f"Bearer {credential}"
+        else:
+            self.auth_header = f"Basic {credential}"
+        self.preferences = preferences
+        self.last_session_id = None
+        self.timeout = timeout
+        self.breaker = breaker
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+    def _headers(self, headers):
+        ret = {
+            "Authorization": self.auth_header,
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        if self.last_session_id is not None:
+            ret["X-UNICORE-SecuritySession"] = self.last_session_id
+        if self.preferences is not None:
+            ret["X-UNICORE-User-Preferences"] = self.preferences
+        if headers:
+            ret.update(headers)
+        return ret
+
+    def check_error(self, res):
+        if 400 <= res.status_code < 600:
+            reason = res.reason_phrase
+            try:
+                reason = res.json().get("errorMessage", "n/a")
+            except ValueError:
+                pass
+            msg = f"{res.status_code} Server Error: {reason} for url: {res.url}"
+            raise httpx.HTTPStatusError(msg, request=res.request, response=res)
+
+    async def request(self, method, url, headers=None, **kwargs):
+        # With stream=True the body is not read, see stream()
+        attempt = 0
+        while True:
+            try:
+                return await self._send(method, url, headers, **kwargs)
+            except Exception as e:
+                # Only GET is idempotent
+                if method != "GET" or attempt >= self.retries or not _is_transient(e):
+                    raise
+                delay = retry_delay(attempt, self.backoff, self.backoff_max)
+                if not may_retry(delay):
+                    raise
+                attempt += 1
+                log.debug(
+                    f"Retry GET {url} in {delay:.2f}s ({attempt}/{self.retries}) - {e}"
+                )
+                await asyncio.sleep(delay)
+
+    async def _send(self, method, url, headers=None, **kwargs):
+        if self.breaker is None:
+            return await self._request(method, url, headers, **kwargs)
+        started_in = self.breaker.before_call()
+        failed = False
+        tic = time.monotonic()
+        try:
+            return await self._request(method, url, headers, **kwargs)
+        except Exception as e:
+            failed = _site_unavailable(e)
+            raise
+        finally:
+            self.breaker.after_call(started_in, time.monotonic() - tic, failed)
+
+    async def _request(self, method, url, headers=None, stream=False, **kwargs):
+        _headers = self._headers(headers)
+        res = await self._client_send(method, url, _headers, stream, **kwargs)
+        if res.status_code == 432:
+            # Security session expired
+            await res.aclose()
+            _headers.pop("X-UNICORE-SecuritySession", None)
+            res = await self._client_send(method, url, _headers, stream, **kwargs)
+        if stream and 400 <= res.status_code < 600:
+            # For the error message
+            await res.aread()
+        self.check_error(res)
+        self.last_session_id = res.headers.get("X-UNICORE-SecuritySession", None)
+        return res
+
+    async def _client_send(self, method, url, headers, stream, **kwargs):
+        request = self.client.build_request(
+            method,
+            url,
+            headers=headers,
+            timeout=request_timeout(self.timeout),
+            **kwargs,
+        )
+        return await self.client.send(request, stream=stream)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, url, headers=None):
+        # GET response whose body is read with res.aiter_bytes()
+        res = await self.request("GET", url, headers=headers, stream=True)
+        try:
+            yield res
+        finally:
+            await res.aclose()
+
+    async def get(self, url, headers=None):
+        res = await self.request("GET", url, headers=headers)
+        return res.json()
+
+    async def post(self, url, json):
+        return await self.request("POST", url, json=json)
+
+    async def delete(self, url):
+        return await self.request("DELETE", url)
+
+
+async def _unicore_call(tictoc, logs_extra, awaitable):
+    tic = time.time()
+    try:
+        return await awaitable
+    finally:
+        toc = time.time() - tic
+        extra_tic = tictoc_extra(tictoc, toc)
+        extra_tic.update(logs_extra)
+        log.debug(
+            "UNICORE communication",
+            extra=extra_tic,
+        )
+
+
+def _site_unavailable(e):
+    # Like sites._site_unavailable, for httpx errors
+    if isinstance(e, httpx.TransportError):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return False
+
+
+def _is_transient(e):
+    # Like deadline.is_transient, for httpx errors
+    if isinstance(e, httpx.TransportError):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRY_STATUS_CODES
+    return False
+
+
+def _get_transport(config, instance_dict, custom_headers, logs_extra={}):
+    log.trace("async - get transport", extra=logs_extra)
+    system_config = get_system_config(config, instance_dict["user_options"]["system"])
+    breaker = pyunicore._get_breaker(config, system_config, logs_extra)
+    try:
+        transport_config = system_config.transport
+        if transport_config.set_preferences:
+            preferences = f"uid:{instance_dict['user_options']['account']},group:{instance_dict['user_options']['project']}"
+        else:
+            preferences = None
+        client = _get_async_client(
+            transport_config.certificate_path, transport_config.timeout
+        )
+        dconfig = deadline_config(config)
+        return AsyncTransport(
+            client,
+            custom_headers["access-token"],
+            oidc=transport_config.oidc,
+            preferences=preferences,
+            timeout=transport_config.timeout,
+            breaker=breaker,
+            retries=dconfig["retries"],
+            backoff=dconfig["backoff"],
+            backoff_max=dconfig["backoff_max"],
+        )
+    except Exception as e:
+        error_message = get_error_message(
+            config,
+            logs_extra,
+            "services.utils.pyunicore._get_transport",
+            "UNICORE error.",
+        )
+        raise MgrException(error_message, str(e))
+
+
+async def _get_site(config, transport, site_url, logs_extra={}):
+    # Uses the same SiteCache as the synchronous client
+    site_cache = pyunicore.site_cache
+    try:
+        site = site_cache.lookup(site_url)
+        if site is None:
+            try:
+                properties = await _unicore_call(
+                    "pyunicore.Client", logs_extra, transport.get(site_url)
+                )
+            except Exception as e:
+                if _site_unavailable(e):
+                    site_cache.add_failure(site_url, e)
+                raise
+            if properties["client"]["role"]["selected"] == "anonymous":
+                raise Exception(f"Failure to authenticate at {site_url}")
+            site = site_cache.add(site_url, properties)
+        return site
+    except CircuitOpen as e:
+        raise MgrException(pyunicore._circuit_open_message(config, logs_extra), str(e))
+    except (SiteUnavailable, Exception) as e:
+        error_message = get_error_message(
+            config,
+            logs_extra,
+            "services.utils.pyunicore._get_client",
+            "UNICORE error.",
+        )
+        raise MgrException(error_message, str(e))
+
+
+async def _job_action(transport, job_url, action, logs_extra):
+    # Like job.start() / job.abort(), the URL is taken from the job's links
+    job_properties = await _unicore_call(
+        "job.properties", logs_extra, transport.get(job_url)
+    )
+    action_url = job_properties["_links"][f"action:{action}"]["href"]
+    await _unicore_call(f"job.{action}", logs_extra, transport.post(action_url, {}))
+
+
+@with_deadline("start")
+async def start_service(
+    config, initial_data, instance_dict, custom_headers, jhub_credential, logs_extra
+):
+    log.debug("Start async", extra=logs_extra)
+    transport = None
+    job_url = None
+    try:
+        site_url = get_system_config(
+            config, instance_dict["user_options"]["system"]
+        ).site_url
+        transport = _get_transport(config, instance_dict, custom_headers, logs_extra)
+        site = await _get_site(config, transport, site_url, logs_extra)
+        # Reads templates and input files, not within the event loop
+        job_description = await sync_to_async(
+            pyunicore._get_job_description, thread_sensitive=False
+        )(config, jhub_credential, initial_data, logs_extra=logs_extra)
+        try:
+            res = await _unicore_call(
+                "client.new_job",
+                logs_extra,
+                transport.post(site.links["jobs"], json=job_description),
+            )
+        except httpx.HTTPStatusError as e:
+            # Like SiteClient.new_job, the site may be cached
+            if e.response.status_code not in AUTHENTICATION_STATUS_CODES:
+                raise
+            raise AuthenticationFailedException(
+                f"Failure to authenticate at {site_url}"
+            ) from e
+        job_url = res.headers["Location"]
+        if job_description.get("haveClientStageIn") in [True, "true"]:
+            await _job_action(transport, job_url, "start", logs_extra)
+        log.debug(f"Start async job - resource_url: {job_url}", extra=logs_extra)
+        return {"resource_url": job_url}
+    except (MgrException, Exception) as e:
+        log.warning("Start async failed", extra=logs_extra, exc_info=True)
+        # The UNICORE Job might be running, try to stop it.
+        if job_url:
+            try:
+                await _job_action(transport, job_url, "abort", logs_extra)
+            except:
+                log.critical(
+                    "Could not abort previously started job",
+                    extra=logs_extra,
+                    exc_info=True,
+                )
+        if e.__class__.__name__ == "MgrException":
+            e_args = e.args
+        elif isinstance(e, CircuitOpen):
+            # The circuit opened while the job was started
+            e_args = (pyunicore._circuit_open_message(config, logs_extra), str(e))
+        elif isinstance(e, AuthenticationFailedException):
+            e_args = (
+                pyunicore._authentication_failed_message(config, logs_extra),
+                str(e),
+            )
+        else:
+            user_error_msg = get_error_message(
+                config,
+                logs_extra,
+                "services.utils.pyunicore.start_job",
+                "UNICORE error during start process.",
+            )
+            e_args = (user_error_msg, str(e))
+        raise MgrException(*e_args)
+
+
+async def _read_tail(transport, file_url, headers, max_bytes):
+    # Like keep_tail(res.iter_content()) in pyunicore._get_file_output
+    tail = TailBuffer(max_bytes)
+    async with transport.stream(file_url, headers=headers) as res:
+        async for chunk in res.aiter_bytes(10 * 1024):
+            tail.feed(chunk)
+    return tail.data()
+
+
+async def _get_file_output(transport, working_dir_url, file, max_bytes):
+    file_url = f"{working_dir_url}/files/{file}"
+    try:
+        try:
+            data = await _unicore_call(
+                "job.working_dir.tail",
+                {},
+                _read_tail(transport, file_url, tail_headers(max_bytes), max_bytes),
+            )
+            calls = 1
+            fallback = False
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in REJECTED_STATUS_CODES:
+                raise
+            # For servers without suffix byte ranges
+            file_properties = await _unicore_call(
+                "job.working_dir.stat", {}, transport.get(file_url)
+            )
+            file_size = file_properties["size"]
+            if file_size == 0:
+                tail_stats.record(2, 0, fallback=True)
+                return f"{file} is empty"
+            offset = max(0, file_size - max_bytes)
+            data = await _read_tail(
+                transport, file_url, range_headers(offset), max_bytes
+            )
+            calls = 3
+            fallback = True
+        tail_stats.record(calls, len(data), fallback=fallback)
+        if not data:
+            return f"{file} is empty"
+        return decode_tail(data, len(data) == max_bytes)
+    except Exception:
+        log.warning("Could not receive file info", exc_info=True)
+        return f"{file} not available."
+
+
+async def _read_range(transport, file_url, headers, logs_extra={}):
+    # Status code, Content-Range and bytes of a byte range (log stream)
+    try:
+        res = await _unicore_call(
+            "job.working_dir.range",
+            logs_extra,
+            transport.request("GET", file_url, headers=headers),
+        )
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code not in REJECTED_STATUS_CODES:
+            raise
+        return e.response.status_code, None, b""
+    return res.status_code, res.headers.get("Content-Range"), res.content
+
+
+async def stream_logs(config, instance_dict, custom_headers, file, offset, logs_extra):
+    settings = log_stream_config(config)
+    tail = LogTail(settings, offset)
+    end = time.monotonic() + settings["max_duration"]
+    log.debug(f"Log stream {file} async - offset {offset}", extra=logs_extra)
+    try:
+        job_url = instance_dict["resource_url"]
+        transport = _get_transport(config, instance_dict, custom_headers, logs_extra)
+        job_properties = await _unicore_call(
+            "job.properties", logs_extra, transport.get(job_url)
+        )
+        working_dir_url = job_properties["_links"]["workingDirectory"]["href"]
+        file_url = f"{working_dir_url}/files/{file}"
+        finished = False
+        while True:
+            text = tail.feed(
+                *await _read_range(
+                    transport, file_url, tail.request_headers(), logs_extra
+                )
+            )
+            if text:
+                yield sse_event(text, event_id=tail.event_id)
+            if tail.more or (finished and text):
+                continue
+            if not text:
+                if finished:
+                    yield sse_event(status, event="end", event_id=tail.event_id)
+                    return
+                job_properties = await _unicore_call(
+                    "job.properties", logs_extra, transport.get(job_url)
+                )
+                status = job_properties["status"]
+                if status in FINISHED_STATUSES:
+                    # Read what was written before it finished
+                    finished = True
+                    continue
+            delay = tail.wait(bool(text))
+            if time.monotonic() + delay > end:
+                log.debug(f"Log stream {file} - max_duration", extra=logs_extra)
+                return
+            if not text:
+                yield KEEP_ALIVE
+            await asyncio.sleep(delay)
+    except Exception as e:
+        yield error_event(config, e, logs_extra)
+
+
+def _download_service(config, instance_dict, custom_headers, system_config, logs_extra):
+    job = pyunicore._get_job(config, instance_dict, custom_headers, logs_extra)
+    pyunicore._download_service(
+        instance_dict["id"],
+        instance_dict["servername"],
+        job,
+        system_config,
+        logs_extra=logs_extra,
+    )
+
+
+async def _no_bss_details():
+    return {}
+
+
+@with_deadline("status")
+async def status_service(config, instance_dict, custom_headers, logs_extra):
+    log.debug("Service status check async", extra=logs_extra)
+    try:
+        job_url = instance_dict["resource_url"]
+        transport = _get_transport(config, instance_dict, custom_headers, logs_extra)
+        system_config = get_system_config(
+            config, instance_dict["user_options"]["system"]
+        )
+        if custom_headers.get("DOWNLOAD", "false").lower() == "true":
+            await sync_to_async(_download_service, thread_sensitive=False)(
+                config, instance_dict, custom_headers, system_config, logs_extra
+            )
+        job_properties = await _unicore_call(
+            "job.properties", logs_extra, transport.get(job_url)
+        )
+        status = job_properties["status"]
+        running = status not in ["SUCCESSFUL", "FAILED"]
+        log.trace(
+            f"Get Service status - running: {running} ( {status} )", extra=logs_extra
+        )
+        # The remaining requests are independent of each other
+        bss_details_url = pyunicore._bss_details_url(job_properties)
+        if system_config.get_bss_details and bss_details_url is not None:
+            bss_details = _unicore_call(
+                "job.bss_details", logs_extra, transport.get(bss_details_url)
+            )
+        else:
+            bss_details = _no_bss_details()
+        if running:
+            ret = pyunicore._running_status(status, await bss_details)
+        else:
+            working_dir_url = job_properties["_links"]["workingDirectory"]["href"]
+            bss_details, unicore_stdout, unicore_stderr = await asyncio.gather(
+                bss_details,
+                _get_file_output(
+                    transport,
+                    working_dir_url,
+                    "stdout",
+                    system_config.unicore_stdout.max_bytes,
+                ),
+                _get_file_output(
+                    transport,
+                    working_dir_url,
+                    "stderr",
+                    system_config.unicore_stderr.max_bytes,
+                ),
+            )
+            ret = pyunicore._finished_status(
+                system_config,
+                status,
+                bss_details,
+                job_properties,
+                unicore_stdout,
+                unicore_stderr,
+                logs_extra,
+            )
+        if "detailed_error" in logs_extra.keys():
+            del logs_extra["detailed_error"]
+        log.info("Service status check finished", extra=logs_extra)
+        return ret
+    except (MgrException, Exception) as e:
+        log.warning("Service status check failed", extra=logs_extra, exc_info=True)
+        if e.__class__.__name__ == "MgrException":
+            e_args = e.args
+        elif isinstance(e, CircuitOpen):
+            e_args = (pyunicore._circuit_open_message(config, logs_extra), str(e))
+        else:
+            user_error_msg = get_error_message(
+                config,
+                logs_extra,
+                "services.utils.common.status_service",
+                "UNICORE error during status process.",
+            )
+            e_args = (user_error_msg, str(e))
+        raise MgrException(*e_args)
+
+
+@with_deadline("stop")
+async def stop_service(
+    config, instance_dict, custom_headers, logs_extra, raise_exception=True
+):
+    log.debug("Service stop async", extra=logs_extra)
+    system_config = get_system_config(config, instance_dict["user_options"]["system"])
+    download, delete = get_download_delete(system_config, logs_extra)
+    try:
+        job_url = instance_dict["resource_url"]
+        transport = _get_transport(config, instance_dict, custom_headers, logs_extra)
+        await _job_action(transport, job_url, "abort", logs_extra)
+        log.debug("Stop async Service - Job aborted", extra=logs_extra)
+        if download:
+            log.debug("Stop async Service - Download Job file", extra=logs_extra)
+            await sync_to_async(_download_service, thread_sensitive=False)(
+                config, instance_dict, custom_headers, system_config, logs_extra
+            )
+        if delete:
+            log.debug("Stop async Service - Delete job", extra=logs_extra)
+            await _unicore_call("job.delete", logs_extra, transport.delete(job_url))
+        log.info("Service stop finished", extra=logs_extra)
+    except (MgrException, Exception) as e:
+        log.warning("async - Service stop failed", exc_info=True, extra=logs_extra)
+        if e.__class__.__name__ == "MgrException":
+            e_args = e.args
+        elif isinstance(e, CircuitOpen):
+            e_args = (pyunicore._circuit_open_message(config, logs_extra), str(e))
+        else:
+            user_error_msg = get_error_message(
+                config,
+                logs_extra,
+                "services.utils.pyunicore.stop_service",
+                "Could not stop service",
+            )
+            e_args = (user_error_msg, str(e))
+        if raise_exception:
+            raise MgrException(*e_args)
@@ -0,0 +1,74 @@
+import collections
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from django.db import close_old_connections
+from services.utils.deadline import deadline as call_deadline
+
+"""
+Runs one function for many items, for example the status of many
+services. Items are grouped by their site. Each site gets at most
+max_per_site lanes, and each lane handles the items of its site one after
+another, so one slow site can neither be flooded with requests nor block
+the workers of the other sites.
+
+After the deadline no new items are started and run_per_site() returns
+with the results it has. Items without a result are reported as
+unfinished. Each item runs within what is left of the deadline
+(services.utils.deadline), so the UNICORE calls of a running item stop
+then as well, instead of keeping a batch thread busy.
+"""
+
+# Shared by all batch requests of this worker
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("BATCH_MAX_WORKERS", 32)),
+    thread_name_prefix="batch",
+)
+
+
+def run_per_site(items, site_of, func, max_per_site=4, deadline=30):
+    # Returns ({key: result}, {key: exception}, [unfinished keys])
+    # items is a dict key -> item
+    end = time.monotonic() + deadline
+    queues = collections.defaultdict(collections.deque)
+    for key, item in items.items():
+        queues[site_of(item)].append(key)
+
+    results = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def lane(queue):
+        while time.monotonic() < end:
+            with lock:
+                if not queue:
+                    return
+                key = queue.popleft()
+            # The threads live as long as the worker, like the poller's
+            close_old_connections()
+            try:
+                with call_deadline(end - time.monotonic()):
+                    result = func(items[key])
+            except Exception as e:
+                with lock:
+                    errors[key] = e
+            else:
+                with lock:
+                    results[key] = result
+            finally:
+                close_old_connections()
+
+    futures = []
+    for queue in queues.values():
+        for _ in range(min(max_per_site, len(queue))):
+            # Run with the caller's context, e.g. its pinned configuration
+            context = contextvars.copy_context()
+            futures.append(batch_executor.submit(context.run, lane, queue))
+    wait(futures, timeout=max(0, end - time.monotonic()))
+    with lock:
+        unfinished = [key for key in items if key not in results and key not in errors]
+        return dict(results), dict(errors), unfinished
@@ -0,0 +1,182 @@
+import collections
+import logging
+import threading
+import time
+
+from jupyterjsc_unicoremgr.settings import LOGGER_NAME
+from services.utils.sites import _site_unavailable
+from services.utils.sites import SiteUnavailable
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+If a UNICORE site is down, every request for it waits for the transport
+timeout. A CircuitBreaker per site_url counts the UNICORE calls of the
+last `window` seconds. A call fails, if the site did not respond
+(connection error, timeout, 5xx) or if it took longer than slow_call
+seconds. When at least min_calls calls were made and error_rate of them
+failed, the circuit opens: for open_seconds all requests for this site
+fail right away.
+
+Afterwards the circuit is half-open and up to half_open_calls requests are
+let through. If such a probe succeeds, the circuit is closed again,
+otherwise it's open for another open_seconds. Every state change is
+logged together with the breaker's stats().
+"""
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def breaker_config(config):
+    ret = {
+        "enabled": True,
+        "window": 60,
+        "min_calls": 5,
+        "error_rate": 0.5,
+        "slow_call": 60,
+        "open_seconds": 30,
+        "half_open_calls": 1,
+    }
+    ret.update(config.get("circuit_breaker", {}))
+    return ret
+
+
+class CircuitOpen(SiteUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, site_url, settings):
+        self.site_url = site_url
+        self.settings = settings
+        self.state = CLOSED
+        # (time, failed, duration) of the calls in the current window
+        self._calls = collections.deque()
+        self._open_until = 0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+
+    def _prune(self, now):
+        while self._calls and self._calls[0][0] < now - self.settings["window"]:
+            self._calls.popleft()
+
+    def _stats(self, now):
+        self._prune(now)
+        calls = len(self._calls)
+        failures = sum(1 for call in self._calls if call[1])
+        durations = [call[2] for call in self._calls]
+        return {
+            "site_url": self.site_url,
+            "state": self.state,
+            "calls": calls,
+            "failures": failures,
+            "error_rate": failures / calls if calls else 0.0,
+            "avg_duration": sum(durations) / calls if calls else 0.0,
+            "max_duration": max(durations, default=0.0),
+            "rejected": self.rejected,
+            "opened": self.opened,
+        }
+
+    def _set_state(self, now, state):
+        self.state = state
+        if state == OPEN:
+            self._open_until = now + self.settings["open_seconds"]
+            self.opened += 1
+        elif state == HALF_OPEN:
+            self._probes = 0
+        else:
+            self._calls.clear()
+        extra = {"uuidcode": "CircuitBreaker", "circuit_breaker": self._stats(now)}
+        if state == OPEN:
+            log.warning(f"Circuit breaker opened - {self.site_url}", extra=extra)
+        else:
+            log.info(f"Circuit breaker {state} - {self.site_url}", extra=extra)
+
+    def _current_state(self, now):
+        if self.state == OPEN and now >= self._open_until:
+            self._set_state(now, HALF_OPEN)
+        return self.state
+
+    def is_open(self):
+        with self._lock:
+            return self._current_state(time.monotonic()) == OPEN
+
+    def before_call(self):
+        # Raises CircuitOpen if the call must not be sent
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == HALF_OPEN and self._probes < self.settings["half_open_calls"]:
+                self._probes += 1
+            elif state != CLOSED:
+                self.rejected += 1
+                raise CircuitOpen(f"Circuit breaker for {self.site_url} is open")
+            return state
+
+    def after_call(self, started_in, duration, failed):
+        slow_call = self.settings["slow_call"]
+        failed = failed or (slow_call > 0 and duration > slow_call)
+        now = time.monotonic()
+        with self._lock:
+            if started_in == HALF_OPEN:
+                self._probes -= 1
+                if self.state == HALF_OPEN:
+                    self._set_state(now, OPEN if failed else CLOSED)
+                return
+            if self.state != CLOSED:
+                # Sent before the circuit opened
+                return
+            self._calls.append((now, failed, duration))
+            stats = self._stats(now)
+            if (
+                stats["calls"] >= self.settings["min_calls"]
+                and stats["error_rate"] >= self.settings["error_rate"]
+            ):
+                self._set_state(now, OPEN)
+
+    def call(self, func, *args, **kwargs):
+        started_in = self.before_call()
+        failed = False
+        tic = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            failed = _site_unavailable(e)
+            raise
+        finally:
+            self.after_call(started_in, time.monotonic() - tic, failed)
+
+    def stats(self):
+        with self._lock:
+            return self._stats(time.monotonic())
+
+
+class CircuitBreakers:
+    def __init__(self):
+        # site_url -> CircuitBreaker
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, site_url, settings):
+        with self._lock:
+            breaker = self._breakers.get(site_url)
+            if breaker is None:
+                breaker = CircuitBreaker(site_url, settings)
+                self._breakers[site_url] = breaker
+            else:
+                # The configuration may have been reloaded
+                breaker.settings = settings
+            return breaker
+
+    def clear(self):
+        with self._lock:
+            self._breakers.clear()
+
+    def stats(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.site_url: breaker.stats() for breaker in breakers}
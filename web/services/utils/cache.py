@@ -0,0 +1,102 @@
+import collections
+import os
+import threading
+
+"""
+Small in-memory caches for files below the job description base directory.
+Every lookup is validated against the file's mtime and size, so changes
+on disk are picked up without restarting the service.
+"""
+
+
+def copy_json(value):
+    # Much cheaper than copy.deepcopy for parsed JSON documents
+    if isinstance(value, dict):
+        return {k: copy_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_json(v) for v in value]
+    return value
+
+
+def file_signature(path):
+    stat_result = os.stat(path)
+    return (stat_result.st_mtime_ns, stat_result.st_size)
+
+
+def directory_signature(path):
+    # Changes when a file is added, removed, renamed or modified
+    stat_result = os.stat(path)
+    with os.scandir(path) as it:
+        files = tuple(
+            sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in it
+            )
+        )
+    return (stat_result.st_mtime_ns, files)
+
+
+class InputDirectory:
+    """
+    Listing and raw file contents of an input directory. Files are read on
+    first use only, so files that are always skipped are never opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.filenames = tuple(os.listdir(path))
+        self._contents = {}
+
+    def read(self, filename):
+        if filename not in self._contents:
+            with open(os.path.join(self.path, filename), "r") as f:
+                self._contents[filename] = f.read()
+        return self._contents[filename]
+
+
+class FileCache:
+    """
+    Thread-safe LRU cache. loader(path, *args) creates the cached value,
+    signature(path) decides whether a cached value is still valid.
+    """
+
+    def __init__(self, loader, signature=file_signature, maxsize=256):
+        self._loader = loader
+        self._signature = signature
+        self._maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, *args):
+        signature = self._signature(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = self._loader(path, *args)
+        with self._lock:
+            self._entries[path] = (signature, value)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self._maxsize,
+            }
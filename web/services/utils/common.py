@@ -7,6 +7,7 @@ from services.utils import _config
 from services.utils import get_error_message
 from services.utils import MgrException
 from services.utils import pyunicore
+from services.utils.breaker import CircuitOpen
 
 log = logging.getLogger(LOGGER_NAME)
 assert log.__class__.__name__ == "ExtraLoggerClass"
@@ -67,6 +68,9 @@ def status_service(instance_dict, custom_headers, logs_extra):
         log.warning("Service status check failed", extra=logs_extra, exc_info=True)
         if e.__class__.__name__ == "MgrException":
             e_args = e.args
+        elif isinstance(e, CircuitOpen):
+            # The circuit opened during the status check
+            e_args = (pyunicore._circuit_open_message(config, logs_extra), str(e))
         else:
             user_error_msg = get_error_message(
                 config,
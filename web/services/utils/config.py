@@ -0,0 +1,464 @@
+import os
+import re
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any
+from typing import Mapping
+from typing import Tuple
+
+"""
+The configuration file is deeply nested and almost every key is optional.
+Instead of walking config.get(...).get(...) chains with defaults at every
+lookup, each system is compiled once per reload into an immutable
+SystemConfig with all defaults already applied.
+"""
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+@dataclass(frozen=True)
+class TransportConfig:
+    oidc: bool
+    certificate_path: Any
+    timeout: int
+    set_preferences: bool
+
+
+@dataclass(frozen=True)
+class OutputConfig:
+    lines: int
+    join: str
+    summary: str
+    max_bytes: int
+
+
+@dataclass(frozen=True)
+class JobDescriptionConfig:
+    base_directory: str
+    template_filename: str
+    replace_indicators: Tuple[str, str]
+    input_directory_name: str
+    skip_prefixs: Tuple[str, ...]
+    skip_suffixs: Tuple[str, ...]
+    resource_mapping: Mapping[str, str]
+    environment_key: str
+    skip_environments: Tuple[str, ...]
+    type_key: str
+    interactive_type_value: str
+    interactive_node_key: str
+    normal_type_value: str
+    resources_key: str
+    queue_key: str
+    set_queue: bool
+    user_options_reservation_key: str
+    reservation_key: str
+    imports_key: str
+    imports_from_value: str
+    certs_keyfile_name: str
+    certs_certfile_name: str
+    certs_cafile_name: str
+
+
+@dataclass(frozen=True)
+class Hook:
+    name: str
+    # (user_options key, allowed values), all of them must match
+    conditions: Tuple[Tuple[str, Any], ...]
+
+    def evaluate(self, user_options):
+        for key, values in self.conditions:
+            try:
+                if user_options.get(key, "") not in values:
+                    return False
+            except TypeError:
+                # Unhashable user_options can't be part of a set of strings
+                return False
+        return True
+
+
+def _compile_hook_values(values):
+    # A string is kept as is, "in" tests for a substring like before
+    if isinstance(values, str):
+        return values
+    try:
+        return frozenset(values)
+    except TypeError:
+        return tuple(values)
+
+
+def _compile_hooks(hooks):
+    return MappingProxyType(
+        {
+            name: Hook(
+                name=name,
+                conditions=tuple(
+                    (key, _compile_hook_values(values))
+                    for key, values in hook_infos.items()
+                ),
+            )
+            for name, hook_infos in hooks.items()
+        }
+    )
+
+
+@dataclass(frozen=True)
+class SystemConfig:
+    # system as sent by JupyterHub and the system it's mapped to
+    name: str
+    mapped_system: str
+    # These keys are read from the unmapped system
+    site_url: str
+    interactive_partitions: Mapping[str, str]
+    hooks: Mapping[str, Hook]
+    # Everything else is read from the mapped system
+    get_bss_details: bool
+    download_after_stop: bool
+    delete_after_stop: bool
+    job_archive: str
+    download_files: Tuple[str, ...]
+    transport: TransportConfig
+    job_description: JobDescriptionConfig
+    detailed_error_join: str
+    unicore_logs: OutputConfig
+    unicore_stdout: OutputConfig
+    unicore_stderr: OutputConfig
+
+
+def _compile_output(status_information, key, lines, summary):
+    output = status_information.get(key, {})
+    return OutputConfig(
+        lines=output.get("lines", lines),
+        join=output.get("join", "<br>"),
+        summary=output.get("summary", summary),
+        max_bytes=output.get("max_bytes", 4096),
+    )
+
+
+def _compile_job_description(job_description):
+    input_config = job_description.get("input", {})
+    keywords = job_description.get("unicore_keywords", {})
+    interactive = keywords.get("interactive", {})
+    normal = keywords.get("normal", {})
+    # The reservation keys are not part of unicore_keywords
+    normal_reservation = job_description.get("normal", {})
+    certs = job_description.get("certs", {})
+    return JobDescriptionConfig(
+        base_directory=job_description.get(
+            "base_directory", "/mnt/config/job_descriptions"
+        ),
+        template_filename=job_description.get(
+            "template_filename", "job_description.json.template"
+        ),
+        replace_indicators=tuple(job_description.get("replace_indicators", ["<", ">"])),
+        input_directory_name=input_config.get("directory_name", "input"),
+        skip_prefixs=tuple(input_config.get("skip_prefixs", ["skip_"])),
+        skip_suffixs=tuple(input_config.get("skip_suffixs", [".swp"])),
+        resource_mapping=_freeze(job_description.get("resource_mapping", {})),
+        environment_key=keywords.get("environment_key", "Environment"),
+        skip_environments=tuple(
+            keywords.get("skip_environments", ["JUPYTERHUB_API_TOKEN", "JPY_API_TOKEN"])
+        ),
+        type_key=keywords.get("type_key", "Job type"),
+        interactive_type_value=interactive.get("type_value", "interactive"),
+        interactive_node_key=interactive.get("node_key", "Login node"),
+        normal_type_value=normal.get("type_value", "normal"),
+        resources_key=normal.get("resources_key", "Resources"),
+        queue_key=normal.get("queue_key", "Queue"),
+        set_queue=normal.get("set_queue", True),
+        user_options_reservation_key=normal_reservation.get(
+            "user_options_reservation_key", "reservation"
+        ),
+        reservation_key=normal_reservation.get("reservation_key", "Reservation"),
+        imports_key=keywords.get("imports_key", "Imports"),
+        imports_from_value=keywords.get("imports_from_value", "inline://dummy"),
+        certs_keyfile_name=certs.get("keyfile_name", "service_cert.key"),
+        certs_certfile_name=certs.get("certfile_name", "service_cert.crt"),
+        certs_cafile_name=certs.get("cafile_name", "service_ca.crt"),
+    )
+
+
+def compile_system_config(config, system):
+    systems = config.get("systems", {})
+    mapped_system = systems.get("mapping", {}).get("system", {}).get(system, system)
+    unmapped_config = systems.get(system, {})
+    mapped_config = systems.get(mapped_system, {})
+    pyunicore_config = mapped_config.get("pyunicore", {})
+    transport = pyunicore_config.get("transport", {})
+    status_information = mapped_config.get("status_information", {})
+    return SystemConfig(
+        name=system,
+        mapped_system=mapped_system,
+        site_url=unmapped_config.get(
+            "site_url", "https://localhost:8080/DEMO-SITE/rest/core"
+        ),
+        interactive_partitions=_freeze(
+            unmapped_config.get("interactive_partitions", {})
+        ),
+        hooks=_compile_hooks(unmapped_config.get("hooks", {})),
+        get_bss_details=mapped_config.get("get_bss_details", False),
+        download_after_stop=pyunicore_config.get("download_after_stop", False),
+        delete_after_stop=pyunicore_config.get("delete_after_stop", False),
+        job_archive=pyunicore_config.get("job_archive", "/tmp"),
+        download_files=tuple(
+            pyunicore_config.get("download_files", ["stderr", "stdout", "bss_submit"])
+        ),
+        transport=TransportConfig(
+            oidc=transport.get("oidc", True),
+            certificate_path=transport.get("certificate_path", False),
+            timeout=transport.get("timeout", 120),
+            set_preferences=transport.get("set_preferences", True),
+        ),
+        job_description=_compile_job_description(
+            pyunicore_config.get("job_description", {})
+        ),
+        detailed_error_join=status_information.get("detailed_error_join", ""),
+        unicore_logs=_compile_output(
+            status_information,
+            "unicore_logs",
+            3,
+            "&nbsp&nbsp&nbsp&nbspUNICORE logs:",
+        ),
+        unicore_stdout=_compile_output(
+            status_information,
+            "unicore_stdout",
+            5,
+            "&nbsp&nbsp&nbsp&nbspJob stdout:",
+        ),
+        unicore_stderr=_compile_output(
+            status_information,
+            "unicore_stderr",
+            5,
+            "&nbsp&nbsp&nbsp&nbspJob stderr:",
+        ),
+    )
+
+
+@dataclass(frozen=True)
+class InputFilesConfig:
+    # Filenames starting with one of these prefixes are skipped
+    skip_prefixs: Tuple[str, ...]
+    skip_prefix_matcher: Any
+    skip_suffixs: Tuple[str, ...]
+    # Prefixes removed from the filename, the first match wins
+    rename_prefixs: Tuple[str, ...]
+    # Configured replacements in the order they are applied ...
+    replace_pairs: Tuple[Tuple[str, str], ...]
+    # ... and merged, the most specific value wins
+    replacements: Mapping[str, str]
+
+    def skip(self, filename):
+        if self.skip_prefix_matcher and self.skip_prefix_matcher.match(filename):
+            return True
+        return filename.endswith(self.skip_suffixs)
+
+    def rename(self, filename):
+        for prefix in self.rename_prefixs:
+            if filename.startswith(prefix):
+                return filename[len(prefix) :]
+        return filename
+
+
+def _skip_prefixs(skip_config, stage, credential, system):
+    skip_stages = skip_config.get("stage", [])
+    skip_credentials = skip_config.get("credential", [])
+    skip_systems = skip_config.get("system", [])
+    prefixs = []
+    # We will skip files that are not meant for specific configurations
+    if stage:
+        prefixs.extend(f"{x}_" for x in skip_stages if x != stage)
+        # Same stage but different credential
+        prefixs.extend(f"{stage}_{x}_" for x in skip_credentials if x != credential)
+        # Same stage but different system
+        prefixs.extend(f"{stage}_{x}_" for x in skip_systems if x != system)
+        # Same stage and credential but different system
+        prefixs.extend(
+            f"{stage}_{x}_{system}_" for x in skip_credentials if x != credential
+        )
+    # Same credential but different system
+    prefixs.extend(f"{credential}_{x}_" for x in skip_systems if x != system)
+    prefixs.extend(f"{x}_" for x in skip_credentials if x != credential)
+    prefixs.extend(f"{x}_" for x in skip_systems if x != system)
+    return prefixs
+
+
+def _replace_pairs(replace_config, stage, credential, system):
+    pairs = []
+    # We start with the most specific replacements and follow up with the least specific ones
+    if stage:
+        pairs.extend(
+            replace_config.get("stage_credential_system", {})
+            .get(stage, {})
+            .get(credential, {})
+            .get(system, {})
+            .items()
+        )
+        pairs.extend(
+            replace_config.get("stage_credential", {})
+            .get(stage, {})
+            .get(credential, {})
+            .items()
+        )
+        pairs.extend(
+            replace_config.get("stage_system", {})
+            .get(stage, {})
+            .get(system, {})
+            .items()
+        )
+        pairs.extend(replace_config.get("stage", {}).get(stage, {}).items())
+    pairs.extend(
+        replace_config.get("credential_system", {})
+        .get(credential, {})
+        .get(system, {})
+        .items()
+    )
+    pairs.extend(replace_config.get("credential", {}).get(credential, {}).items())
+    pairs.extend(replace_config.get("system", {}).get(system, {}).items())
+    return pairs
+
+
+def compile_input_files_config(config, stage, credential, system):
+    mapping = config.get("systems", {}).get("mapping", {})
+    jd_config = get_system_config(config, system).job_description
+    skip_prefixs = tuple(jd_config.skip_prefixs) + tuple(
+        _skip_prefixs(mapping.get("skip", {}), stage, credential, system)
+    )
+    if skip_prefixs:
+        # Longest prefixes first, one regex instead of a loop over all prefixes
+        skip_prefix_matcher = re.compile(
+            "|".join(
+                re.escape(prefix)
+                for prefix in sorted(set(skip_prefixs), key=len, reverse=True)
+            )
+        )
+    else:
+        skip_prefix_matcher = None
+    replace_pairs = tuple(
+        _replace_pairs(mapping.get("replace", {}), stage, credential, system)
+    )
+    replacements = {}
+    for key, value in replace_pairs:
+        replacements.setdefault(key, value)
+    return InputFilesConfig(
+        skip_prefixs=skip_prefixs,
+        skip_prefix_matcher=skip_prefix_matcher,
+        skip_suffixs=tuple(jd_config.skip_suffixs),
+        rename_prefixs=(
+            f"{stage}_{credential}_{system}_",
+            f"{stage}_{credential}_",
+            f"{stage}_{system}_",
+            f"{credential}_{system}_",
+            f"{stage}_",
+            f"{credential}_",
+            f"{system}_",
+        ),
+        replace_pairs=replace_pairs,
+        replacements=MappingProxyType(replacements),
+    )
+
+
+def _nested_keys(mapping, depth):
+    # All keys on the given depth of a nested dict
+    if depth == 0:
+        return set(mapping.keys())
+    keys = set()
+    for value in mapping.values():
+        if isinstance(value, Mapping):
+            keys.update(_nested_keys(value, depth - 1))
+    return keys
+
+
+def _known_credentials_and_systems(config):
+    mapping = config.get("systems", {}).get("mapping", {})
+    replace_config = mapping.get("replace", {})
+    skip_config = mapping.get("skip", {})
+    credentials = set(config.get("credential_mapping", {}).keys())
+    credentials.update(skip_config.get("credential", []))
+    credentials.update(_nested_keys(replace_config.get("credential", {}), 0))
+    credentials.update(_nested_keys(replace_config.get("credential_system", {}), 0))
+    credentials.update(_nested_keys(replace_config.get("stage_credential", {}), 1))
+    credentials.update(
+        _nested_keys(replace_config.get("stage_credential_system", {}), 1)
+    )
+    systems = set(config.get("systems", {}).keys())
+    systems.update(mapping.get("system", {}).keys())
+    systems.update(skip_config.get("system", []))
+    systems.update(_nested_keys(replace_config.get("system", {}), 0))
+    systems.update(_nested_keys(replace_config.get("credential_system", {}), 1))
+    systems.update(_nested_keys(replace_config.get("stage_system", {}), 1))
+    systems.update(_nested_keys(replace_config.get("stage_credential_system", {}), 2))
+    systems.discard("mapping")
+    return credentials, systems
+
+
+class Config(dict):
+    """
+    Immutable snapshot of the parsed configuration file. It behaves like the
+    plain dict it was created from, but carries a precompiled SystemConfig
+    for every configured system and the version it was loaded as.
+    """
+
+    def __init__(self, data, version=0):
+        super().__init__({key: _freeze(value) for key, value in data.items()})
+        self.version = version
+        systems = self.get("systems", {})
+        names = set(systems.keys())
+        names.update(systems.get("mapping", {}).get("system", {}).keys())
+        names.discard("mapping")
+        self.systems = MappingProxyType(
+            {name: compile_system_config(self, name) for name in names}
+        )
+        # Skip and replace rules for every known credential and system. The
+        # stage is taken from the environment and does not change at runtime.
+        self.stage = os.environ.get("STAGE", "").lower()
+        credentials, systems = _known_credentials_and_systems(self)
+        self.input_files = MappingProxyType(
+            {
+                (self.stage, credential, system): compile_input_files_config(
+                    self, self.stage, credential, system
+                )
+                for credential in credentials
+                for system in systems
+            }
+        )
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Config snapshots are read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def system(self, system):
+        if system in self.systems:
+            return self.systems[system]
+        # Not configured at all, only defaults apply
+        return compile_system_config(self, system)
+
+    def input_files_config(self, stage, credential, system):
+        key = (stage, credential, system)
+        if key in self.input_files:
+            return self.input_files[key]
+        return compile_input_files_config(self, stage, credential, system)
+
+
+def get_system_config(config, system):
+    if not isinstance(config, Config):
+        raise TypeError(f"Expected a Config, got {type(config).__name__}")
+    return config.system(system)
+
+
+def get_input_files_config(config, stage, credential, system):
+    if not isinstance(config, Config):
+        raise TypeError(f"Expected a Config, got {type(config).__name__}")
+    return config.input_files_config(stage, credential, system)
@@ -0,0 +1,126 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import random
+import time
+
+import requests
+
+"""
+start, status and stop each get a deadline (deadlines.start / status /
+stop seconds), shared by all UNICORE calls of the operation. Every call
+uses the configured transport timeout, but never more than what is left
+of the deadline. Once it has passed, no further call is sent.
+
+Idempotent GET requests are retried on connection errors, timeouts and
+502/503/504 responses, with exponential backoff and full jitter, as long as
+the remaining budget allows it. POST, PUT and DELETE are never retried.
+
+The deadline is kept in a context variable. Work submitted to a thread
+pool must run in a copy of the caller's context to share it. The remaining
+budget is part of every "UNICORE communication" log record (tictoc).
+"""
+
+_deadline = contextvars.ContextVar("unicore_deadline", default=None)
+
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+def deadline_config(config):
+    ret = {
+        "start": 180,
+        "status": 60,
+        "stop": 600,
+        "retries": 3,
+        "backoff": 0.5,
+        "backoff_max": 5,
+    }
+    ret.update(config.get("deadlines", {}))
+    return ret
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    # A nested deadline can only shorten the budget of the outer one
+    end = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        end = min(end, current)
+    token = _deadline.set(end)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def with_deadline(operation):
+    # For functions that get the configuration as first argument
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(config, *args, **kwargs):
+                with deadline(deadline_config(config)[operation]):
+                    return await func(config, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(config, *args, **kwargs):
+            with deadline(deadline_config(config)[operation]):
+                return func(config, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def remaining():
+    # Seconds left, None without a deadline
+    end = _deadline.get()
+    if end is None:
+        return None
+    return end - time.monotonic()
+
+
+def request_timeout(timeout):
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded by {-left:.1f}s")
+    if timeout is None:
+        return left
+    return min(timeout, left)
+
+
+def retry_delay(attempt, backoff, backoff_max):
+    # Full jitter, so retries of many requests spread out
+    return random.uniform(0, min(backoff_max, backoff * 2**attempt))
+
+
+def may_retry(delay):
+    # Only if the budget is left after the delay
+    left = remaining()
+    return left is None or left > delay
+
+
+def is_transient(e):
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code in RETRY_STATUS_CODES
+    return False
+
+
+def tictoc_extra(tictoc, duration):
+    ret = {"tictoc": tictoc, "duration": duration}
+    left = remaining()
+    if left is not None:
+        ret["remaining"] = left
+    return ret
@@ -0,0 +1,156 @@
+import contextvars
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from jupyterjsc_unicoremgr.settings import LOGGER_NAME
+from services.utils.deadline import tictoc_extra
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Downloads the allowed files of a UNICORE working directory to the job
+archive. Each directory is listed once, and only if it may contain an
+allowed file (allowed_files are prefixes of the relative path). The files
+are downloaded in parallel by a thread pool shared by all downloads of
+this worker.
+
+Each file is streamed to a temporary file next to its destination and
+renamed afterwards, so the archive never contains partial files.
+"""
+
+# Shared by all downloads of this worker
+download_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DOWNLOAD_MAX_WORKERS", 8)),
+    thread_name_prefix="download",
+)
+
+
+def is_allowed(name, allowed_files):
+    return any(name.startswith(allowed_file) for allowed_file in allowed_files)
+
+
+def may_contain_allowed(dir_name, allowed_files):
+    # dir/ may contain dir/sub/file.txt, and everything if "dir" is allowed
+    prefix = f"{dir_name.strip('/')}/"
+    return any(
+        allowed_file.startswith(prefix) or prefix.startswith(allowed_file)
+        for allowed_file in allowed_files
+    )
+
+
+def _listdir(storage, base, logs_extra):
+    tic = time.time()
+    try:
+        return storage.listdir(base)
+    finally:
+        toc = time.time() - tic
+        extra_tic = tictoc_extra("storage.listdir", toc)
+        extra_tic.update(logs_extra)
+        log.debug("UNICORE communication", extra=extra_tic)
+
+
+def list_files(storage, allowed_files, logs_extra={}):
+    # Returns {relative name: path} of all allowed files
+    files = {}
+    dirs = ["/"]
+    while dirs:
+        # All directories of one level are listed in parallel
+        futures = [
+            download_executor.submit(
+                contextvars.copy_context().run, _listdir, storage, base, logs_extra
+            )
+            for base in dirs
+        ]
+        dirs = []
+        for future in futures:
+            for name, path in future.result().items():
+                if path.isfile():
+                    if is_allowed(name, allowed_files):
+                        files[name] = path
+                elif path.isdir():
+                    if may_contain_allowed(name, allowed_files):
+                        dirs.append(f"/{name.strip('/')}/")
+                    else:
+                        log.trace(f"Download Service - skip: {name}", extra=logs_extra)
+    return files
+
+
+def _destination_path(destination, name):
+    # Names come from UNICORE, nothing may end up outside of destination
+    path = os.path.normpath(os.path.join(destination, name.lstrip("/")))
+    if os.path.commonpath([destination, path]) != destination:
+        return None
+    return path
+
+
+def download_file(path, file_destination, logs_extra={}):
+    # Returns the number of bytes written
+    log.trace(f"Download Service - download: {path.name}", extra=logs_extra)
+    dirname, basename = os.path.split(file_destination)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=f".{basename}.", suffix=".part")
+    tic = time.time()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            path.download(f)
+            size = f.tell()
+        os.replace(tmp, file_destination)
+    except Exception:
+        os.unlink(tmp)
+        raise
+    finally:
+        toc = time.time() - tic
+        extra_tic = tictoc_extra("path.download", toc)
+        extra_tic.update(logs_extra)
+        log.debug("UNICORE communication", extra=extra_tic)
+    return size
+
+
+def download_files(storage, destination, allowed_files, logs_extra={}):
+    # Returns {"files": ..., "bytes": ..., "duration": ...}
+    tic = time.time()
+    destination = os.path.abspath(destination)
+    os.makedirs(destination, exist_ok=True)
+    files = list_files(storage, allowed_files, logs_extra=logs_extra)
+    futures = {}
+    for name, path in files.items():
+        file_destination = _destination_path(destination, name)
+        if file_destination is None:
+            log.warning(f"Download Service - skip: {name}", extra=logs_extra)
+            continue
+        future = download_executor.submit(
+            contextvars.copy_context().run,
+            download_file,
+            path,
+            file_destination,
+            logs_extra,
+        )
+        futures[future] = name
+    wait(futures)
+    size = 0
+    errors = []
+    for future, name in futures.items():
+        try:
+            size += future.result()
+        except Exception as e:
+            log.warning(
+                f"Download Service - could not download {name}",
+                extra=logs_extra,
+                exc_info=True,
+            )
+            errors.append(e)
+    ret = {"files": len(futures) - len(errors), "bytes": size}
+    ret["duration"] = time.time() - tic
+    log.info(
+        f"Download Service files finished - {ret['files']} files, "
+        f"{ret['bytes']} bytes in {ret['duration']:.2f}s",
+        extra=dict(logs_extra, **ret),
+    )
+    if errors:
+        raise errors[0]
+    return ret
@@ -0,0 +1,261 @@
+import codecs
+import collections
+import functools
+import json
+import logging
+import threading
+
+from django.http import StreamingHttpResponse
+from jupyterjsc_unicoremgr.settings import LOGGER_NAME
+from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import Throttled
+from rest_framework.exceptions import ValidationError
+from services.utils import get_error_message
+from services.utils import MgrException
+from services.utils.tail import REJECTED_STATUS_CODES
+from services.utils.tail import skip_partial_character
+from services.utils.tail import tail_headers
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+GET /api/services/<servername>/logs/?stream=stdout sends the output
+(stdout or stderr) of a service as server-sent events while it's written.
+The first event contains the last initial_bytes of the file. Afterwards
+the file is polled with byte ranges starting at the current offset, so
+only new bytes are transferred. Without new data the poll interval grows
+from interval to interval_max seconds (factor backoff), new data resets
+it. Idle streams get a keep-alive comment per poll.
+
+The id of each event is the byte offset after its data. A client that
+reconnects sends it as Last-Event-ID (or ?offset=) and continues there.
+Once the job has finished and everything is sent, an "end" event with the
+job's status closes the stream. After max_duration seconds the stream is
+closed without it, so the client reconnects.
+
+Streams are only served by the async views (ASYNC_VIEWS=true), where a
+stream is a coroutine instead of a gunicorn thread. Each user may have
+max_per_user open streams per worker, and all users together
+max_per_worker.
+"""
+
+STREAMS = ("stdout", "stderr")
+FINISHED_STATUSES = ("SUCCESSFUL", "FAILED")
+KEEP_ALIVE = b": keep-alive\n\n"
+
+
+def log_stream_config(config):
+    ret = {
+        "max_per_user": 2,
+        "initial_bytes": 16384,
+        "chunk_bytes": 65536,
+        "interval": 1,
+        "interval_max": 30,
+        "backoff": 2,
+        "max_duration": 300,
+        "max_per_worker": 10,
+    }
+    ret.update(config.get("log_stream", {}))
+    return ret
+
+
+class StreamLimiter:
+    def __init__(self):
+        # user -> open streams
+        self._streams = collections.Counter()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, user, limit, total_limit):
+        with self._lock:
+            if self._streams[user] >= limit or self._total >= total_limit:
+                return False
+            self._streams[user] += 1
+            self._total += 1
+            return True
+
+    def release(self, user):
+        with self._lock:
+            self._streams[user] -= 1
+            self._total -= 1
+            if self._streams[user] <= 0:
+                del self._streams[user]
+
+    def streams(self, user=None):
+        with self._lock:
+            if user is None:
+                return self._total
+            return self._streams[user]
+
+
+# Shared by all streams of this worker
+stream_limiter = StreamLimiter()
+
+
+def parse_content_range(value):
+    # "bytes 10-19/20" -> (10, 20), total is None for "*"
+    try:
+        unit, byte_range = value.split(" ", 1)
+        first_last, total = byte_range.split("/", 1)
+        if unit != "bytes":
+            return None, None
+        start = int(first_last.split("-", 1)[0])
+        return start, None if total == "*" else int(total)
+    except (AttributeError, ValueError):
+        return None, None
+
+
+def sse_event(data, event=None, event_id=None):
+    lines = []
+    if event is not None:
+        lines.append(f"event: {event}")
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    data = data.replace("\r\n", "\n").replace("\r", "\n")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return ("\n".join(lines) + "\n\n").encode()
+
+
+class LogTail:
+    """
+    Offset, decoding and poll interval of one stream, without any I/O.
+    Each response is passed to feed(), request_headers() are the headers
+    of the next request.
+    """
+
+    def __init__(self, settings, offset=None):
+        self.settings = settings
+        # None until the first response
+        self.offset = offset
+        # Whether the file has more bytes than the last range
+        self.more = False
+        self.interval = settings["interval"]
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def request_headers(self):
+        if self.offset is None:
+            return tail_headers(self.settings["initial_bytes"])
+        last = self.offset + self.settings["chunk_bytes"] - 1
+        return {
+            "Accept": "application/octet-stream",
+            "Range": f"bytes={self.offset}-{last}",
+        }
+
+    @property
+    def event_id(self):
+        # An incomplete character is sent with the next event
+        return self.offset - len(self._decoder.getstate()[0])
+
+    def feed(self, status_code, content_range, data):
+        # Returns the new text
+        total = None
+        if status_code in REJECTED_STATUS_CODES:
+            # Nothing at this offset. Without suffix ranges or with an
+            # empty file the stream starts at the beginning.
+            start = self.offset or 0
+            data = b""
+        elif status_code == 206:
+            start, total = parse_content_range(content_range)
+            if start is None:
+                start = self.offset or 0
+        elif self.offset is None:
+            # The Range header was ignored
+            start = max(0, len(data) - self.settings["initial_bytes"])
+            data = data[start:]
+        else:
+            start = self.offset
+            data = data[start:]
+        text_data = data
+        if self.offset is None and start > 0:
+            text_data = skip_partial_character(data)
+        self.offset = start + len(data)
+        if total is None:
+            self.more = status_code == 206 and len(data) >= self.settings["chunk_bytes"]
+        else:
+            self.more = self.offset < total
+        return self._decoder.decode(text_data)
+
+    def wait(self, new_data):
+        # Seconds until the next poll, longer the longer there's no new data
+        if new_data:
+            self.interval = self.settings["interval"]
+            return self.interval
+        interval = self.interval
+        self.interval = min(
+            self.settings["interval_max"], interval * self.settings["backoff"]
+        )
+        return interval
+
+
+def open_stream(config, request, instance, custom_headers):
+    # Returns file, offset and the function that frees the user's slot
+    file = request.query_params.get("stream", "stdout")
+    if file not in STREAMS:
+        raise ValidationError({"stream": f"Must be one of {', '.join(STREAMS)}."})
+    offset = request.META.get(
+        "HTTP_LAST_EVENT_ID", request.query_params.get("offset", None)
+    )
+    if offset is not None:
+        try:
+            offset = int(offset)
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise ValidationError({"offset": "Must be a byte offset."})
+    if instance.stop_pending:
+        raise NotFound("Service is stopping.")
+    if "access-token" not in custom_headers.keys():
+        raise ValidationError({"access-token": "This header is required."})
+    user = request.user.username
+    settings = log_stream_config(config)
+    if not stream_limiter.acquire(
+        user, settings["max_per_user"], settings["max_per_worker"]
+    ):
+        raise Throttled(detail="Too many open log streams.")
+    return file, offset, functools.partial(stream_limiter.release, user)
+
+
+def error_event(config, e, logs_extra):
+    log.warning("Log stream failed", extra=logs_extra, exc_info=True)
+    if isinstance(e, MgrException):
+        data = {"error": e.args[0], "detailed_error": e.args[1]}
+    else:
+        user_error_msg = get_error_message(
+            config,
+            logs_extra,
+            "services.utils.logstream.stream_logs",
+            "UNICORE error while reading the logs.",
+        )
+        data = {"error": user_error_msg, "detailed_error": str(e)}
+    return sse_event(json.dumps(data), event="error")
+
+
+class EventStream:
+    # close() frees the user's slot, also if the stream never started
+    def __init__(self, events, release):
+        self.events = events
+        self.release = release
+
+    def __iter__(self):
+        # Sent by jupyterjsc_unicoremgr.asgi.ASGIHandler
+        return iter(())
+
+    def __aiter__(self):
+        return self.events.__aiter__()
+
+    def close(self):
+        if self.release is not None:
+            self.release()
+            self.release = None
+
+
+def event_stream_response(events, release):
+    stream = EventStream(events, release)
+    response = StreamingHttpResponse(stream, content_type="text/event-stream")
+    # Django 3.2 iterates streaming responses synchronously
+    response.async_streaming_content = stream
+    response["Cache-Control"] = "no-cache"
+    # No buffering in nginx
+    response["X-Accel-Buffering"] = "no"
+    return response
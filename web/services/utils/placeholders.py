@@ -0,0 +1,112 @@
+import functools
+import re
+
+"""
+Job description files contain placeholders like <JUPYTERHUB_USER_ID>. The
+replacements used to be applied one str.replace() pass per key, in a fixed
+order. Placeholders renders the same result in a single pass: each text is
+split into literals and placeholder keys once, and every key is resolved
+through a lookup table in which the first value of a key wins (like the
+first str.replace() pass did).
+
+A single pass only differs from the sequential passes if a replacement
+creates a new placeholder, which a later pass would have replaced. If
+that might happen, we fall back to the sequential passes, so the output is
+always identical.
+
+Parsed JSON documents are rendered with render_json(), which walks the
+nested dicts and lists and only rewrites strings (keys and values). No
+serialization is needed, and values containing quotes or backslashes
+cannot break the document.
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def _pattern(start, end):
+    indicator_chars = re.escape("".join(sorted(set(start + end))))
+    return re.compile(f"{re.escape(start)}([^{indicator_chars}]+){re.escape(end)}")
+
+
+def _tokenize(text, start, end):
+    # Literals at even, placeholder keys at odd positions
+    tokens = []
+    pos = 0
+    for match in _pattern(start, end).finditer(text):
+        tokens.append(text[pos : match.start()])
+        tokens.append(match.group(1))
+        pos = match.end()
+    tokens.append(text[pos:])
+    return tuple(tokens)
+
+
+# Input files are cached, so the same text objects are tokenized over and over
+_tokenize_cached = functools.lru_cache(maxsize=1024)(_tokenize)
+
+
+class Placeholders:
+    def __init__(self, replace_indicators, pairs):
+        self.start = replace_indicators[0]
+        self.end = replace_indicators[1]
+        # Ordered (key, value) pairs, as the sequential passes used them
+        self.pairs = tuple(pairs)
+        self.table = {}
+        for key, value in self.pairs:
+            self.table.setdefault(key, value)
+        indicator_chars = set(self.start + self.end)
+        # Placeholders can only overlap if keys contain indicator characters
+        # or if the indicators overlap each other (e.g. "%%" and "%%").
+        self.single_pass = (
+            bool(self.start)
+            and bool(self.end)
+            and self.start[0] not in self.end
+            and self.end[-1] not in self.start
+            and all(key and not indicator_chars.intersection(key) for key in self.table)
+        )
+
+    def placeholder(self, key):
+        return f"{self.start}{key}{self.end}"
+
+    def keys(self, text):
+        # Keys of all placeholders in text, in order
+        return list(_tokenize(text, self.start, self.end)[1::2])
+
+    def render_sequential(self, text):
+        for key, value in self.pairs:
+            text = text.replace(self.placeholder(key), value)
+        return text
+
+    def render(self, text, cache_tokens=False):
+        if self.start not in text:
+            return text
+        if not self.single_pass:
+            return self.render_sequential(text)
+        tokenize = _tokenize_cached if cache_tokens else _tokenize
+        parts = list(tokenize(text, self.start, self.end))
+        for i in range(1, len(parts), 2):
+            key = parts[i]
+            if key in self.table:
+                parts[i] = self.table[key]
+            else:
+                parts[i] = self.placeholder(key)
+        result = "".join(parts)
+        # All original placeholders with known keys are gone. If one shows up
+        # now, a replacement created it and a later pass might have used it.
+        for match in _pattern(self.start, self.end).finditer(result):
+            if match.group(1) in self.table:
+                return self.render_sequential(text)
+        return result
+
+    def render_json(self, value, cache_tokens=False):
+        # Returns a new document, the given one is not modified
+        if isinstance(value, str):
+            return self.render(value, cache_tokens=cache_tokens)
+        if isinstance(value, dict):
+            return {
+                self.render(k, cache_tokens=cache_tokens): self.render_json(
+                    v, cache_tokens=cache_tokens
+                )
+                for k, v in value.items()
+            }
+        if isinstance(value, list):
+            return [self.render_json(v, cache_tokens=cache_tokens) for v in value]
+        return value
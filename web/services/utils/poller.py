@@ -0,0 +1,283 @@
+import copy
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from jupyterjsc_unicoremgr.settings import LOGGER_NAME
+from services.models import ServicesModel
+from services.models import StatusSnapshotModel
+from services.utils import _config
+from services.utils import MgrException
+from services.utils import pinned_config
+from services.utils.common import instance_dict_and_custom_headers_to_logs_extra
+from services.utils.common import status_service
+from services.utils.transports import token_expiry
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+The status of a service is stored in StatusSnapshotModel. retrieve serves
+it from there as long as it's not older than status_poller.max_age
+seconds, so a hub poll doesn't always cost a UNICORE round trip.
+
+The StatusPoller thread (one per gunicorn worker) keeps the snapshots up
+to date: services that are queued or starting are polled every
+interval_starting seconds, running ones every interval_running seconds.
+Services in a terminal state (SUCCESSFUL, FAILED) are not polled again.
+Their status can't change anymore, so it's always stored (even without
+the poller) and served from the snapshot, without any UNICORE request.
+
+The poller uses the last access token JupyterHub has sent for a service.
+Tokens are only kept in memory (TokenStore), never in the database. Before
+polling a service, a poller takes a lease on its snapshot row with a
+single conditional UPDATE, so only one worker (of all pods) polls it.
+"""
+
+TERMINAL_STATES = ("SUCCESSFUL", "FAILED")
+
+
+def poller_config(config):
+    ret = {
+        "enabled": False,
+        "max_age": 0,
+        "interval_starting": 10,
+        "interval_running": 300,
+        "interval_error": 60,
+        "lease": 60,
+        "tick": 5,
+        "batch_size": 50,
+        "token_ttl": 300,
+    }
+    ret.update(config.get("status_poller", {}))
+    return ret
+
+
+class TokenStore:
+    def __init__(self):
+        # service id -> (expires, custom_headers)
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def set(self, service_id, custom_headers, ttl):
+        expires = token_expiry(custom_headers["access-token"])
+        if expires is None:
+            expires = time.time() + ttl
+        with self._lock:
+            self._tokens[service_id] = (expires, copy.deepcopy(custom_headers))
+
+    def get(self, service_id):
+        with self._lock:
+            entry = self._tokens.get(service_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._tokens[service_id]
+                return None
+            return copy.deepcopy(entry[1])
+
+    def discard(self, service_id):
+        with self._lock:
+            self._tokens.pop(service_id, None)
+
+    def service_ids(self):
+        # Services with a valid token, expired ones are removed
+        now = time.time()
+        with self._lock:
+            for service_id, entry in list(self._tokens.items()):
+                if entry[0] <= now:
+                    del self._tokens[service_id]
+            return list(self._tokens.keys())
+
+
+token_store = TokenStore()
+
+
+def remember_token(config, instance, custom_headers):
+    if "access-token" in custom_headers.keys():
+        token_store.set(instance.id, custom_headers, poller_config(config)["token_ttl"])
+
+
+def next_poll_interval(config, unicore_status):
+    pconfig = poller_config(config)
+    if unicore_status in TERMINAL_STATES:
+        return None
+    if unicore_status == "RUNNING":
+        return pconfig["interval_running"]
+    return pconfig["interval_starting"]
+
+
+def save_snapshot(config, instance, status):
+    unicore_status = status.get("status", "")
+    interval = next_poll_interval(config, unicore_status)
+    now = timezone.now()
+    StatusSnapshotModel.objects.update_or_create(
+        service=instance,
+        defaults={
+            "status": status,
+            "unicore_status": unicore_status,
+            "updated": now,
+            "next_poll": now + timedelta(seconds=interval) if interval else None,
+            "terminal": interval is None,
+        },
+    )
+
+
+def create_snapshot(config, instance):
+    # New services are polled soon, their status is not known yet
+    interval = poller_config(config)["interval_starting"]
+    StatusSnapshotModel.objects.get_or_create(
+        service=instance,
+        defaults={"next_poll": timezone.now() + timedelta(seconds=interval)},
+    )
+
+
+def store_status(config, instance, status):
+    pconfig = poller_config(config)
+    if (
+        pconfig["enabled"]
+        or pconfig["max_age"] > 0
+        or status.get("status", "") in TERMINAL_STATES
+    ):
+        save_snapshot(config, instance, status)
+
+
+def fresh_snapshot(config, instance):
+    # Returns the stored status, if it's final or recent enough
+    max_age = poller_config(config)["max_age"]
+    min_updated = timezone.now() - timedelta(seconds=max_age)
+    if ServicesModel.status_snapshot.is_cached(instance):
+        # Loaded with select_related, e.g. by the batch status
+        try:
+            snapshot = instance.status_snapshot
+        except StatusSnapshotModel.DoesNotExist:
+            return None
+        if not snapshot.terminal and (
+            max_age <= 0 or snapshot.updated is None or snapshot.updated < min_updated
+        ):
+            return None
+    else:
+        usable = Q(terminal=True)
+        if max_age > 0:
+            usable |= Q(updated__gte=min_updated)
+        snapshot = (
+            StatusSnapshotModel.objects.filter(service=instance)
+            .filter(usable)
+            .only("status")
+            .first()
+        )
+    if snapshot is None:
+        return None
+    return copy.deepcopy(snapshot.status)
+
+
+class StatusPoller:
+    def __init__(self, owner=None):
+        if owner is None:
+            owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.owner = owner
+
+    def _lease_free(self, now):
+        return (
+            Q(lease_until__isnull=True)
+            | Q(lease_until__lt=now)
+            | Q(lease_owner=self.owner)
+        )
+
+    def claim(self, snapshot_id, lease):
+        now = timezone.now()
+        updated = (
+            StatusSnapshotModel.objects.filter(id=snapshot_id)
+            .filter(self._lease_free(now))
+            .update(lease_owner=self.owner, lease_until=now + timedelta(seconds=lease))
+        )
+        return updated == 1
+
+    def poll(self, config, instance, custom_headers):
+        logs_extra = instance_dict_and_custom_headers_to_logs_extra(
+            instance.__dict__, custom_headers
+        )
+        logs_extra["status_poller"] = self.owner
+        try:
+            status = status_service(instance.__dict__, custom_headers, logs_extra)
+        except MgrException:
+            log.warning("Status poll failed", extra=logs_extra, exc_info=True)
+            interval = poller_config(config)["interval_error"]
+            StatusSnapshotModel.objects.filter(service=instance).update(
+                next_poll=timezone.now() + timedelta(seconds=interval)
+            )
+            return False
+        save_snapshot(config, instance, status)
+        return True
+
+    def run_once(self):
+        config = _config()
+        pconfig = poller_config(config)
+        if not pconfig["enabled"]:
+            return 0
+        # Only services this worker has a token for. The others would stay
+        # due and fill every batch, other workers may have their tokens.
+        service_ids = token_store.service_ids()
+        if not service_ids:
+            return 0
+        now = timezone.now()
+        candidates = (
+            StatusSnapshotModel.objects.filter(
+                terminal=False,
+                next_poll__lte=now,
+                service__stop_pending=False,
+                service_id__in=service_ids,
+            )
+            .filter(self._lease_free(now))
+            .select_related("service")
+            .order_by("next_poll")[: pconfig["batch_size"]]
+        )
+        polled = 0
+        for snapshot in candidates:
+            custom_headers = token_store.get(snapshot.service_id)
+            if custom_headers is None:
+                # Expired since service_ids()
+                continue
+            if not self.claim(snapshot.id, pconfig["lease"]):
+                continue
+            if self.poll(config, snapshot.service, custom_headers):
+                polled += 1
+        return polled
+
+    def run_forever(self, stop_event):
+        log.info(
+            f"Status poller started - {self.owner}",
+            extra={"uuidcode": "StatusPoller"},
+        )
+        while not stop_event.is_set():
+            tick = 5
+            try:
+                with pinned_config() as config:
+                    tick = poller_config(config)["tick"]
+                    self.run_once()
+            except Exception:
+                log.exception(
+                    "Status poller failed", extra={"uuidcode": "StatusPoller"}
+                )
+            finally:
+                close_old_connections()
+            stop_event.wait(tick)
+
+
+def start_poller_thread():
+    stop_event = threading.Event()
+    thread = threading.Thread(
+        target=StatusPoller().run_forever,
+        args=(stop_event,),
+        name="status-poller",
+        daemon=True,
+    )
+    thread.start()
+    return thread, stop_event
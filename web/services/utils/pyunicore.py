@@ -1,21 +1,55 @@
 import base64
+import contextlib
+import contextvars
 import copy
 import html
 import json
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pyunicore.client as pyunicore
+import requests
+from pyunicore.credentials import AuthenticationFailedException
 from jupyterjsc_unicoremgr.settings import LOGGER_NAME
 from services.utils import get_download_delete
 from services.utils import get_error_message
 from services.utils import MgrException
+from services.utils.breaker import breaker_config
+from services.utils.breaker import CircuitOpen
+from services.utils.breaker import CircuitBreakers
+from services.utils.cache import copy_json
+from services.utils.cache import directory_signature
+from services.utils.cache import file_signature
+from services.utils.cache import FileCache
+from services.utils.cache import InputDirectory
+from services.utils.config import get_input_files_config
+from services.utils.config import get_system_config
+from services.utils.deadline import deadline_config
+from services.utils.deadline import tictoc_extra
+from services.utils.deadline import with_deadline
+from services.utils.download import download_files
+from services.utils.placeholders import Placeholders
+from services.utils.sites import get_site_client
+from services.utils.sites import SiteCache
+from services.utils.tail import decode_tail
+from services.utils.tail import keep_tail
+from services.utils.tail import last_lines
+from services.utils.tail import REJECTED_STATUS_CODES
+from services.utils.tail import tail_headers
+from services.utils.tail import tail_stats
+from services.utils.transports import SessionTransport
+from services.utils.transports import ssl_contexts
+from services.utils.transports import token_expiry
+from services.utils.transports import token_hash
+from services.utils.transports import TransportPool
 
 log = logging.getLogger(LOGGER_NAME)
 assert log.__class__.__name__ == "ExtraLoggerClass"
 
 
+@with_deadline("start")
 def start_service(
     config, initial_data, instance_dict, custom_headers, jhub_credential, logs_extra
 ):
@@ -38,7 +72,7 @@ def start_service(
             raise tice
         finally:
             toc = time.time() - tic
-            extra_tic = {"tictoc": "client.new_job", "duration": toc}
+            extra_tic = tictoc_extra("client.new_job", toc)
             extra_tic.update(logs_extra)
             log.debug(
                 "UNICORE communication",
@@ -62,7 +96,7 @@ def start_service(
                     raise tice
                 finally:
                     toc = time.time() - tic
-                    extra_tic = {"tictoc": "job.abort", "duration": toc}
+                    extra_tic = tictoc_extra("job.abort", toc)
                     extra_tic.update(logs_extra)
                     log.debug(
                         "UNICORE communication",
@@ -76,6 +110,11 @@ def start_service(
             )
         if e.__class__.__name__ == "MgrException":
             e_args = e.args
+        elif isinstance(e, CircuitOpen):
+            # The circuit opened while the job was started
+            e_args = (_circuit_open_message(config, logs_extra), str(e))
+        elif isinstance(e, AuthenticationFailedException):
+            e_args = (_authentication_failed_message(config, logs_extra), str(e))
         else:
             user_error_msg = get_error_message(
                 config,
@@ -87,253 +126,102 @@ def start_service(
         raise MgrException(*e_args)
 
 
+def _load_template(template_path):
+    with open(template_path, "r") as f:
+        return json.load(f)
+
+
+# Parsed job description templates, shared by all starts in this process
+template_cache = FileCache(
+    _load_template, maxsize=int(os.environ.get("JOB_DESCRIPTION_CACHE_SIZE", 256))
+)
+
+
+# Listing and contents of the input directories
+input_dir_cache = FileCache(
+    InputDirectory,
+    signature=directory_signature,
+    maxsize=int(os.environ.get("JOB_DESCRIPTION_CACHE_SIZE", 256)),
+)
+
+
 def _jd_template(config, jhub_credential, initial_data):
     jhub_credential_mapped = config.get("credential_mapping", {}).get(
         jhub_credential, jhub_credential
     )
-    mapped_system = (
-        config.get("systems", {})
-        .get("mapping", {})
-        .get("system", {})
-        .get(
-            initial_data["user_options"]["system"],
-            initial_data["user_options"]["system"],
-        )
-    )
-    base_dir = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("base_directory", "/mnt/config/job_descriptions")
-    )
-    template_filename = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("template_filename", "job_description.json.template")
-    )
+    system_config = get_system_config(config, initial_data["user_options"]["system"])
+    jd_config = system_config.job_description
     template_path = os.path.join(
-        base_dir,
+        jd_config.base_directory,
         jhub_credential_mapped,
         initial_data["user_options"]["service"],
-        mapped_system,
-        template_filename,
+        system_config.mapped_system,
+        jd_config.template_filename,
     )
-    with open(template_path, "r") as f:
-        template = json.load(f)
-    return template
+    # Callers modify the template, so never hand out the cached object
+    return copy_json(template_cache.get(template_path))
 
 
 def _jd_add_initial_data_env(config, initial_data, jd, logs_extra):
-    mapped_system = (
-        config.get("systems", {})
-        .get("mapping", {})
-        .get("system", {})
-        .get(
-            initial_data["user_options"]["system"],
-            initial_data["user_options"]["system"],
-        )
-    )
-    environment_key = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("unicore_keywords", {})
-        .get("environment_key", "Environment")
-    )
-    skip_environments = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("unicore_keywords", {})
-        .get("skip_environments", ["JUPYTERHUB_API_TOKEN", "JPY_API_TOKEN"])
-    )
+    jd_config = get_system_config(
+        config, initial_data["user_options"]["system"]
+    ).job_description
+    environment_key = jd_config.environment_key
     if environment_key not in jd:
         jd[environment_key] = {}
     for key, value in initial_data["env"].items():
-        if key not in skip_environments:
+        if key not in jd_config.skip_environments:
             jd[environment_key][key] = str(value)
     if "certs" in initial_data.keys():
-        certs_keyfile_name = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("certs", {})
-            .get("keyfile_name", "service_cert.key")
+        jd[environment_key]["JUPYTERHUB_SSL_KEYFILE_DATA"] = str(
+            jd_config.certs_keyfile_name
         )
-        certs_certfile_name = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("certs", {})
-            .get("keyfile_name", "service_cert.crt")
+        jd[environment_key]["JUPYTERHUB_SSL_CERTFILE_DATA"] = str(
+            jd_config.certs_certfile_name
         )
-        certs_cafile_name = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("certs", {})
-            .get("keyfile_name", "service_ca.crt")
+        jd[environment_key]["JUPYTERHUB_SSL_CLIENT_CA_DATA"] = str(
+            jd_config.certs_cafile_name
         )
-        jd[environment_key]["JUPYTERHUB_SSL_KEYFILE_DATA"] = str(certs_keyfile_name)
-        jd[environment_key]["JUPYTERHUB_SSL_CERTFILE_DATA"] = str(certs_certfile_name)
-        jd[environment_key]["JUPYTERHUB_SSL_CLIENT_CA_DATA"] = str(certs_cafile_name)
 
     return jd
 
 
 def _jd_replace(config, initial_data, jd):
-    jd_as_string = json.dumps(jd)
-    mapped_system = (
-        config.get("systems", {})
-        .get("mapping", {})
-        .get("system", {})
-        .get(
-            initial_data["user_options"]["system"],
-            initial_data["user_options"]["system"],
-        )
-    )
-    replace_indicators = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("replace_indicators", ["<", ">"])
-    )
-    for key, value in initial_data.get("user_options", {}).items():
-        if type(value) == str:
-            jd_as_string = jd_as_string.replace(
-                f"{replace_indicators[0]}{key}{replace_indicators[1]}", value
-            )
-    for key, value in initial_data.get("env", {}).items():
-        if type(value) == str:
-            jd_as_string = jd_as_string.replace(
-                f"{replace_indicators[0]}{key}{replace_indicators[1]}", value
-            )
-    return json.loads(jd_as_string)
+    replace_indicators = get_system_config(
+        config, initial_data["user_options"]["system"]
+    ).job_description.replace_indicators
+    placeholders = Placeholders(replace_indicators, _jd_replace_pairs(initial_data))
+    return placeholders.render_json(jd, cache_tokens=True)
 
 
-def _jd_insert_job_type(config, initial_data, jd):
-    mapped_system = (
-        config.get("systems", {})
-        .get("mapping", {})
-        .get("system", {})
-        .get(
-            initial_data["user_options"]["system"],
-            initial_data["user_options"]["system"],
-        )
-    )
-    job_type_key = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("unicore_keywords", {})
-        .get("type_key", "Job type")
-    )
-    if initial_data["user_options"]["partition"] in (
-        config.get("systems", {})
-        .get(initial_data["user_options"]["system"], {})
-        .get("interactive_partitions", {})
-        .keys()
-    ):
-        job_type_value = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("unicore_keywords", {})
-            .get("interactive", {})
-            .get("type_value", "interactive")
-        )
-        interactive_node_key = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("unicore_keywords", {})
-            .get("interactive", {})
-            .get("node_key", "Login node")
-        )
-        interactive_node_value = (
-            config.get("systems", {})
-            .get(initial_data["user_options"]["system"], {})
-            .get("interactive_partitions", {})
-            .get(
-                initial_data["user_options"]["partition"],
-                initial_data["user_options"]["partition"],
-            )
-        )
-        jd[job_type_key] = job_type_value
-        jd[interactive_node_key] = interactive_node_value
+def _jd_insert_job_type_static(jd_config, interactive, jd):
+    # Only depends on the configuration, part of the job description skeleton
+    if interactive:
+        jd[jd_config.type_key] = jd_config.interactive_type_value
     else:
-        normal_value = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("unicore_keywords", {})
-            .get("normal", {})
-            .get("type_value", "normal")
-        )
-        jd[job_type_key] = normal_value
-        resources_key = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("unicore_keywords", {})
-            .get("normal", {})
-            .get("resources_key", "Resources")
-        )
-        queue_key = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("unicore_keywords", {})
-            .get("normal", {})
-            .get("queue_key", "Queue")
-        )
-        set_queue = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("unicore_keywords", {})
-            .get("normal", {})
-            .get("set_queue", True)
-        )
-        if resources_key not in jd:
-            jd[resources_key] = {}
-        if set_queue:
-            jd[resources_key][queue_key] = initial_data["user_options"]["partition"]
-        for key, new_key in (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("resource_mapping", {})
-            .items()
-        ):
+        jd[jd_config.type_key] = jd_config.normal_type_value
+        if jd_config.resources_key not in jd:
+            jd[jd_config.resources_key] = {}
+    return jd
+
+
+def _jd_insert_job_type_user_options(config, initial_data, jd):
+    system_config = get_system_config(config, initial_data["user_options"]["system"])
+    jd_config = system_config.job_description
+    partition = initial_data["user_options"]["partition"]
+    if partition in system_config.interactive_partitions.keys():
+        jd[jd_config.interactive_node_key] = system_config.interactive_partitions[
+            partition
+        ]
+    else:
+        resources_key = jd_config.resources_key
+        if jd_config.set_queue:
+            jd[resources_key][jd_config.queue_key] = partition
+        for key, new_key in jd_config.resource_mapping.items():
             if key in initial_data["user_options"].keys():
                 jd[resources_key][new_key] = initial_data["user_options"][key]
         # Add reservation if any given
-        user_options_reservation_key = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("normal", {})
-            .get("user_options_reservation_key", "reservation")
-        )
+        user_options_reservation_key = jd_config.user_options_reservation_key
         if user_options_reservation_key in initial_data[
             "user_options"
         ].keys() and initial_data["user_options"][
@@ -342,390 +230,139 @@ def _jd_insert_job_type(config, initial_data, jd):
             "",
             "none",
         ]:
-            reservation_key = (
-                config.get("systems", {})
-                .get(mapped_system, {})
-                .get("pyunicore", {})
-                .get("job_description", {})
-                .get("normal", {})
-                .get("reservation_key", "Reservation")
-            )
-            jd[resources_key][reservation_key] = initial_data["user_options"][
+            jd[resources_key][jd_config.reservation_key] = initial_data["user_options"][
                 user_options_reservation_key
             ]
     return jd
 
 
-def _jd_add_input_files(config, jhub_credential, initial_data, jd, logs_extra={}):
+def _jd_insert_job_type(config, initial_data, jd):
+    system_config = get_system_config(config, initial_data["user_options"]["system"])
+    interactive = (
+        initial_data["user_options"]["partition"]
+        in system_config.interactive_partitions.keys()
+    )
+    jd = _jd_insert_job_type_static(system_config.job_description, interactive, jd)
+    return _jd_insert_job_type_user_options(config, initial_data, jd)
+
+
+def _jd_replace_pairs(initial_data):
+    # Values from user_options and env, in the order they are replaced
+    pairs = []
+    for key, value in initial_data.get("user_options", {}).items():
+        if type(value) == str:
+            pairs.append((key, value))
+    for key, value in initial_data.get("env", {}).items():
+        if type(value) == str:
+            pairs.append((key, value))
+    return pairs
+
+
+def _jd_hook_pairs(config, initial_data, logs_extra):
+    pairs = []
+    # Hooks can be used to change file for specific user_options
+    # Example:
+    # "hooks": {
+    #   "load_project_specific_kernel": {
+    #       "project": ["hai_ds_isa", "training2223"]
+    #   }
+    # },
+    #
+    # This will replace <hook_load_project_specific_kernel> in all files with 1
+    # if initial_data["user_options"]["project"] is in ["hai_ds_isa", "training2223"].
+    # For all other projects it's replaced with 0
+    #
+    # You can combine multiple user_options. They are connected with an AND operator, so
+    # the user_options must be part of all configured lists.
+    #
+    # The hooks are compiled with the configuration, each one is a few set lookups.
+    system_config = get_system_config(config, initial_data["user_options"]["system"])
+    user_options = initial_data["user_options"]
+    trace = log.isEnabledFor(5)
+    for hook in system_config.hooks.values():
+        replace_string = "1" if hook.evaluate(user_options) else "0"
+        if trace:
+            log.trace(
+                f"Job Description: hook {hook.name} replace with: {replace_string}",
+                extra=logs_extra,
+            )
+        pairs.append((f"hook_{hook.name}", replace_string))
+    return pairs
+
+
+def _jd_input_dir(config, jhub_credential, initial_data):
     jhub_credential_mapped = config.get("credential_mapping", {}).get(
         jhub_credential, jhub_credential
     )
-    mapped_system = (
-        config.get("systems", {})
-        .get("mapping", {})
-        .get("system", {})
-        .get(
-            initial_data["user_options"]["system"],
-            initial_data["user_options"]["system"],
-        )
-    )
-    base_dir = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("base_directory", "/mnt/config/job_descriptions")
-    )
-    input_dir_name = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("input", {})
-        .get("directory_name", "input")
-    )
-    input_dir = os.path.join(
-        base_dir,
+    system_config = get_system_config(config, initial_data["user_options"]["system"])
+    jd_config = system_config.job_description
+    return os.path.join(
+        jd_config.base_directory,
         jhub_credential_mapped,
         initial_data["user_options"]["service"],
-        mapped_system,
-        input_dir_name,
-    )
-    skip_prefixs = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("input", {})
-        .get("skip_prefixs", ["skip_"])
-    )
-    skip_suffixs = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("input", {})
-        .get("skip_suffixs", [".swp"])
+        system_config.mapped_system,
+        jd_config.input_directory_name,
     )
+
+
+def _jd_input_files(config, jhub_credential, initial_data):
+    # (new name, unrendered content) of all files that are not skipped
     system = initial_data["user_options"]["system"]
     stage = os.environ.get("STAGE", "").lower()
-
-    # We will skip files that are not meant for specific configurations
-    if stage:
-        stages_to_skip = [
-            f"{x}_"
-            for x in config.get("systems", {})
-            .get("mapping", {})
-            .get("skip", {})
-            .get("stage", [])
-            if x != stage
-        ]
-        skip_prefixs.extend(stages_to_skip)
-
-        # Same stage but different credential
-        stages_credential_to_skip = [
-            f"{stage}_{x}_"
-            for x in config.get("systems", {})
-            .get("mapping", {})
-            .get("skip", {})
-            .get("credential", [])
-            if x != jhub_credential
-        ]
-        skip_prefixs.extend(stages_credential_to_skip)
-
-        # Same stage but different system
-        stages_system_to_skip = [
-            f"{stage}_{x}_"
-            for x in config.get("systems", {})
-            .get("mapping", {})
-            .get("skip", {})
-            .get("system", [])
-            if x != system
-        ]
-        skip_prefixs.extend(stages_system_to_skip)
-
-        # Same stage and credential but different system
-        stages_credential_system_to_skip = [
-            f"{stage}_{x}_{system}_"
-            for x in config.get("systems", {})
-            .get("mapping", {})
-            .get("skip", {})
-            .get("credential", [])
-            if x != jhub_credential
-        ]
-        skip_prefixs.extend(stages_credential_system_to_skip)
-
-    # Same credential but different system
-    credential_system_to_skip = [
-        f"{jhub_credential}_{x}_"
-        for x in config.get("systems", {})
-        .get("mapping", {})
-        .get("skip", {})
-        .get("system", [])
-        if x != system
-    ]
-    skip_prefixs.extend(credential_system_to_skip)
-
-    credential_to_skip = [
-        f"{x}_"
-        for x in config.get("systems", {})
-        .get("mapping", {})
-        .get("skip", {})
-        .get("credential", [])
-        if x != jhub_credential
-    ]
-    skip_prefixs.extend(credential_to_skip)
-
-    system_to_skip = [
-        f"{x}_"
-        for x in config.get("systems", {})
-        .get("mapping", {})
-        .get("skip", {})
-        .get("system", [])
-        if x != system
-    ]
-    skip_prefixs.extend(system_to_skip)
-    replace_indicators = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("replace_indicators", ["<", ">"])
+    # Skip and replace rules are precomputed for each credential and system
+    input_files_config = get_input_files_config(config, stage, jhub_credential, system)
+    input_directory = input_dir_cache.get(
+        _jd_input_dir(config, jhub_credential, initial_data)
     )
-    imports_from_value = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("job_description", {})
-        .get("unicore_keywords", {})
-        .get("imports_from_value", "inline://dummy")
+    return tuple(
+        (input_files_config.rename(filename), input_directory.read(filename))
+        for filename in input_directory.filenames
+        if not input_files_config.skip(filename)
     )
-    input_files = os.listdir(input_dir)
-    imports = []
-    for filename in input_files:
-        skip = False
-        for prefix in skip_prefixs:
-            if filename.startswith(prefix):
-                skip = True
-                break
-        if skip:
-            continue
-        for suffix in skip_suffixs:
-            if filename.endswith(suffix):
-                skip = True
-                break
-        if skip:
-            continue
 
-        newname = filename
-        if filename.startswith(f"{stage}_{jhub_credential}_{system}_"):
-            newname = filename[
-                len(stage) + 1 + len(jhub_credential) + 1 + len(system) + 1 :
-            ]
-        elif filename.startswith(f"{stage}_{jhub_credential}_"):
-            newname = filename[len(stage) + 1 + len(jhub_credential) + 1 :]
-        elif filename.startswith(f"{stage}_{system}_"):
-            newname = filename[len(stage) + 1 + len(system) + 1 :]
-        elif filename.startswith(f"{jhub_credential}_{system}_"):
-            newname = filename[len(jhub_credential) + 1 + len(system) + 1 :]
-        elif filename.startswith(f"{stage}_"):
-            newname = filename[len(stage) + 1 :]
-        elif filename.startswith(f"{jhub_credential}_"):
-            newname = filename[len(jhub_credential) + 1 :]
-        elif filename.startswith(f"{system}_"):
-            newname = filename[len(system) + 1 :]
-        with open(os.path.join(input_dir, filename), "r") as f:
-            file_data = f.read()
-        for key, value in initial_data.get("user_options", {}).items():
-            if type(value) == str:
-                file_data = file_data.replace(
-                    f"{replace_indicators[0]}{key}{replace_indicators[1]}", value
-                )
-        for key, value in initial_data.get("env", {}).items():
-            if type(value) == str:
-                file_data = file_data.replace(
-                    f"{replace_indicators[0]}{key}{replace_indicators[1]}", value
-                )
-        # We will replace keywords with configured values.
-        # We start with the most specific replacements and follow up with the least specific ones
-        if stage:
-            # Replace values specified for stage+credential+system
-            for key, value in (
-                config.get("systems", {})
-                .get("mapping", {})
-                .get("replace", {})
-                .get("stage_credential_system", {})
-                .get(stage, {})
-                .get(jhub_credential, {})
-                .get(initial_data["user_options"]["system"], {})
-                .items()
-            ):
-                file_data = file_data.replace(
-                    f"{replace_indicators[0]}{key}{replace_indicators[1]}",
-                    value,
-                )
-
-            # Replace values specified for stage+credential
-            for key, value in (
-                config.get("systems", {})
-                .get("mapping", {})
-                .get("replace", {})
-                .get("stage_credential", {})
-                .get(stage, {})
-                .get(jhub_credential, {})
-                .items()
-            ):
-                file_data = file_data.replace(
-                    f"{replace_indicators[0]}{key}{replace_indicators[1]}",
-                    value,
-                )
-
-            # Replace values specified for stage+system
-            for key, value in (
-                config.get("systems", {})
-                .get("mapping", {})
-                .get("replace", {})
-                .get("stage_system", {})
-                .get(stage, {})
-                .get(initial_data["user_options"]["system"], {})
-                .items()
-            ):
-                file_data = file_data.replace(
-                    f"{replace_indicators[0]}{key}{replace_indicators[1]}",
-                    value,
-                )
-
-            # Replace values specified for stage
-            for key, value in (
-                config.get("systems", {})
-                .get("mapping", {})
-                .get("replace", {})
-                .get("stage", {})
-                .get(stage, {})
-                .items()
-            ):
-                file_data = file_data.replace(
-                    f"{replace_indicators[0]}{key}{replace_indicators[1]}",
-                    value,
-                )
-
-        # Replace values specified for credential+system
-        for key, value in (
-            config.get("systems", {})
-            .get("mapping", {})
-            .get("replace", {})
-            .get("credential_system", {})
-            .get(jhub_credential, {})
-            .get(initial_data["user_options"]["system"], {})
-            .items()
-        ):
-            file_data = file_data.replace(
-                f"{replace_indicators[0]}{key}{replace_indicators[1]}",
-                value,
-            )
-
-        # Replace values specified for credential
-        for key, value in (
-            config.get("systems", {})
-            .get("mapping", {})
-            .get("replace", {})
-            .get("credential", {})
-            .get(jhub_credential, {})
-            .items()
-        ):
-            file_data = file_data.replace(
-                f"{replace_indicators[0]}{key}{replace_indicators[1]}",
-                value,
-            )
 
-        # Replace values specified for system
-        for key, value in (
-            config.get("systems", {})
-            .get("mapping", {})
-            .get("replace", {})
-            .get("system", {})
-            .get(initial_data["user_options"]["system"], {})
-            .items()
-        ):
-            file_data = file_data.replace(
-                f"{replace_indicators[0]}{key}{replace_indicators[1]}",
-                value,
-            )
-
-        # Hooks can be used to change file for specific user_options
-        # Example:
-        # "hooks": {
-        #   "load_project_specific_kernel": {
-        #       "project": ["hai_ds_isa", "training2223"]
-        #   }
-        # },
-        #
-        # This will replace <hook_load_project_specific_kernel> in all files with 1
-        # if initial_data["user_options"]["project"] is in ["hai_ds_isa", "training2223"].
-        # For all other projects it's replaced with 0
-        #
-        # You can combine multiple user_options. They are connected with an AND operator, so
-        # the user_options must be part of all configured lists.
-        for hook_name, hook_infos in (
-            config.get("systems", {})
-            .get(initial_data["user_options"]["system"], {})
-            .get("hooks", {})
-            .items()
-        ):
-            log.trace(f"Job Description: check hook {hook_name}", extra=logs_extra)
-            replace_string = "1"
-            for user_options_key, user_options_values in hook_infos.items():
-                log.trace(
-                    f"Job Description - {hook_name} - {user_options_key}",
-                    extra=logs_extra,
-                )
-                key_is_in = (
-                    initial_data["user_options"].get(user_options_key, "")
-                    in user_options_values
-                )
-                log.trace(
-                    f"Job Description - {hook_name} - {initial_data['user_options'].get(user_options_key, '')} in {user_options_values} : {key_is_in}",
-                    extra=logs_extra,
-                )
-                if not key_is_in:
-                    replace_string = "0"
-                    break
-            log.trace(
-                f"Job Description: hook {hook_name} replace with: {replace_string}",
-                extra=logs_extra,
-            )
-            file_data = file_data.replace(
-                f"{replace_indicators[0]}hook_{hook_name}{replace_indicators[1]}",
-                replace_string,
-            )
+def _jd_add_input_files(
+    config,
+    jhub_credential,
+    initial_data,
+    jd,
+    logs_extra={},
+    input_files=None,
+    rendered_files=None,
+):
+    system = initial_data["user_options"]["system"]
+    stage = os.environ.get("STAGE", "").lower()
+    jd_config = get_system_config(config, system).job_description
+    input_files_config = get_input_files_config(config, stage, jhub_credential, system)
+    if input_files is None:
+        input_files = _jd_input_files(config, jhub_credential, initial_data)
+    replace_indicators = jd_config.replace_indicators
+    imports_from_value = jd_config.imports_from_value
+    replace_pairs = _jd_replace_pairs(initial_data)
+    placeholders = Placeholders(
+        replace_indicators,
+        replace_pairs
+        + list(input_files_config.replace_pairs)
+        + _jd_hook_pairs(config, initial_data, logs_extra),
+    )
+    if (
+        rendered_files is not None
+        and placeholders.single_pass
+        and not any(key in input_files_config.replacements for key, _ in replace_pairs)
+    ):
+        # The configured replacements are already applied. Only a value from
+        # user_options or env with the same key would have come first.
+        input_files = rendered_files
+    imports = []
+    for newname, data in input_files:
+        file_data = placeholders.render(data, cache_tokens=True)
         imports.append(
             {"From": imports_from_value, "To": newname, "Data": file_data.strip()}
         )
     if "certs" in initial_data.keys():
-        certs_keyfile_name = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("certs", {})
-            .get("keyfile_name", "service_cert.key")
-        )
-        certs_certfile_name = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("certs", {})
-            .get("keyfile_name", "service_cert.crt")
-        )
-        certs_cafile_name = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("certs", {})
-            .get("keyfile_name", "service_ca.crt")
-        )
+        certs_keyfile_name = jd_config.certs_keyfile_name
+        certs_certfile_name = jd_config.certs_certfile_name
+        certs_cafile_name = jd_config.certs_cafile_name
         imports.append(
             {
                 "From": imports_from_value,
@@ -757,29 +394,193 @@ def _jd_add_input_files(config, jhub_credential, initial_data, jd, logs_extra={}
                 }
             )
     if imports:
-        imports_key = (
-            config.get("systems", {})
-            .get(mapped_system, {})
-            .get("pyunicore", {})
-            .get("job_description", {})
-            .get("unicore_keywords", {})
-            .get("imports_key", "Imports")
-        )
-        jd[imports_key] = imports
+        jd[jd_config.imports_key] = imports
     return jd
 
 
+class JobDescriptionSkeleton:
+    """
+    Everything of a job description that only depends on the configuration
+    and the files on disk: the template with the job type keys and the
+    input files that are not skipped. Starts copy the skeleton and apply
+    the user specific values (env, user_options, certs, input_files).
+
+    rendered_files are the input files with the configured replacements
+    (input.replace) applied, None if there are none or if applying them
+    first could change the result. The hooks depend on user_options and
+    are applied per start.
+    """
+
+    def __init__(self, template, input_files, rendered_files=None):
+        self.template = template
+        self.input_files = input_files
+        self.rendered_files = rendered_files
+
+
+def _jd_prerender_input_files(jd_config, input_files_config, input_files):
+    # The replacements come after the ones of user_options and env. Applied
+    # first, they must neither create nor break placeholders, otherwise a
+    # user value could fill them.
+    placeholders = Placeholders(
+        jd_config.replace_indicators, input_files_config.replace_pairs
+    )
+    indicator_chars = set(placeholders.start + placeholders.end)
+    if (
+        not placeholders.table
+        or not placeholders.single_pass
+        or any(indicator_chars.intersection(value) for _, value in placeholders.pairs)
+    ):
+        return None
+    rendered_files = []
+    for newname, data in input_files:
+        rendered = placeholders.render(data)
+        keys = [key for key in placeholders.keys(data) if key not in placeholders.table]
+        if placeholders.keys(rendered) != keys:
+            return None
+        rendered_files.append((newname, rendered))
+    return tuple(rendered_files)
+
+
+def _jd_skeleton_signature(key):
+    template_path, input_dir = key[-2:]
+    return (file_signature(template_path), directory_signature(input_dir))
+
+
+def _load_jd_skeleton(key, config):
+    _, stage, jhub_credential, service, system, interactive, _, _ = key
+    initial_data = {"user_options": {"system": system, "service": service}}
+    jd_config = get_system_config(config, system).job_description
+    template = _jd_template(config, jhub_credential, initial_data)
+    template = _jd_insert_job_type_static(jd_config, interactive, template)
+    input_files = _jd_input_files(config, jhub_credential, initial_data)
+    rendered_files = _jd_prerender_input_files(
+        jd_config,
+        get_input_files_config(config, stage, jhub_credential, system),
+        input_files,
+    )
+    return JobDescriptionSkeleton(template, input_files, rendered_files)
+
+
+# Job description skeletons, one per configuration version, credential,
+# service, system and job type
+skeleton_cache = FileCache(
+    _load_jd_skeleton,
+    signature=_jd_skeleton_signature,
+    maxsize=int(os.environ.get("JOB_DESCRIPTION_CACHE_SIZE", 256)),
+)
+
+
+def _jd_skeleton_for(config, jhub_credential, service, system, interactive):
+    initial_data = {"user_options": {"system": system, "service": service}}
+    jd_config = get_system_config(config, system).job_description
+    jhub_credential_mapped = config.get("credential_mapping", {}).get(
+        jhub_credential, jhub_credential
+    )
+    template_path = os.path.join(
+        jd_config.base_directory,
+        jhub_credential_mapped,
+        service,
+        get_system_config(config, system).mapped_system,
+        jd_config.template_filename,
+    )
+    key = (
+        config.version,
+        os.environ.get("STAGE", "").lower(),
+        jhub_credential,
+        service,
+        system,
+        interactive,
+        template_path,
+        _jd_input_dir(config, jhub_credential, initial_data),
+    )
+    return skeleton_cache.get(key, config)
+
+
+def _jd_skeleton(config, jhub_credential, initial_data):
+    system = initial_data["user_options"]["system"]
+    interactive = (
+        initial_data["user_options"]["partition"]
+        in get_system_config(config, system).interactive_partitions.keys()
+    )
+    return _jd_skeleton_for(
+        config,
+        jhub_credential,
+        initial_data["user_options"]["service"],
+        system,
+        interactive,
+    )
+
+
+def warm_job_descriptions(config):
+    # Build the skeletons for all credentials, services and systems found
+    # below the job description base directories
+    maxsize = skeleton_cache.stats()["maxsize"]
+    credential_mapping = config.get("credential_mapping", {})
+    count = 0
+    for system, system_config in config.systems.items():
+        base_directory = system_config.job_description.base_directory
+        if not os.path.isdir(base_directory):
+            continue
+        credentials = set(credential_mapping.keys()).union(os.listdir(base_directory))
+        for credential in sorted(credentials):
+            credential_dir = os.path.join(
+                base_directory, credential_mapping.get(credential, credential)
+            )
+            if not os.path.isdir(credential_dir):
+                continue
+            # Services may be nested, like "JupyterLab/simple"
+            services = sorted(
+                os.path.relpath(os.path.dirname(dirpath), credential_dir)
+                for dirpath, _, filenames in os.walk(credential_dir)
+                if os.path.basename(dirpath) == system_config.mapped_system
+                and system_config.job_description.template_filename in filenames
+            )
+            for service in services:
+                job_types = [False]
+                if system_config.interactive_partitions:
+                    job_types.append(True)
+                for interactive in job_types:
+                    if count >= maxsize:
+                        return count
+                    try:
+                        _jd_skeleton_for(
+                            config, credential, service, system, interactive
+                        )
+                        count += 1
+                    except (OSError, ValueError):
+                        log.debug(
+                            f"Could not prepare job description - {credential} - {service} - {system}",
+                            extra={"uuidcode": "StartUp"},
+                            exc_info=True,
+                        )
+    return count
+
+
 def _get_job_description(config, jhub_credential, initial_data, logs_extra):
     log.trace("Create job_description", extra=logs_extra)
-    jd = _jd_template(config, jhub_credential, initial_data)
+    skeleton = _jd_skeleton(config, jhub_credential, initial_data)
+    jd = copy_json(skeleton.template)
     jd = _jd_add_initial_data_env(config, initial_data, jd, logs_extra)
     jd = _jd_replace(config, initial_data, jd)
-    jd = _jd_insert_job_type(config, initial_data, jd)
+    jd = _jd_insert_job_type_user_options(config, initial_data, jd)
     jd = _jd_add_input_files(
-        config, jhub_credential, initial_data, jd, logs_extra=logs_extra
+        config,
+        jhub_credential,
+        initial_data,
+        jd,
+        logs_extra=logs_extra,
+        input_files=skeleton.input_files,
+        rendered_files=skeleton.rendered_files,
     )
     jd_logs_extra = copy.deepcopy(logs_extra)
-    jd_logs_extra.update({"jobs_description": jd})
+    jd_logs_extra.update(
+        {
+            "jobs_description": jd,
+            "template_cache": template_cache.stats(),
+            "input_dir_cache": input_dir_cache.stats(),
+            "skeleton_cache": skeleton_cache.stats(),
+        }
+    )
     log.trace("Create job description... done", extra=jd_logs_extra)
     return jd
 
@@ -794,7 +595,7 @@ def _get_job(config, instance_dict, custom_headers, logs_extra):
         raise tice
     finally:
         toc = time.time() - tic
-        extra_tic = {"tictoc": "pyunicore.Job", "duration": toc}
+        extra_tic = tictoc_extra("pyunicore.Job", toc)
         extra_tic.update(logs_extra)
         log.debug(
             "UNICORE communication",
@@ -803,24 +604,15 @@ def _get_job(config, instance_dict, custom_headers, logs_extra):
     return job
 
 
+@with_deadline("stop")
 def stop_service(
     config, instance_dict, custom_headers, logs_extra, raise_exception=True
 ):
     log.debug("Service stop pyunicore", extra=logs_extra)
 
-    mapped_system = (
-        config.get("systems", {})
-        .get("mapping", {})
-        .get("system", {})
-        .get(
-            instance_dict["user_options"]["system"],
-            instance_dict["user_options"]["system"],
-        )
-    )
+    system_config = get_system_config(config, instance_dict["user_options"]["system"])
 
-    download, delete = get_download_delete(
-        config, instance_dict, mapped_system, logs_extra
-    )
+    download, delete = get_download_delete(system_config, logs_extra)
     try:
         log.debug(
             f"Stop pyunicore Service - Get Job: {instance_dict['resource_url']} ...",
@@ -835,7 +627,7 @@ def stop_service(
             raise tice
         finally:
             toc = time.time() - tic
-            extra_tic = {"tictoc": "job.abort", "duration": toc}
+            extra_tic = tictoc_extra("job.abort", toc)
             extra_tic.update(logs_extra)
             log.debug(
                 "UNICORE communication",
@@ -848,9 +640,8 @@ def stop_service(
             _download_service(
                 instance_dict["id"],
                 instance_dict["servername"],
-                config,
                 job,
-                mapped_system,
+                system_config,
                 logs_extra=logs_extra,
             )
 
@@ -863,7 +654,7 @@ def stop_service(
                 raise tice
             finally:
                 toc = time.time() - tic
-                extra_tic = {"tictoc": "job.delete", "duration": toc}
+                extra_tic = tictoc_extra("job.delete", toc)
                 extra_tic.update(logs_extra)
                 log.debug(
                     "UNICORE communication",
@@ -874,6 +665,8 @@ def stop_service(
         log.warning("pyunicore - Service stop failed", exc_info=True, extra=logs_extra)
         if e.__class__.__name__ == "MgrException":
             e_args = e.args
+        elif isinstance(e, CircuitOpen):
+            e_args = (_circuit_open_message(config, logs_extra), str(e))
         else:
             user_error_msg = get_error_message(
                 config,
@@ -889,57 +682,8 @@ def stop_service(
             raise MgrException(*e_args)
 
 
-def _create_dir(dir, logs_extra={}):
-    log.trace(f"Create directory: {dir}", extra=logs_extra)
-    if os.path.exists(dir):
-        log.critical(f"Create directory - {dir} already exists.")
-    os.makedirs(dir, exist_ok=True)
-
-
-def _download_job_files(
-    storage, destination_base_dir, allowed_files=[], base="/", logs_extra={}
-):
-    destination_base_dir_rstrip = destination_base_dir.rstrip("/")
-    destination_dir = f"{destination_base_dir_rstrip}{base}".rstrip("/")
-    _create_dir(destination_dir, logs_extra=logs_extra)
-
-    dict_of_paths = storage.listdir(base)
-    for name, path in dict_of_paths.items():
-        file_destination = f"{destination_base_dir_rstrip}/{name}"
-        if path.isfile():
-            for allowed_file in allowed_files:
-                if name.startswith(allowed_file):
-                    log.trace(f"Download Service - download: {name}", extra=logs_extra)
-                    tic = time.time()
-                    try:
-                        path.download(file_destination)
-                    except Exception as tice:
-                        raise tice
-                    finally:
-                        toc = time.time() - tic
-                        extra_tic = {"tictoc": "path.download", "duration": toc}
-                        extra_tic.update(logs_extra)
-                        log.debug(
-                            "UNICORE communication",
-                            extra=extra_tic,
-                        )
-        elif path.isdir():
-            _download_job_files(
-                storage,
-                destination_base_dir,
-                allowed_files,
-                f"/{name}",
-                logs_extra=logs_extra,
-            )
-
-
-def _download_service(drf_id, servername, config, job, system, logs_extra={}):
-    destination_dir = (
-        config.get("systems", {})
-        .get(system, {})
-        .get("pyunicore", {})
-        .get("job_archive", "/tmp")
-    )
+def _download_service(drf_id, servername, job, system_config, logs_extra={}):
+    destination_dir = system_config.job_archive
     tic = time.time()
     try:
         job_id = job.job_id
@@ -947,19 +691,14 @@ def _download_service(drf_id, servername, config, job, system, logs_extra={}):
         raise tice
     finally:
         toc = time.time() - tic
-        extra_tic = {"tictoc": "job.job_id", "duration": toc}
+        extra_tic = tictoc_extra("job.job_id", toc)
         extra_tic.update(logs_extra)
         log.debug(
             "UNICORE communication",
             extra=extra_tic,
         )
     destination = f"{destination_dir.rstrip('/')}/{drf_id}_{servername}_{job_id}"
-    allowed_files = (
-        config.get("system", {})
-        .get(system, {})
-        .get("pyunicore", {})
-        .get("download_files", ["stderr", "stdout", "bss_submit"])
-    )
+    allowed_files = system_config.download_files
     tic = time.time()
     try:
         storage = job.working_dir
@@ -967,58 +706,120 @@ def _download_service(drf_id, servername, config, job, system, logs_extra={}):
         raise tice
     finally:
         toc = time.time() - tic
-        extra_tic = {"tictoc": "job.working_dir", "duration": toc}
+        extra_tic = tictoc_extra("job.working_dir", toc)
         extra_tic.update(logs_extra)
         log.debug(
             "UNICORE communication",
             extra=extra_tic,
         )
     log.debug(f"Download Service files - {storage} to {destination}", extra=logs_extra)
-    _download_job_files(storage, destination, allowed_files, "/", logs_extra=logs_extra)
+    return download_files(storage, destination, allowed_files, logs_extra=logs_extra)
 
 
 def _get_file_output(job, file, max_bytes):
     try:
-        tic = time.time()
+        file_url = f"{job.working_dir.resource_url}/files/{file}"
         try:
-            file_path = job.working_dir.stat(file)
-        except Exception as tice:
-            raise tice
-        finally:
-            toc = time.time() - tic
-            extra_tic = {"tictoc": "job.working_dir.stat", "duration": toc}
-            log.debug(
-                "UNICORE communication",
-                extra=extra_tic,
-            )
-        file_size = file_path.properties["size"]
-        if file_size == 0:
+            tic = time.time()
+            try:
+                res = job.transport.get(
+                    to_json=False,
+                    url=file_url,
+                    headers=tail_headers(max_bytes),
+                    stream=True,
+                )
+            except Exception as tice:
+                raise tice
+            finally:
+                toc = time.time() - tic
+                extra_tic = tictoc_extra("job.working_dir.tail", toc)
+                log.debug(
+                    "UNICORE communication",
+                    extra=extra_tic,
+                )
+        except requests.HTTPError as e:
+            if e.response is None or (
+                e.response.status_code not in REJECTED_STATUS_CODES
+            ):
+                raise
+            return _get_file_output_stat(job, file, max_bytes)
+        with contextlib.closing(res):
+            data = keep_tail(res.iter_content(10 * 1024), max_bytes)
+        tail_stats.record(1, len(data))
+        if not data:
             return f"{file} is empty"
-        offset = max(0, file_size - max_bytes)
-        s = file_path.raw(offset=offset)
-        ret = s.data.decode()
-        return ret
+        return decode_tail(data, len(data) == max_bytes)
     except Exception as e:
         log.warning("Could not receive file info", exc_info=True)
         return f"{file} not available."
 
 
+def _get_file_output_stat(job, file, max_bytes):
+    # For servers without suffix byte ranges
+    tic = time.time()
+    try:
+        file_path = job.working_dir.stat(file)
+    except Exception as tice:
+        raise tice
+    finally:
+        toc = time.time() - tic
+        extra_tic = tictoc_extra("job.working_dir.stat", toc)
+        log.debug(
+            "UNICORE communication",
+            extra=extra_tic,
+        )
+    file_size = file_path.properties["size"]
+    if file_size == 0:
+        tail_stats.record(2, 0, fallback=True)
+        return f"{file} is empty"
+    offset = max(0, file_size - max_bytes)
+    data = file_path.raw(offset=offset).data
+    tail_stats.record(3, len(data), fallback=True)
+    return decode_tail(data, offset > 0)
+
+
 def _prettify_error_logs(log_list, join_s, lines, summary):
-    if type(log_list) == str:
-        log_list = log_list.split("\n")
-    if type(log_list) == list:
-        if lines > 0:
-            log_list_short = log_list[-lines:]
-        if lines < len(log_list):
-            log_list_short.insert(0, "...")
-        log_list_short_escaped = list(map(lambda x: html.escape(x), log_list_short))
-        logs_s = join_s.join(log_list_short_escaped)
+    if isinstance(log_list, (str, bytes)):
+        log_list_short, truncated = last_lines(log_list, lines)
+    elif type(log_list) == list:
+        truncated = 0 < lines < len(log_list)
+        log_list_short = log_list[-lines:] if lines > 0 else log_list
     else:
-        logs_s = log_list.split()
-        logs_s = html.escape(logs_s)
+        logs_s = html.escape(str(log_list))
+        return f"<details><summary>{summary}</summary>{logs_s}</details>"
+    if truncated:
+        log_list_short = ["..."] + log_list_short
+    logs_s = join_s.join(html.escape(x) for x in log_list_short)
     return f"<details><summary>{summary}</summary>{logs_s}</details>"
 
 
+# Bounded pool for the independent UNICORE requests of a status check
+status_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("STATUS_MAX_WORKERS", 16)),
+    thread_name_prefix="status",
+)
+
+
+def _unicore_call(tictoc, logs_extra, func, *args):
+    tic = time.time()
+    try:
+        return func(*args)
+    finally:
+        toc = time.time() - tic
+        extra_tic = tictoc_extra(tictoc, toc)
+        extra_tic.update(logs_extra)
+        log.debug(
+            "UNICORE communication",
+            extra=extra_tic,
+        )
+
+
+def _bss_details_url(job_properties):
+    # Like job.bss_details(), the link is missing if the site has none
+    return job_properties.get("_links", {}).get("details", {}).get("href", None)
+
+
+@with_deadline("status")
 def status_service(config, instance_dict, custom_headers, logs_extra):
     log.trace("Get Service status", extra=logs_extra)
     job = _get_job(
@@ -1028,71 +829,33 @@ def status_service(config, instance_dict, custom_headers, logs_extra):
         logs_extra=logs_extra,
     )
 
-    mapped_system = (
-        config.get("systems", {})
-        .get("mapping", {})
-        .get("system", {})
-        .get(
-            instance_dict["user_options"]["system"],
-            instance_dict["user_options"]["system"],
-        )
-    )
+    system_config = get_system_config(config, instance_dict["user_options"]["system"])
 
     if custom_headers.get("DOWNLOAD", "false").lower() == "true":
         _download_service(
             instance_dict["id"],
             instance_dict["servername"],
-            config,
             job,
-            mapped_system,
+            system_config,
             logs_extra=logs_extra,
         )
-    tic = time.time()
-    try:
-        running = job.is_running()
-    except Exception as tice:
-        raise tice
-    finally:
-        toc = time.time() - tic
-        extra_tic = {"tictoc": "job.is_running", "duration": toc}
-        extra_tic.update(logs_extra)
-        log.debug(
-            "UNICORE communication",
-            extra=extra_tic,
-        )
-    tic = time.time()
-    try:
-        job_properties = job.properties
-    except Exception as tice:
-        raise tice
-    finally:
-        toc = time.time() - tic
-        extra_tic = {"tictoc": "job.properties", "duration": toc}
-        extra_tic.update(logs_extra)
-        log.debug(
-            "UNICORE communication",
-            extra=extra_tic,
-        )
+    job_properties = _unicore_call("job.properties", logs_extra, lambda: job.properties)
+    # is_running() uses the properties fetched above (pyunicore caches them)
+    running = _unicore_call("job.is_running", logs_extra, job.is_running)
     status = job_properties["status"]
-    get_bss_details = (
-        config.get("systems", {}).get(mapped_system, {}).get("get_bss_details", False)
-    )
-    if get_bss_details:
-        tic = time.time()
-        try:
-            bss_details = job.bss_details()
-        except Exception as tice:
-            raise tice
-        finally:
-            toc = time.time() - tic
-            extra_tic = {"tictoc": "job.bss_details", "duration": toc}
-            extra_tic.update(logs_extra)
-            log.debug(
-                "UNICORE communication",
-                extra=extra_tic,
-            )
+    # The remaining requests are independent of each other, each thread runs
+    # in a copy of this context, with the same deadline
+    bss_details_url = _bss_details_url(job_properties)
+    if system_config.get_bss_details and bss_details_url is not None:
+        bss_details_future = status_executor.submit(
+            contextvars.copy_context().run,
+            _unicore_call,
+            "job.bss_details",
+            logs_extra,
+            lambda: job.transport.get(url=bss_details_url),
+        )
     else:
-        bss_details = {}
+        bss_details_future = None
 
     log.trace(f"Get Service status - running: {running} ( {status} )", extra=logs_extra)
 
@@ -1100,103 +863,65 @@ def status_service(config, instance_dict, custom_headers, logs_extra):
     # So we should NOT always pull the output.
     # Only get useful output, when the job is not running anymore
     if running:
-        return {
-            "running": running,
-            "status": status,
-            "bss_details": bss_details,
-            "details": {
-                "error": "No error message available.",
-                "detailed_error": f"Job is still running ( {status} ). ",
-            },
-        }
+        return _running_status(status, _bss_details_result(bss_details_future))
 
     # We will only call poll, when the job status changed to SUCCESSFUL/DONE/FAILED . So we'll
     # need the useful output for every GET request
-    unicore_detailed_error_join = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("detailed_error_join", "")
-    )
-    unicore_logs_lines = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_logs", {})
-        .get("lines", 3)
+    stdout_future = status_executor.submit(
+        contextvars.copy_context().run,
+        _get_file_output,
+        job,
+        "stdout",
+        system_config.unicore_stdout.max_bytes,
     )
-    unicore_logs_join = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_logs", {})
-        .get("join", "<br>")
+    stderr_future = status_executor.submit(
+        contextvars.copy_context().run,
+        _get_file_output,
+        job,
+        "stderr",
+        system_config.unicore_stderr.max_bytes,
     )
-    unicore_logs_summary = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_logs", {})
-        .get("summary", "&nbsp&nbsp&nbsp&nbspUNICORE logs:")
+    return _finished_status(
+        system_config,
+        status,
+        _bss_details_result(bss_details_future),
+        job_properties,
+        stdout_future.result(),
+        stderr_future.result(),
+        logs_extra,
     )
 
-    unicore_stdout_lines = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_stdout", {})
-        .get("lines", 5)
-    )
-    unicore_stdout_join = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_stdout", {})
-        .get("join", "<br>")
-    )
-    unicore_stdout_max_bytes = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_stdout", {})
-        .get("max_bytes", 4096)
-    )
-    unicore_stdout_summary = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_stdout", {})
-        .get("summary", "&nbsp&nbsp&nbsp&nbspJob stdout:")
-    )
 
-    unicore_stderr_lines = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_stderr", {})
-        .get("lines", 5)
-    )
-    unicore_stderr_join = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_stderr", {})
-        .get("join", "<br>")
-    )
-    unicore_stderr_max_bytes = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_stderr", {})
-        .get("max_bytes", 4096)
-    )
-    unicore_stderr_summary = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("status_information", {})
-        .get("unicore_stderr", {})
-        .get("summary", "&nbsp&nbsp&nbsp&nbspJob stderr:")
-    )
+def _bss_details_result(bss_details_future):
+    if bss_details_future is None:
+        return {}
+    return bss_details_future.result()
+
+
+def _running_status(status, bss_details):
+    return {
+        "running": True,
+        "status": status,
+        "bss_details": bss_details,
+        "details": {
+            "error": "No error message available.",
+            "detailed_error": f"Job is still running ( {status} ). ",
+        },
+    }
+
+
+def _finished_status(
+    system_config,
+    status,
+    bss_details,
+    job_properties,
+    unicore_stdout,
+    unicore_stderr,
+    logs_extra,
+):
+    unicore_logs_config = system_config.unicore_logs
+    unicore_stdout_config = system_config.unicore_stdout
+    unicore_stderr_config = system_config.unicore_stderr
 
     unicore_exit_code = job_properties.get("exitCode", "unknown exitCode")
     error_msg = f"UNICORE Job stopped with exitCode: {unicore_exit_code}"
@@ -1206,22 +931,23 @@ def status_service(config, instance_dict, custom_headers, logs_extra):
 
     unicore_logs = job_properties.get("log", [])
     unicore_logs_details = _prettify_error_logs(
-        unicore_logs, unicore_logs_join, unicore_logs_lines, unicore_logs_summary
+        unicore_logs,
+        unicore_logs_config.join,
+        unicore_logs_config.lines,
+        unicore_logs_config.summary,
     )
 
-    unicore_stdout = _get_file_output(job, "stdout", unicore_stdout_max_bytes)
-    unicore_stderr = _get_file_output(job, "stderr", unicore_stderr_max_bytes)
     unicore_stdout_details = _prettify_error_logs(
         unicore_stdout,
-        unicore_stdout_join,
-        unicore_stdout_lines,
-        unicore_stdout_summary,
+        unicore_stdout_config.join,
+        unicore_stdout_config.lines,
+        unicore_stdout_config.summary,
     )
     unicore_stderr_details = _prettify_error_logs(
         unicore_stderr,
-        unicore_stderr_join,
-        unicore_stderr_lines,
-        unicore_stderr_summary,
+        unicore_stderr_config.join,
+        unicore_stderr_config.lines,
+        unicore_stderr_config.summary,
     )
     detailed_error_list = [
         unicore_status_message,
@@ -1229,12 +955,16 @@ def status_service(config, instance_dict, custom_headers, logs_extra):
         unicore_stdout_details,
         unicore_stderr_details,
     ]
-    detailed_error = unicore_detailed_error_join.join(detailed_error_list)
+    detailed_error = system_config.detailed_error_join.join(detailed_error_list)
     logs_extra["error_msg"] = error_msg
     logs_extra["detailed_error"] = detailed_error
     log.debug("Information shown to user", logs_extra)
+    log.trace(
+        "Tail reads of stdout/stderr",
+        extra=dict(logs_extra, tail_reads=tail_stats.stats()),
+    )
     return {
-        "running": running,
+        "running": False,
         "status": status,
         "bss_details": bss_details,
         "details": {
@@ -1244,6 +974,54 @@ def status_service(config, instance_dict, custom_headers, logs_extra):
     }
 
 
+# Transports with keep-alive connections, shared by all threads of a worker
+transport_pool = TransportPool(
+    maxsize=int(os.environ.get("TRANSPORT_POOL_SIZE", 128)),
+    ttl=int(os.environ.get("TRANSPORT_POOL_TTL", 300)),
+)
+
+
+# One circuit breaker per site_url
+circuit_breakers = CircuitBreakers()
+
+
+def _authentication_failed_message(config, logs_extra={}):
+    # Like a failed authentication in _get_client, also when the submission
+    # of a cached site is rejected
+    return get_error_message(
+        config,
+        logs_extra,
+        "services.utils.pyunicore._get_client",
+        "UNICORE error.",
+    )
+
+
+def _circuit_open_message(config, logs_extra={}):
+    # Also for CircuitOpen raised by a call, if the circuit opened meanwhile
+    return get_error_message(
+        config,
+        logs_extra,
+        "services.utils.pyunicore.circuit_open",
+        "System not available. Please try again later.",
+    )
+
+
+def _get_breaker(config, system_config, logs_extra={}):
+    # Raises MgrException right away, if the circuit of the site is open
+    bconfig = breaker_config(config)
+    if not bconfig["enabled"]:
+        return None
+    breaker = circuit_breakers.get(system_config.site_url, bconfig)
+    if breaker.is_open():
+        error_message = _circuit_open_message(
+            config, dict(logs_extra, circuit_breaker=breaker.stats())
+        )
+        raise MgrException(
+            error_message, f"Circuit breaker for {system_config.site_url} is open"
+        )
+    return breaker
+
+
 def _get_transport(
     config,
     instance_dict,
@@ -1252,69 +1030,69 @@ def _get_transport(
 ):
     log.trace("pyunicore - get transport", extra=logs_extra)
     credential = custom_headers["access-token"]
-    mapped_system = (
-        config.get("systems", {})
-        .get("mapping", {})
-        .get("system", {})
-        .get(
-            instance_dict["user_options"]["system"],
-            instance_dict["user_options"]["system"],
-        )
-    )
-    oidc = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("transport", {})
-        .get("oidc", True)
-    )
-    certificate_path = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("transport", {})
-        .get("certificate_path", False)
-    )
-    timeout = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("transport", {})
-        .get("timeout", 120)
-    )
-    set_preferences = (
-        config.get("systems", {})
-        .get(mapped_system, {})
-        .get("pyunicore", {})
-        .get("transport", {})
-        .get("set_preferences", True)
-    )
+    system_config = get_system_config(config, instance_dict["user_options"]["system"])
+    breaker = _get_breaker(config, system_config, logs_extra)
+    transport_config = system_config.transport
+    oidc = transport_config.oidc
+    certificate_path = transport_config.certificate_path
+    timeout = transport_config.timeout
+    set_preferences = transport_config.set_preferences
     log.trace(
         f"pyunicore - oidc={oidc} - cert={certificate_path} - timeout={timeout} - set_preferences={set_preferences}",
         extra=logs_extra,
     )
     try:
+        if set_preferences:
+            preferences = f"uid:{instance_dict['user_options']['account']},group:{instance_dict['user_options']['project']}"
+        else:
+            preferences = None
         tic = time.time()
         try:
-            transport = pyunicore.Transport(
-                credential=credential,
-                oidc=oidc,
-                verify=certificate_path,
-                timeout=timeout,
+            key = (
+                system_config.mapped_system,
+                token_hash(credential),
+                preferences,
+                oidc,
+                certificate_path,
+                timeout,
             )
+
+            def new_transport():
+                transport = SessionTransport(
+                    credential=credential,
+                    oidc=oidc,
+                    verify=certificate_path,
+                    timeout=timeout,
+                )
+                transport.preferences = preferences
+                return transport
+
+            transport = transport_pool.get(
+                key, new_transport, expires_at=token_expiry(credential)
+            )
+            transport.breaker = breaker
+            dconfig = deadline_config(config)
+            transport.retries = dconfig["retries"]
+            transport.backoff = dconfig["backoff"]
+            transport.backoff_max = dconfig["backoff_max"]
         except Exception as tice:
             raise tice
         finally:
             toc = time.time() - tic
-            extra_tic = {"tictoc": "pyunicore.Transport", "duration": toc}
+            extra_tic = tictoc_extra("pyunicore.Transport", toc)
             extra_tic.update(logs_extra)
             log.debug(
                 "UNICORE communication",
                 extra=extra_tic,
             )
-        log.trace("pyunicore - received transport object", extra=logs_extra)
-        if set_preferences:
-            transport.preferences = f"uid:{instance_dict['user_options']['account']},group:{instance_dict['user_options']['project']}"
+        log.trace(
+            "pyunicore - received transport object",
+            extra=dict(
+                logs_extra,
+                transport_pool=transport_pool.stats(),
+                ssl_contexts=ssl_contexts.stats(),
+            ),
+        )
     except Exception as e:
         error_message = get_error_message(
             config,
@@ -1326,28 +1104,42 @@ def _get_transport(
     return transport
 
 
+# Site-level metadata of the UNICORE core endpoints
+site_cache = SiteCache(
+    ttl=int(os.environ.get("SITE_CACHE_TTL", 60)),
+    negative_ttl=int(os.environ.get("SITE_CACHE_NEGATIVE_TTL", 10)),
+)
+
+
 def _get_client(config, instance_dict, custom_headers, logs_extra={}):
-    site_url = (
-        config.get("systems", {})
-        .get(instance_dict["user_options"]["system"], {})
-        .get("site_url", "https://localhost:8080/DEMO-SITE/rest/core")
-    )
+    site_url = get_system_config(
+        config, instance_dict["user_options"]["system"]
+    ).site_url
     transport = _get_transport(config, instance_dict, custom_headers, logs_extra)
     try:
         tic = time.time()
         try:
-            client = pyunicore.Client(transport, site_url)
+            client = get_site_client(site_cache, transport, site_url)
         except Exception as tice:
             raise tice
         finally:
             toc = time.time() - tic
-            extra_tic = {"tictoc": "pyunicore.Client", "duration": toc}
+            extra_tic = tictoc_extra("pyunicore.Client", toc)
             extra_tic.update(logs_extra)
             log.debug(
                 "UNICORE communication",
                 extra=extra_tic,
             )
-        log.trace("pyunicore - retrieved client object", extra=logs_extra)
+        log.trace(
+            "pyunicore - retrieved client object",
+            extra=dict(
+                logs_extra,
+                site_cache=site_cache.stats(),
+                circuit_breakers=circuit_breakers.stats(),
+            ),
+        )
+    except CircuitOpen as e:
+        raise MgrException(_circuit_open_message(config, logs_extra), str(e))
     except Exception as e:
         error_message = get_error_message(
             config,
@@ -0,0 +1,166 @@
+import collections
+import threading
+import time
+from datetime import datetime
+from types import MappingProxyType
+
+import pyunicore.client as pyunicore
+import requests
+from pyunicore.credentials import AuthenticationFailedException
+
+"""
+pyunicore.Client fetches the core endpoint of a site before it can submit
+a job. Most of that document is the same for every user: the links to the
+jobs, storages and other endpoints and the server information. SiteCache
+keeps this part per site_url for a short time, so a start only pays for
+the job submission itself.
+
+The "client" section (role, xlogin, ...) belongs to the user whose
+credentials were used, so it is never shared. If a site does not respond,
+this is remembered for a few seconds and further requests fail right away.
+
+The authentication is checked when the core endpoint is fetched. With a
+cached Site an expired token is noticed when the job is submitted, the
+site's 401 / 403 is reported as the same authentication failure.
+"""
+
+# A missing or expired access token
+AUTHENTICATION_STATUS_CODES = (401, 403)
+
+
+class SiteUnavailable(Exception):
+    pass
+
+
+class Site:
+    def __init__(self, site_url, properties):
+        self.site_url = site_url
+        self.links = MappingProxyType(
+            {k: v["href"] for k, v in properties.get("_links", {}).items()}
+        )
+        self.server = MappingProxyType(dict(properties.get("server", {})))
+        self.retrieved = time.time()
+
+
+class SiteClient(pyunicore.Client):
+    # A Client that takes the site-level links from the cache
+    def __init__(self, transport, site):
+        super().__init__(transport, site.site_url, check_authentication=False)
+        self.site = site
+
+    @property
+    def links(self):
+        return self.site.links
+
+    def new_job(self, job_description, inputs=[], autostart=True):
+        try:
+            return super().new_job(job_description, inputs, autostart)
+        except requests.HTTPError as e:
+            if (
+                e.response is None
+                or e.response.status_code not in AUTHENTICATION_STATUS_CODES
+            ):
+                raise
+            raise AuthenticationFailedException(
+                f"Failure to authenticate at {self.site.site_url}"
+            ) from e
+
+
+def _site_unavailable(e):
+    # Only errors of the site itself, a 4xx depends on the user
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500
+    return False
+
+
+class SiteCache:
+    def __init__(self, ttl=60, negative_ttl=10, maxsize=64):
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._maxsize = maxsize
+        # site_url -> (expires, Site or error message)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, site_url, expires, value):
+        with self._lock:
+            self._entries[site_url] = (expires, value)
+            self._entries.move_to_end(site_url)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def lookup(self, site_url):
+        # The cached Site, None if there is none. Raises SiteUnavailable as
+        # long as a failure of this site is remembered.
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(site_url)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(site_url)
+                self.hits += 1
+                if isinstance(entry[1], Site):
+                    return entry[1]
+                raise SiteUnavailable(entry[1])
+            self.misses += 1
+        return None
+
+    def add(self, site_url, properties):
+        site = Site(site_url, properties)
+        self._store(site_url, time.time() + self._ttl, site)
+        return site
+
+    def add_failure(self, site_url, e):
+        self._store(
+            site_url,
+            time.time() + self._negative_ttl,
+            f"{site_url} did not respond: {e}",
+        )
+
+    def get(self, site_url, fetch):
+        site = self.lookup(site_url)
+        if site is not None:
+            return site
+        try:
+            properties = fetch()
+        except Exception as e:
+            if _site_unavailable(e):
+                self.add_failure(site_url, e)
+            raise
+        return self.add(site_url, properties)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self._maxsize,
+            }
+
+
+def get_site_client(site_cache, transport, site_url):
+    fetched = {}
+
+    def fetch():
+        fetched["properties"] = transport.get(url=site_url)
+        return fetched["properties"]
+
+    site = site_cache.get(site_url, fetch)
+    client = SiteClient(transport, site)
+    if fetched:
+        # The properties were fetched with this user's credentials, so we can
+        # check the authentication like pyunicore.Client does
+        client._last_properties = fetched["properties"]
+        client._last_retrieved = datetime.now()
+        client.assert_authentication()
+    return client
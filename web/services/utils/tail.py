@@ -0,0 +1,126 @@
+import threading
+
+"""
+The output of a finished job (stdout, stderr) is shown to the user, but
+only its last max_bytes. tail_headers() asks for them with a suffix
+byte range (Range: bytes=-max_bytes), so one request is enough. Servers
+that reject suffix ranges (400, 416) are asked for the size first and
+then for the range starting at size - max_bytes, two requests like
+before. If a server ignores the Range header (200 instead of 206), only
+the last max_bytes of the body are kept.
+
+tail_stats counts the requests and bytes of all tail reads of this
+worker, and the requests saved compared to stat + range.
+
+last_lines() returns the last lines of such an output. It searches the
+line breaks backwards from the end, so only these lines are split, escaped
+and copied, however large the output is.
+"""
+
+REJECTED_STATUS_CODES = (400, 416)
+
+
+def tail_headers(max_bytes):
+    return {"Accept": "application/octet-stream", "Range": f"bytes=-{max_bytes}"}
+
+
+def range_headers(offset):
+    headers = {"Accept": "application/octet-stream"}
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+    return headers
+
+
+class TailBuffer:
+    # Last max_bytes of the chunks fed to it, in constant memory
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._data = bytearray()
+
+    def feed(self, chunk):
+        self._data += chunk
+        if len(self._data) > 2 * self.max_bytes:
+            del self._data[: -self.max_bytes]
+
+    def data(self):
+        if self.max_bytes <= 0:
+            return b""
+        return bytes(self._data[-self.max_bytes :])
+
+
+def keep_tail(chunks, max_bytes):
+    # Last max_bytes of a stream of byte chunks (e.g. iter_content())
+    tail = TailBuffer(max_bytes)
+    for chunk in chunks:
+        tail.feed(chunk)
+    return tail.data()
+
+
+def skip_partial_character(data):
+    # A tail may start within a multibyte UTF-8 character
+    skip = 0
+    while skip < min(3, len(data)) and data[skip] & 0xC0 == 0x80:
+        skip += 1
+    return data[skip:]
+
+
+def decode_tail(data, truncated):
+    if truncated:
+        data = skip_partial_character(data)
+    return data.decode(errors="replace")
+
+
+def last_lines(text, lines):
+    # Same as text.split("\n")[-lines:], and whether lines were left out.
+    # All lines if lines <= 0. bytes are decoded after the search.
+    newline = b"\n" if isinstance(text, bytes) else "\n"
+    start = len(text)
+    found = 0
+    while found < lines:
+        start = text.rfind(newline, 0, start)
+        if start == -1:
+            break
+        found += 1
+    truncated = lines > 0 and found == lines
+    tail = text[start + 1 :] if truncated else text
+    if isinstance(tail, bytes):
+        # A line break is never part of a multibyte character
+        tail = decode_tail(tail, True)
+    return tail.split("\n"), truncated
+
+
+class TailStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.requests = 0
+        self.fallbacks = 0
+        self.bytes = 0
+
+    def record(self, requests, nbytes, fallback=False):
+        with self._lock:
+            self.reads += 1
+            self.requests += requests
+            self.bytes += nbytes
+            if fallback:
+                self.fallbacks += 1
+
+    def clear(self):
+        with self._lock:
+            self.reads = 0
+            self.requests = 0
+            self.fallbacks = 0
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "reads": self.reads,
+                "requests": self.requests,
+                "requests_saved": 2 * self.reads - self.requests,
+                "fallbacks": self.fallbacks,
+                "bytes": self.bytes,
+            }
+
+
+tail_stats = TailStats()
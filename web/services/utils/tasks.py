@@ -0,0 +1,292 @@
+import base64
+import contextlib
+import hashlib
+import logging
+import os
+import random
+import socket
+import threading
+import uuid
+from datetime import timedelta
+
+from cryptography.fernet import Fernet
+from cryptography.fernet import InvalidToken
+from django.conf import settings
+from django.db import close_old_connections
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+from jupyterjsc_unicoremgr.settings import LOGGER_NAME
+from services.models import StopTaskModel
+from services.utils import _config
+from services.utils import MgrException
+from services.utils import pinned_config
+from services.utils.common import instance_dict_and_custom_headers_to_logs_extra
+from services.utils.common import stop_service
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+Stopping a service (abort, optional download of the working directory,
+delete) can take a long time. DELETE only marks the service as stopping and
+stores a StopTaskModel. StopTaskWorker threads (stop_queue.threads per
+gunicorn worker) process these tasks.
+
+A worker claims a task with SELECT ... FOR UPDATE SKIP LOCKED, so workers
+of all pods can take tasks from the same table without blocking each
+other. While a task runs, it's hidden from the other workers for
+visibility_timeout seconds, a heartbeat renews this every third of it. If
+the worker dies, the task is taken by the next one afterwards. Failed
+attempts are retried with exponential backoff until max_attempts is
+reached. Finished tasks keep their state, number of attempts and last
+error.
+
+A task only stores the headers a stop needs. The access token is
+encrypted with a key derived from SECRET_KEY and removed once the task is
+finished. The workers of one pod share SECRET_KEY (preload_app), workers
+of several pods need the same UNICOREMGR_SECRET_KEY to read each other's
+tasks.
+
+The queue is disabled by default, DELETE stops the service within the
+request then. Its threads are started by gunicorn's post_worker_init
+(gunicorn_http.py, gunicorn_https.py), so only enable it with gunicorn.
+With manage.py runserver the tasks would be stored but never processed.
+"""
+
+
+def stop_queue_config(config):
+    ret = {
+        "enabled": False,
+        "threads": 4,
+        "max_attempts": 5,
+        "backoff": 10,
+        "backoff_max": 600,
+        "visibility_timeout": 300,
+        "tick": 2,
+    }
+    ret.update(config.get("stop_queue", {}))
+    return ret
+
+
+# Headers stored in a task, the others are not used by stop_service
+STOP_HEADERS = ("access-token", "uuidcode")
+
+
+def _fernet():
+    key = hashlib.sha256(settings.SECRET_KEY.encode()).digest()
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def encrypt_headers(custom_headers):
+    ret = {key: custom_headers[key] for key in STOP_HEADERS if key in custom_headers}
+    if "access-token" in ret:
+        ret["access-token"] = _fernet().encrypt(ret["access-token"].encode()).decode()
+    return ret
+
+
+def decrypt_headers(stored_headers):
+    ret = dict(stored_headers)
+    if "access-token" in ret:
+        try:
+            ret["access-token"] = (
+                _fernet().decrypt(ret["access-token"].encode()).decode()
+            )
+        except InvalidToken:
+            raise MgrException(
+                "Could not read the access token.",
+                "Stored with another SECRET_KEY",
+            )
+    return ret
+
+
+def task_instance_dict(instance):
+    # All a stop needs, JSON serializable
+    return {
+        "id": instance.id,
+        "servername": instance.servername,
+        "start_id": instance.start_id,
+        "user_options": instance.user_options,
+        "jhub_user_id": instance.jhub_user_id,
+        "jhub_credential": instance.jhub_credential,
+        "resource_url": instance.resource_url,
+        "start_date": instance.start_date.isoformat() if instance.start_date else "",
+    }
+
+
+def enqueue_stop(instance, custom_headers):
+    return StopTaskModel.objects.create(
+        servername=instance.servername,
+        jhub_credential=instance.jhub_credential,
+        instance=task_instance_dict(instance),
+        custom_headers=encrypt_headers(custom_headers),
+        available_at=timezone.now(),
+    )
+
+
+def backoff_delay(qconfig, attempts):
+    # Exponential backoff with jitter, so retries of many tasks spread out
+    delay = min(qconfig["backoff_max"], qconfig["backoff"] * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+class StopTaskWorker:
+    def __init__(self, owner=None):
+        if owner is None:
+            owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.owner = owner
+
+    def claim(self, qconfig):
+        now = timezone.now()
+        with transaction.atomic():
+            task = (
+                StopTaskModel.objects.select_for_update(skip_locked=True)
+                .filter(
+                    state__in=[StopTaskModel.PENDING, StopTaskModel.RUNNING],
+                    available_at__lte=now,
+                )
+                .order_by("available_at")
+                .first()
+            )
+            if task is None:
+                return None
+            # The attempts check protects databases without row locks
+            claimed = StopTaskModel.objects.filter(
+                id=task.id, attempts=task.attempts
+            ).update(
+                state=StopTaskModel.RUNNING,
+                attempts=task.attempts + 1,
+                locked_by=self.owner,
+                available_at=now + timedelta(seconds=qconfig["visibility_timeout"]),
+            )
+        if claimed != 1:
+            return None
+        task.refresh_from_db()
+        return task
+
+    def _update(self, task, **fields):
+        # Only if no other worker took over after the visibility timeout
+        return StopTaskModel.objects.filter(
+            id=task.id, locked_by=self.owner, attempts=task.attempts
+        ).update(**fields)
+
+    def _finish(self, task, state, last_error=""):
+        self._update(
+            task,
+            state=state,
+            custom_headers={},
+            last_error=last_error,
+            finished=timezone.now(),
+        )
+
+    @contextlib.contextmanager
+    def heartbeat(self, qconfig, task):
+        # Keeps the task hidden from the other workers while it runs
+        stop_event = threading.Event()
+        visibility_timeout = qconfig["visibility_timeout"]
+
+        def beat():
+            try:
+                while not stop_event.wait(visibility_timeout / 3):
+                    self._update(
+                        task,
+                        available_at=timezone.now()
+                        + timedelta(seconds=visibility_timeout),
+                    )
+            except Exception:
+                log.exception(
+                    "Stop task heartbeat failed", extra={"uuidcode": "StopTaskWorker"}
+                )
+            finally:
+                connection.close()
+
+        thread = threading.Thread(
+            target=beat, name=f"stop-heartbeat-{task.id}", daemon=True
+        )
+        thread.start()
+        try:
+            yield
+        finally:
+            stop_event.set()
+            thread.join()
+
+    def process(self, qconfig, task):
+        logs_extra = instance_dict_and_custom_headers_to_logs_extra(
+            task.instance, task.custom_headers
+        )
+        logs_extra["stop_task"] = task.id
+        logs_extra["attempt"] = task.attempts
+        if task.attempts > qconfig["max_attempts"]:
+            # The previous worker did not finish within the visibility timeout
+            log.warning("Stop task timed out", extra=logs_extra)
+            self._finish(task, StopTaskModel.FAILED, "Timed out")
+            return False
+        try:
+            with self.heartbeat(qconfig, task):
+                stop_service(
+                    task.instance, decrypt_headers(task.custom_headers), logs_extra
+                )
+        except Exception as e:
+            last_error = " ".join(str(x) for x in e.args)
+            if task.attempts >= qconfig["max_attempts"]:
+                log.critical("Could not stop service.", extra=logs_extra)
+                self._finish(task, StopTaskModel.FAILED, last_error)
+            else:
+                delay = backoff_delay(qconfig, task.attempts)
+                log.warning(
+                    f"Stop task failed, retry in {delay:.0f}s", extra=logs_extra
+                )
+                self._update(
+                    task,
+                    state=StopTaskModel.PENDING,
+                    last_error=last_error,
+                    available_at=timezone.now() + timedelta(seconds=delay),
+                )
+            return False
+        self._finish(task, StopTaskModel.DONE)
+        return True
+
+    def run_once(self):
+        # Processes one task, returns False if there was none
+        qconfig = stop_queue_config(_config())
+        task = self.claim(qconfig)
+        if task is None:
+            return False
+        self.process(qconfig, task)
+        return True
+
+    def run_forever(self, stop_event):
+        log.info(
+            f"Stop task worker started - {self.owner}",
+            extra={"uuidcode": "StopTaskWorker"},
+        )
+        while not stop_event.is_set():
+            found = False
+            tick = 2
+            try:
+                with pinned_config() as config:
+                    tick = stop_queue_config(config)["tick"]
+                    found = self.run_once()
+            except Exception:
+                log.exception(
+                    "Stop task worker failed", extra={"uuidcode": "StopTaskWorker"}
+                )
+            finally:
+                close_old_connections()
+            if not found:
+                stop_event.wait(tick)
+
+
+def start_stop_workers():
+    stop_event = threading.Event()
+    threads = []
+    for i in range(stop_queue_config(_config())["threads"]):
+        thread = threading.Thread(
+            target=StopTaskWorker().run_forever,
+            args=(stop_event,),
+            name=f"stop-worker-{i}",
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+    return threads, stop_event
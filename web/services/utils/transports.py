@@ -0,0 +1,290 @@
+import base64
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import pyunicore.client as pyunicore
+import requests
+from jupyterjsc_unicoremgr.settings import LOGGER_NAME
+from requests.adapters import HTTPAdapter
+from services.utils.cache import directory_signature
+from services.utils.cache import file_signature
+from services.utils.cache import FileCache
+from services.utils.deadline import is_transient
+from services.utils.deadline import may_retry
+from services.utils.deadline import request_timeout
+from services.utils.deadline import retry_delay
+from urllib3.util.ssl_ import create_urllib3_context
+
+log = logging.getLogger(LOGGER_NAME)
+assert log.__class__.__name__ == "ExtraLoggerClass"
+
+"""
+pyunicore.Transport sends every request with requests.get/put/post/delete,
+so each UNICORE call opens a new connection and does a new TLS handshake.
+SessionTransport sends them through a requests.Session instead. The
+session, and with it the keep-alive connections, is shared by all clones
+of a transport (pyunicore clones the transport for every Client and Job).
+
+TransportPool keeps these transports per mapped system, access token and
+user preferences, so a user's status polls reuse an established
+connection. Entries expire with the access token (or after the pool's
+TTL, whatever comes first) and the least recently used ones are evicted.
+
+Without further help every new connection loads and parses the CA bundle
+given in certificate_path (or certifi's bundle) again. SSLContextAdapter
+uses one SSL context per bundle instead, which is created once per
+worker and only recreated when the bundle changes on disk.
+"""
+
+
+def ca_bundle(verify):
+    # CA bundle used by requests for the given verify argument
+    if verify is True:
+        return requests.certs.where()
+    if isinstance(verify, str) and verify:
+        return verify
+    return None
+
+
+def _bundle_signature(path):
+    if os.path.isdir(path):
+        return directory_signature(path)
+    return file_signature(path)
+
+
+def _load_ssl_context(path):
+    tic = time.time()
+    context = create_urllib3_context()
+    if os.path.isdir(path):
+        context.load_verify_locations(capath=path)
+    else:
+        context.load_verify_locations(cafile=path)
+    toc = time.time() - tic
+    log.debug(
+        f"SSL context created - {path}",
+        extra={"uuidcode": "SSLContext", "tictoc": "ssl.SSLContext", "duration": toc},
+    )
+    return context
+
+
+# One SSL context per CA bundle, shared by all UNICORE connections
+ssl_contexts = FileCache(_load_ssl_context, signature=_bundle_signature, maxsize=16)
+
+
+class SSLContextAdapter(HTTPAdapter):
+    def __init__(self, certificate_path, **kwargs):
+        self.certificate_path = certificate_path
+        self.ssl_context = ssl_contexts.get(certificate_path)
+        self._lock = threading.Lock()
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs["ssl_context"] = self.ssl_context
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if conn.cert_reqs == "CERT_REQUIRED":
+            # The CA certificates are already loaded into the shared context
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+    def send(self, request, **kwargs):
+        ssl_context = ssl_contexts.get(self.certificate_path)
+        if ssl_context is not self.ssl_context:
+            # The bundle has changed, new connections use the new context
+            with self._lock:
+                if ssl_context is not self.ssl_context:
+                    self.ssl_context = ssl_context
+                    self.poolmanager.clear()
+                    self.init_poolmanager(
+                        self._pool_connections,
+                        self._pool_maxsize,
+                        block=self._pool_block,
+                    )
+        return super().send(request, **kwargs)
+
+
+class SessionTransport(pyunicore.Transport):
+    def __init__(self, *args, session=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if session is None:
+            session = requests.Session()
+            certificate_path = ca_bundle(self.verify)
+            if certificate_path:
+                session.mount("https://", SSLContextAdapter(certificate_path))
+        self.session = session
+        # CircuitBreaker of the site, see services.utils.breaker
+        self.breaker = None
+        # Retries of GET requests, see services.utils.deadline
+        self.retries = 0
+        self.backoff = 0.5
+        self.backoff_max = 5
+
+    def _clone(self):
+        tr = SessionTransport(self.credential, session=self.session)
+        tr.preferences = self.preferences
+        tr.use_security_sessions = self.use_security_sessions
+        tr.last_session_id = self.last_session_id
+        tr.timeout = self.timeout
+        tr.verify = self.verify
+        tr.breaker = self.breaker
+        tr.retries = self.retries
+        tr.backoff = self.backoff
+        tr.backoff_max = self.backoff_max
+        return tr
+
+    def _run_method(self, method, **args):
+        # pyunicore.Transport.run_method, with the timeout limited by the
+        # deadline of the current operation
+        args = dict(args)
+        _headers = self._headers(args)
+        res = method(
+            headers=_headers,
+            verify=self.verify,
+            timeout=request_timeout(self.timeout),
+            **args,
+        )
+        if self.repeat_required(res, _headers):
+            res = method(
+                headers=_headers,
+                verify=self.verify,
+                timeout=request_timeout(self.timeout),
+                **args,
+            )
+        self.check_error(res)
+        if self.use_security_sessions:
+            self.last_session_id = res.headers.get("X-UNICORE-SecuritySession", None)
+        return res
+
+    def _send(self, method, **args):
+        if self.breaker is None:
+            return self._run_method(method, **args)
+        return self.breaker.call(self._run_method, method, **args)
+
+    def run_method(self, method, **args):
+        # requests.get -> session.get, same for put, post and delete
+        name = method.__name__
+        method = getattr(self.session, name)
+        attempt = 0
+        while True:
+            try:
+                return self._send(method, **args)
+            except Exception as e:
+                # Only GET is idempotent
+                if name != "get" or attempt >= self.retries or not is_transient(e):
+                    raise
+                delay = retry_delay(attempt, self.backoff, self.backoff_max)
+                if not may_retry(delay):
+                    raise
+                attempt += 1
+                log.debug(
+                    f"Retry GET {args.get('url')} in {delay:.2f}s ({attempt}/{self.retries}) - {e}"
+                )
+                time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+
+def warm_ssl_contexts(config):
+    # Create the SSL contexts of all configured systems
+    for system_config in config.systems.values():
+        certificate_path = ca_bundle(system_config.transport.certificate_path)
+        if certificate_path:
+            try:
+                ssl_contexts.get(certificate_path)
+            except (OSError, ValueError):
+                log.warning(
+                    f"Could not load CA bundle {certificate_path}",
+                    extra={"uuidcode": "StartUp"},
+                    exc_info=True,
+                )
+    return ssl_contexts.stats()["size"]
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def token_expiry(token):
+    # Expiration time of a JWT access token, None if it's not a JWT
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp is not None else None
+    except (IndexError, ValueError, TypeError, AttributeError):
+        return None
+
+
+class TransportPool:
+    """
+    Thread-safe LRU pool of transports. get() always returns a clone, so
+    callers never share the mutable state of a transport, only its session.
+    """
+
+    def __init__(self, maxsize=128, ttl=300):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _close(self, transport):
+        if hasattr(transport, "close"):
+            transport.close()
+
+    def get(self, key, factory, expires_at=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]._clone()
+            if entry is not None:
+                del self._entries[key]
+                self._close(entry[1])
+            self.misses += 1
+        transport = factory()
+        expires = now + self._ttl
+        if expires_at is not None:
+            expires = min(expires, expires_at)
+        with self._lock:
+            replaced = self._entries.get(key)
+            self._entries[key] = (expires, transport)
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self._maxsize:
+                evicted.append(self._entries.popitem(last=False)[1][1])
+        if replaced is not None:
+            # Another thread created a transport for the same key meanwhile
+            evicted.append(replaced[1])
+        for old_transport in evicted:
+            self._close(old_transport)
+        return transport._clone()
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+        for _, transport in entries:
+            self._close(transport)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self._maxsize,
+            }
@@ -5,14 +5,26 @@ from jupyterjsc_unicoremgr.permissions import HasGroupPermission
 from jupyterjsc_unicoremgr.settings import LOGGER_NAME
 from rest_framework import mixins
 from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
 
 from .models import ServicesModel
 from .serializers import ServicesSerializer
+from .utils import _config
 from .utils import get_custom_headers
+from .utils import MgrException
+from .utils.batch import run_per_site
 from .utils.common import initial_data_to_logs_extra
 from .utils.common import instance_dict_and_custom_headers_to_logs_extra
 from .utils.common import start_service
 from .utils.common import stop_service
+from .utils.config import get_system_config
+from .utils.poller import create_snapshot
+from .utils.poller import poller_config
+from .utils.poller import remember_token
+from .utils.poller import token_store
+from .utils.tasks import enqueue_stop
+from .utils.tasks import stop_queue_config
 
 log = logging.getLogger(LOGGER_NAME)
 assert log.__class__.__name__ == "ExtraLoggerClass"
@@ -53,6 +65,10 @@ class ServicesViewSet(
         if not start_service_values:
             start_service_values = {}
         serializer.save(**start_service_values)
+        config = _config()
+        if poller_config(config)["enabled"]:
+            create_snapshot(config, serializer.instance)
+            remember_token(config, serializer.instance, custom_headers)
 
     def perform_destroy(self, instance):
         custom_headers = get_custom_headers(self.request._request.META)
@@ -63,10 +79,16 @@ class ServicesViewSet(
         if instance.stop_pending:
             log.debug("Service is already stopping. Do nothing.", extra=logs_extra)
             return
+        token_store.discard(instance.id)
         try:
             instance.stop_pending = True
             instance.save()
-            stop_service(instance.__dict__, custom_headers, logs_extra)
+            if stop_queue_config(_config())["enabled"]:
+                # The stop task workers stop the UNICORE job
+                task = enqueue_stop(instance, custom_headers)
+                log.debug(f"Stop task {task.id} created", extra=logs_extra)
+            else:
+                stop_service(instance.__dict__, custom_headers, logs_extra)
         except Exception as e:
             log.critical(
                 "Could not stop service.", extra=instance.__dict__, exc_info=True
@@ -103,3 +125,89 @@ class ServicesViewSet(
     @request_decorator
     def list(self, request, *args, **kwargs):
         return super().list(request, *args, **kwargs)
+
+    @request_decorator
+    def status(self, request, *args, **kwargs):
+        # Status of many services in one request, POST /api/status/
+        config = _config()
+        batch_config = config.get("status_batch", {})
+        max_servernames = batch_config.get("max_servernames", 1000)
+        servernames = None
+        if isinstance(request.data, dict):
+            servernames = request.data.get("servernames")
+        if (
+            not isinstance(servernames, list)
+            or not all(isinstance(x, str) for x in servernames)
+            or len(servernames) > max_servernames
+        ):
+            return Response(
+                {
+                    "error": "Bad request",
+                    "detailed_error": f"Expected a list of at most {max_servernames} servernames",
+                },
+                status=400,
+            )
+
+        # Like get_object(), the latest service wins if there are multiple ones
+        instances = {}
+        for instance in (
+            self.get_queryset()
+            .filter(servername__in=servernames)
+            .select_related("status_snapshot")
+            .order_by("id")
+        ):
+            instances[instance.servername] = instance
+
+        def site_of(instance):
+            system = instance.user_options.get("system", "")
+            return get_system_config(config, system).site_url
+
+        def representation(instance):
+            return self.get_serializer(instance).data
+
+        results, exceptions, unfinished = run_per_site(
+            instances,
+            site_of,
+            representation,
+            max_per_site=batch_config.get("max_per_site", 4),
+            deadline=batch_config.get("deadline", 30),
+        )
+        errors = {}
+        for servername in servernames:
+            if servername not in instances:
+                errors[servername] = {
+                    "error": "Not found",
+                    "detailed_error": f"No service {servername}",
+                }
+        for servername, e in exceptions.items():
+            log.warning(
+                f"Could not get status of {servername}",
+                extra={"uuidcode": servername},
+                exc_info=e,
+            )
+            if isinstance(e, MgrException):
+                errors[servername] = {"error": e.args[0], "detailed_error": e.args[1]}
+            else:
+                errors[servername] = {
+                    "error": "Unexpected Error",
+                    "detailed_error": str(e),
+                }
+        for servername in unfinished:
+            errors[servername] = {
+                "error": "Timeout",
+                "detailed_error": "Status not available within the deadline",
+            }
+        return Response({"services": results, "errors": errors})
+
+    @action(detail=True, methods=["get"], url_path="logs")
+    @request_decorator
+    def logs(self, request, *args, **kwargs):
+        # A stream would keep a gunicorn thread busy for minutes, so the
+        # logs are only streamed by the async views (ASYNC_VIEWS=true)
+        return Response(
+            {
+                "error": "Not implemented",
+                "detailed_error": "Log streams need ASYNC_VIEWS=true",
+            },
+            status=501,
+        )
@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+
+"""
+Compares the old json.dumps/str.replace/json.loads round trip of
+_jd_replace with the structure walking Placeholders.render_json().
+
+Run it from the repository root against the job descriptions you want to
+measure, the largest templates are used:
+
+    PYTHONPATH=web python web/tests/benchmarks/jd_replace.py \\
+        web/tests/config/job_descriptions --top 5
+"""
+
+
+def find_templates(base_directory, template_filename, top):
+    templates = []
+    for dirpath, _, filenames in os.walk(base_directory):
+        if template_filename in filenames:
+            path = os.path.join(dirpath, template_filename)
+            templates.append((os.path.getsize(path), path))
+    return [path for _, path in sorted(templates, reverse=True)[:top]]
+
+
+def replace_pairs(jd, placeholders_pattern, env_size):
+    # A value for every placeholder in the template plus a typical env
+    pairs = []
+    for key in sorted(set(placeholders_pattern.findall(json.dumps(jd)))):
+        pairs.append((key, f"value of {key}"))
+    for i in range(env_size):
+        pairs.append((f"JUPYTERHUB_ENV_{i}", f"env value {i}"))
+    return pairs
+
+
+def main():
+    import django
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jupyterjsc_unicoremgr.settings")
+    django.setup()
+
+    from services.utils.placeholders import _pattern
+    from services.utils.placeholders import Placeholders
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the job description placeholder replacement"
+    )
+    parser.add_argument(
+        "base_directory", nargs="?", default="web/tests/config/job_descriptions"
+    )
+    parser.add_argument("--template-filename", default="job_description.json.template")
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--env-size", type=int, default=40)
+    parser.add_argument("--indicators", nargs=2, default=["<", ">"])
+    args = parser.parse_args()
+
+    paths = find_templates(args.base_directory, args.template_filename, args.top)
+    if not paths:
+        print(f"No {args.template_filename} found in {args.base_directory}")
+        return 1
+
+    print(
+        f"{'template':60} {'bytes':>8} {'round trip':>12} {'walk':>12} {'speedup':>8}"
+    )
+    for path in paths:
+        with open(path, "r") as f:
+            jd = json.load(f)
+        placeholders = Placeholders(
+            args.indicators,
+            replace_pairs(jd, _pattern(*args.indicators), args.env_size),
+        )
+
+        def round_trip():
+            return json.loads(placeholders.render(json.dumps(jd)))
+
+        def walk():
+            return placeholders.render_json(jd, cache_tokens=True)
+
+        if round_trip() != walk():
+            print(f"{path}: results differ")
+        round_trip_time = min(timeit.repeat(round_trip, number=args.number, repeat=3))
+        walk_time = min(timeit.repeat(walk, number=args.number, repeat=3))
+        print(
+            f"{os.path.relpath(path, args.base_directory)[-60:]:60} "
+            f"{os.path.getsize(path):>8} "
+            f"{round_trip_time / args.number * 1e6:>10.1f}us "
+            f"{walk_time / args.number * 1e6:>10.1f}us "
+            f"{round_trip_time / walk_time:>7.2f}x"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import argparse
+import html
+import os
+import sys
+import timeit
+import tracemalloc
+
+"""
+Compares the previous _prettify_error_logs, which split the whole output
+into lines, with the backward search of services.utils.tail.last_lines().
+
+Run it from the repository root, e.g. for 10 MB of output:
+
+    PYTHONPATH=web python web/tests/benchmarks/prettify_logs.py \\
+        --size 10000000 --lines 20
+"""
+
+
+def prettify_split(log_list, join_s, lines, summary):
+    # _prettify_error_logs before the backward search
+    log_list = log_list.split("\n")
+    log_list_short = log_list[-lines:]
+    if lines < len(log_list):
+        log_list_short.insert(0, "...")
+    logs_s = join_s.join(map(lambda x: html.escape(x), log_list_short))
+    return f"<details><summary>{summary}</summary>{logs_s}</details>"
+
+
+def make_output(size, line_length):
+    line = ("x" * (line_length - 4) + " <ä>")[:line_length]
+    count = size // (len(line.encode()) + 1) + 1
+    return "\n".join(f"{i} {line}" for i in range(count))
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    import django
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "jupyterjsc_unicoremgr.settings")
+    django.setup()
+
+    from services.utils.pyunicore import _prettify_error_logs
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the line tail of stdout/stderr"
+    )
+    parser.add_argument("--size", type=int, default=10_000_000)
+    parser.add_argument("--line-length", type=int, default=100)
+    parser.add_argument("--lines", type=int, default=20)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+
+    output = make_output(args.size, args.line_length)
+    # Cut at an arbitrary byte, like a tail read
+    data = output.encode()[-args.size :]
+
+    def split():
+        return prettify_split(output, "<br>", args.lines, "Output")
+
+    def backward():
+        return _prettify_error_logs(output, "<br>", args.lines, "Output")
+
+    def backward_bytes():
+        return _prettify_error_logs(data, "<br>", args.lines, "Output")
+
+    if split() != backward():
+        print("results differ")
+        return 1
+
+    print(f"{len(output.encode())} bytes, last {args.lines} lines")
+    print(f"{'':16} {'time':>12} {'peak memory':>14}")
+    for name, func in [
+        ("split", split),
+        ("backward", backward),
+        ("backward bytes", backward_bytes),
+    ]:
+        seconds = min(timeit.repeat(func, number=args.number, repeat=3))
+        print(
+            f"{name:16} {seconds / args.number * 1e3:>10.3f}ms "
+            f"{peak_memory(func) / 1e6:>12.3f}MB"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,7 @@
+from django.urls import include
+from django.urls import path
+from jupyterjsc_unicoremgr.urls import urlpatterns as default_urlpatterns
+from services.urls import async_urlpatterns
+
+# The URLs with ASYNC_VIEWS=true
+urlpatterns = [path("api/", include(async_urlpatterns))] + default_urlpatterns
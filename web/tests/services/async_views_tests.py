@@ -0,0 +1,520 @@
+import asyncio
+import json
+import time
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.test import override_settings
+from services.models import ServicesModel
+from services.models import StopTaskModel
+from services.utils import aio
+from services.utils import MgrException
+from services.utils import pyunicore
+from services.utils.breaker import CircuitOpen
+from services.utils.logstream import event_stream_response
+from services.utils.logstream import KEEP_ALIVE
+from services.utils.logstream import sse_event
+from services.utils.logstream import stream_limiter
+from tests.user_credentials import UserCredentials
+
+from .mocks import clear_unicore_state
+from .mocks import config_mock
+from .mocks import config_mock_data
+from .mocks import mock_config
+from .mocks import MockUnicoreServer
+
+
+@override_settings(ROOT_URLCONF="tests.services.async_urls")
+@mock.patch("services.async_views._config", side_effect=config_mock)
+class AsyncServiceViewTests(UserCredentials):
+    url = "/api/services/"
+    simple_request_data = {
+        "user_options": {
+            "system": "DEMO-SITE",
+            "service": "JupyterLab/simple",
+            "project": "demoproject",
+            "partition": "LoginNode",
+            "account": "demouser",
+        },
+        "env": {
+            "JUPYTERHUB_USER_ID": 17,
+            "JUPYTERHUB_API_TOKEN": "secret",
+            "JUPYTERHUB_STATUS_URL": "http://jhub:8000",
+        },
+        "start_id": "abcdefgh",
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.server = MockUnicoreServer()
+        self.client_patch = mock.patch(
+            "services.utils.aio._get_async_client", side_effect=self.server.client
+        )
+        self.client_patch.start()
+        self.headers = {
+            "authorization": f"token {self.user_authorized.auth_token.key}",
+            "access-token": "ZGVtb3VzZXI6dGVzdDEyMw==",
+        }
+
+    def tearDown(self):
+        self.client_patch.stop()
+        return super().tearDown()
+
+    async def create(self):
+        r = await self.async_client.post(
+            self.url,
+            data=json.dumps(self.simple_request_data),
+            content_type="application/json",
+            **self.headers,
+        )
+        self.assertEqual(r.status_code, 201)
+        return r.json()["servername"]
+
+    async def test_create(self, config_mocked):
+        servername = await self.create()
+        service = await sync_to_async(ServicesModel.objects.get)(servername=servername)
+        self.assertTrue(service.resource_url.startswith(self.server.site_url))
+        self.assertIn(("POST", f"{self.server.site_url}/jobs"), self.server.requests)
+
+    async def test_retrieve(self, config_mocked):
+        servername = await self.create()
+        r = await self.async_client.get(f"{self.url}{servername}/", **self.headers)
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.json()["running"])
+        self.assertEqual(r.json()["status"], "RUNNING")
+        self.assertEqual(r.json()["servername"], servername)
+
+        self.server.status = "FAILED"
+        r = await self.async_client.get(f"{self.url}{servername}/", **self.headers)
+        self.assertEqual(r.status_code, 200)
+        self.assertFalse(r.json()["running"])
+        self.assertEqual(r.json()["status"], "FAILED")
+        self.assertIn("line2", r.json()["details"]["detailed_error"])
+        self.assertIn("stderr is empty", r.json()["details"]["detailed_error"])
+
+    async def test_destroy(self, config_mocked):
+        servername = await self.create()
+        r = await self.async_client.delete(f"{self.url}{servername}/", **self.headers)
+        self.assertEqual(r.status_code, 204)
+        # Stopped within the request, the stop queue is opt-in
+        self.assertEqual(self.server.requests[-1][0], "POST")
+        self.assertTrue(self.server.requests[-1][1].endswith("/actions/abort"))
+        self.assertFalse(
+            await sync_to_async(
+                StopTaskModel.objects.filter(servername=servername).exists
+            )()
+        )
+
+    async def test_destroy_action_link(self, config_mocked):
+        servername = await self.create()
+        self.server.actions_path = "rest/job-actions"
+        r = await self.async_client.delete(f"{self.url}{servername}/", **self.headers)
+        self.assertEqual(r.status_code, 204)
+        # The abort URL is taken from the job's links
+        self.assertEqual(self.server.requests[-1][0], "POST")
+        self.assertTrue(self.server.requests[-1][1].endswith("/rest/job-actions/abort"))
+
+    async def test_destroy_queue(self, config_mocked):
+        config = config_mock(stop_queue={"enabled": True})
+        config_mocked.side_effect = None
+        config_mocked.return_value = config
+        servername = await self.create()
+        r = await self.async_client.delete(f"{self.url}{servername}/", **self.headers)
+        self.assertEqual(r.status_code, 204)
+        # Stopped by the stop task workers
+        task = await sync_to_async(StopTaskModel.objects.get)(servername=servername)
+        self.assertEqual(task.state, StopTaskModel.PENDING)
+        self.assertFalse(
+            await sync_to_async(
+                ServicesModel.objects.filter(servername=servername).exists
+            )()
+        )
+
+    async def test_list(self, config_mocked):
+        servername = await self.create()
+        r = await self.async_client.get(self.url, **self.headers)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([x["servername"] for x in r.json()], [servername])
+
+    async def test_not_found(self, config_mocked):
+        r = await self.async_client.get(f"{self.url}unknown/", **self.headers)
+        self.assertEqual(r.status_code, 404)
+
+    async def test_unauthorized(self, config_mocked):
+        headers = dict(self.headers)
+        headers["authorization"] = f"token {self.user_unauthorized.auth_token.key}"
+        r = await self.async_client.get(self.url, **headers)
+        self.assertEqual(r.status_code, 403)
+        del headers["authorization"]
+        r = await self.async_client.get(self.url, **headers)
+        self.assertEqual(r.status_code, 401)
+
+    async def test_invalid_input_data(self, config_mocked):
+        r = await self.async_client.post(
+            self.url, data="{}", content_type="application/json", **self.headers
+        )
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.json(), ["Missing key in input data: env"])
+
+    async def test_unicore_error(self, config_mocked):
+        self.server.fail = True
+        r = await self.async_client.post(
+            self.url,
+            data=json.dumps(self.simple_request_data),
+            content_type="application/json",
+            **self.headers,
+        )
+        self.assertEqual(r.status_code, 500)
+        self.assertIn("503 Server Error", r.json()["detailed_error"])
+
+    async def test_logs(self, config_mocked):
+        config = config_mock(log_stream={"interval": 0, "max_per_user": 1})
+        config_mocked.side_effect = None
+        config_mocked.return_value = config
+        servername = await self.create()
+        self.server.status = "FAILED"
+        r = await self.async_client.get(
+            f"{self.url}{servername}/logs/?stream=stdout", **self.headers
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r["Content-Type"], "text/event-stream")
+        self.assertEqual(stream_limiter.streams("authorized"), 1)
+        # One open stream per user
+        r2 = await self.async_client.get(
+            f"{self.url}{servername}/logs/?stream=stdout", **self.headers
+        )
+        self.assertEqual(r2.status_code, 429)
+        events = [event async for event in r.async_streaming_content]
+        r.close()
+        self.assertEqual(
+            events,
+            [
+                b"id: 12\ndata: line1\ndata: line2\ndata: \n\n",
+                b"event: end\nid: 12\ndata: FAILED\n\n",
+            ],
+        )
+        self.assertEqual(stream_limiter.streams("authorized"), 0)
+        # Open streams of all users per worker
+        config_mocked.return_value = config_mock(log_stream={"max_per_worker": 0})
+        r = await self.async_client.get(
+            f"{self.url}{servername}/logs/?stream=stdout", **self.headers
+        )
+        self.assertEqual(r.status_code, 429)
+        config_mocked.return_value = config
+        r = await self.async_client.get(
+            f"{self.url}{servername}/logs/?stream=x", **self.headers
+        )
+        self.assertEqual(r.status_code, 400)
+
+
+class AsyncUnicoreTests(UserCredentials):
+    def test_concurrent_status(self):
+        # A slow site delays the requests, but doesn't serialize them
+        server = MockUnicoreServer(delay=0.2)
+        instance_dict = {
+            "resource_url": f"{server.site_url}/jobs/abc",
+            "user_options": {"system": "DEMO-SITE"},
+        }
+
+        async def status_many():
+            with mock.patch(
+                "services.utils.aio._get_async_client", side_effect=server.client
+            ):
+                return await asyncio.gather(
+                    *[
+                        aio.status_service(
+                            config_mock(),
+                            instance_dict,
+                            {"access-token": "secret"},
+                            {"uuidcode": str(i)},
+                        )
+                        for i in range(50)
+                    ]
+                )
+
+        tic = time.time()
+        results = asyncio.run(status_many())
+        self.assertLess(time.time() - tic, 2)
+        self.assertEqual(len(results), 50)
+        self.assertTrue(all(x["status"] == "RUNNING" for x in results))
+
+    def test_bss_details(self):
+        server = MockUnicoreServer()
+        data = config_mock_data()
+        data["systems"]["default_system"]["get_bss_details"] = True
+        instance_dict = {
+            "resource_url": f"{server.site_url}/jobs/abc",
+            "user_options": {"system": "DEMO-SITE"},
+        }
+
+        async def status():
+            with mock.patch(
+                "services.utils.aio._get_async_client", side_effect=server.client
+            ):
+                return await aio.status_service(
+                    mock_config(data),
+                    instance_dict,
+                    {"access-token": "secret"},
+                    {"uuidcode": "abc"},
+                )
+
+        # Read from the details link of the job properties
+        self.assertEqual(asyncio.run(status())["bss_details"], {"partition": "batch"})
+        self.assertIn(("GET", f"{server.site_url}/jobs/abc/details"), server.requests)
+
+    def test_authentication_failed_cached_site(self):
+        server = MockUnicoreServer()
+        server.unauthorized = True
+        data = config_mock_data()
+        data["error_messages"] = {
+            "services.utils.pyunicore._get_client": "Could not authenticate."
+        }
+        config = mock_config(data)
+        initial_data = AsyncServiceViewTests.simple_request_data
+        instance_dict = {"user_options": initial_data["user_options"]}
+        clear_unicore_state()
+        pyunicore.site_cache.add(
+            server.site_url, {"_links": {"jobs": {"href": f"{server.site_url}/jobs"}}}
+        )
+
+        async def start():
+            with mock.patch(
+                "services.utils.aio._get_async_client", side_effect=server.client
+            ):
+                await aio.start_service(
+                    config,
+                    initial_data,
+                    instance_dict,
+                    {"access-token": "expired"},
+                    "authorized",
+                    {},
+                )
+
+        # The site is not fetched again, the rejected submission is reported
+        with self.assertRaises(MgrException) as cm:
+            asyncio.run(start())
+        self.assertEqual(
+            cm.exception.args,
+            (
+                "Could not authenticate.",
+                f"Failure to authenticate at {server.site_url}",
+            ),
+        )
+        self.assertEqual(server.requests, [("POST", f"{server.site_url}/jobs")])
+
+    def test_circuit_opened_during_call(self):
+        server = MockUnicoreServer()
+        data = config_mock_data()
+        data["error_messages"] = {
+            "services.utils.pyunicore.circuit_open": "DEMO-SITE not available."
+        }
+        config = mock_config(data)
+        initial_data = AsyncServiceViewTests.simple_request_data
+        instance_dict = {
+            "id": 1,
+            "servername": "circuit",
+            "resource_url": f"{server.site_url}/jobs/abc",
+            "user_options": initial_data["user_options"],
+        }
+        custom_headers = {"access-token": "secret"}
+        # Only the submission of the job fails
+        clear_unicore_state()
+        pyunicore.site_cache.add(
+            server.site_url, {"_links": {"jobs": {"href": f"{server.site_url}/jobs"}}}
+        )
+
+        async def calls():
+            errors = []
+            with mock.patch(
+                "services.utils.aio._get_async_client", side_effect=server.client
+            ), mock.patch(
+                "services.utils.aio.AsyncTransport._send",
+                side_effect=CircuitOpen("Circuit breaker for DEMO-SITE is open"),
+            ):
+                for call in [
+                    aio.start_service(
+                        config,
+                        initial_data,
+                        instance_dict,
+                        custom_headers,
+                        "authorized",
+                        {},
+                    ),
+                    aio.status_service(config, instance_dict, custom_headers, {}),
+                    aio.stop_service(config, instance_dict, custom_headers, {}),
+                ]:
+                    try:
+                        await call
+                    except MgrException as e:
+                        errors.append(e.args[0])
+            return errors
+
+        self.assertEqual(asyncio.run(calls()), ["DEMO-SITE not available."] * 3)
+
+    def test_tail_read(self):
+        server = MockUnicoreServer()
+        server.files["stdout"] = b"x" * 100 + "ü".encode() + b"end"
+        working_dir_url = f"{server.site_url}/jobs/abc/storage"
+
+        async def tail(max_bytes):
+            with mock.patch(
+                "services.utils.aio._get_async_client", side_effect=server.client
+            ):
+                transport = aio._get_transport(
+                    config_mock(),
+                    {"user_options": {"system": "DEMO-SITE"}},
+                    {"access-token": "secret"},
+                )
+                return await asyncio.gather(
+                    aio._get_file_output(
+                        transport, working_dir_url, "stdout", max_bytes
+                    ),
+                    aio._get_file_output(
+                        transport, working_dir_url, "stderr", max_bytes
+                    ),
+                )
+
+        # The cut multibyte character is dropped. The empty stderr can't be
+        # answered with a range.
+        self.assertEqual(asyncio.run(tail(4)), ["end", "stderr is empty"])
+        self.assertEqual(len(server.requests), 3)
+        server.suffix_ranges = False
+        server.requests = []
+        self.assertEqual(asyncio.run(tail(5)), ["üend", "stderr is empty"])
+        self.assertEqual(len(server.requests), 5)
+        # Only the tail of a body without range is kept
+        server.ignore_ranges = True
+        self.assertEqual(asyncio.run(tail(5)), ["üend", "stderr is empty"])
+
+    def stream_logs(self, server, config, file, offset, sleep=None):
+        instance_dict = {
+            "resource_url": f"{server.site_url}/jobs/abc",
+            "user_options": {"system": "DEMO-SITE"},
+        }
+
+        async def stream():
+            with mock.patch(
+                "services.utils.aio._get_async_client", side_effect=server.client
+            ), mock.patch("services.utils.aio.asyncio.sleep", side_effect=sleep):
+                return [
+                    event
+                    async for event in aio.stream_logs(
+                        config,
+                        instance_dict,
+                        {"access-token": "secret"},
+                        file,
+                        offset,
+                        {},
+                    )
+                ]
+
+        return asyncio.run(stream())
+
+    def test_stream_logs(self):
+        server = MockUnicoreServer()
+        server.files["stdout"] = b"line1\n"
+        delays = []
+
+        async def sleep(delay):
+            delays.append(delay)
+            if len(delays) == 1:
+                server.files["stdout"] += b"line2\n"
+            elif len(delays) == 3:
+                server.files["stdout"] += b"line3\n"
+                server.status = "FAILED"
+
+        events = self.stream_logs(server, config_mock(), "stdout", None, sleep)
+        self.assertEqual(
+            events,
+            [
+                sse_event("line1\n", event_id=6),
+                sse_event("line2\n", event_id=12),
+                KEEP_ALIVE,
+                sse_event("line3\n", event_id=18),
+                sse_event("FAILED", event="end", event_id=18),
+            ],
+        )
+        self.assertEqual(delays, [1, 1, 1, 1])
+
+    def test_stream_logs_resume(self):
+        server = MockUnicoreServer(status="SUCCESSFUL")
+        server.files["stderr"] = b"line1\nline2\n"
+        events = self.stream_logs(server, config_mock(), "stderr", 6)
+        self.assertEqual(
+            events,
+            [
+                sse_event("line2\n", event_id=12),
+                sse_event("SUCCESSFUL", event="end", event_id=12),
+            ],
+        )
+
+    def test_stream_logs_max_duration(self):
+        server = MockUnicoreServer()
+        server.files["stdout"] = b"line1\n"
+        config = config_mock(log_stream={"max_duration": 0})
+        events = self.stream_logs(server, config, "stdout", None)
+        self.assertEqual(events, [sse_event("line1\n", event_id=6)])
+
+    def test_stream_logs_error(self):
+        server = MockUnicoreServer()
+        server.fail = True
+        events = self.stream_logs(server, config_mock(), "stdout", None)
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].startswith(b"event: error\n"))
+        self.assertIn(b"503", events[0])
+
+    def test_async_client_per_loop(self):
+        async def clients():
+            return (
+                aio._get_async_client(False, 120),
+                aio._get_async_client(False, 120),
+                aio._get_async_client(False, 30),
+            )
+
+        first = asyncio.run(clients())
+        self.assertIs(first[0], first[1])
+        self.assertIsNot(first[0], first[2])
+        second = asyncio.run(clients())
+        self.assertIsNot(first[0], second[0])
+
+    def test_event_stream_disconnect(self):
+        from jupyterjsc_unicoremgr import asgi
+
+        closed = []
+
+        async def events():
+            try:
+                yield b"data: 1\n\n"
+                await asyncio.sleep(60)
+                yield b"data: 2\n\n"
+            finally:
+                closed.append("events")
+
+        async def stream():
+            messages = []
+            disconnected = asyncio.Event()
+
+            async def send(message):
+                messages.append(message)
+
+            async def receive():
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+
+            response = event_stream_response(events(), lambda: closed.append("release"))
+            asgi._receive.set(receive)
+            task = asyncio.ensure_future(
+                asgi.ASGIHandler().send_response(response, send)
+            )
+            while len(messages) < 2:
+                await asyncio.sleep(0)
+            disconnected.set()
+            await asyncio.wait_for(task, 5)
+            return messages
+
+        messages = asyncio.run(stream())
+        self.assertEqual(messages[0]["status"], 200)
+        self.assertIn((b"Cache-Control", b"no-cache"), messages[0]["headers"])
+        self.assertEqual(messages[1]["body"], b"data: 1\n\n")
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(closed, ["events", "release"])
@@ -1,8 +1,27 @@
+import asyncio
 import os
 import uuid
+from unittest import mock
 
+import httpx
+from services.utils import _config_versions
+from services.utils import pyunicore
+from services.utils.config import Config
 
-def config_mock():
+
+def mock_config(data):
+    # Like the configurations _config() returns
+    return Config(data, version=next(_config_versions))
+
+
+def clear_unicore_state():
+    # Pooled transports, cached sites and open circuits live in the worker
+    pyunicore.transport_pool.clear()
+    pyunicore.site_cache.clear()
+    pyunicore.circuit_breakers.clear()
+
+
+def config_mock_data():
     return {
         "systems": {
             "mapping": {
@@ -82,243 +101,253 @@ def config_mock():
     }
 
 
+def config_mock(**overrides):
+    return mock_config(dict(config_mock_data(), **overrides))
+
+
 def config_mock_suffix():
-    return {
-        "unicore_status_message_suffix": {
-            "MockException": "Suffix",
-            "NewJob Exception.": "NewJobSuffix",
-        },
-        "systems": {
-            "mapping": {
-                "system": {"DEMO-SITE": "default_system"},
-                "skip": {
-                    "stage": ["stage1", "stage2"],
-                    "system": ["DEMO-SITE", "SYSTEM2"],
-                },
-                "replace": {
-                    "stage": {
-                        "stage1": {"stage_stuff": "stage1"},
-                        "stage2": {"stage_stuff": "stage2"},
-                    },
-                    "system": {"DEMO-SITE": {}, "SYSTEM2": {}},
-                },
+    return mock_config(
+        {
+            "unicore_status_message_suffix": {
+                "MockException": "Suffix",
+                "NewJob Exception.": "NewJobSuffix",
             },
-            "DEMO-SITE": {
-                "site_url": "https://localhost:8080/DEMO-SITE/rest/core",
-                "interactive_partitions": {"LoginNode": "localost"},
-                "hooks": {
-                    "load_project_specific_kernel": {
-                        "project": ["training1904"],
-                        "partition": ["devel"],
-                    }
-                },
-            },
-            "default_system": {
-                "backend_id_env_name": "JUPYTER_BACKEND_ID",
-                "remote_nodes": ["demo_site"],
-                "max_start_attempts": 3,
-                "pyunicore": {
-                    "job_archive": "/tmp/job-archive",
-                    "transport": {
-                        "certificate_path": False,
-                        "oidc": False,
-                        "timeout": 120,
-                        "set_preferences": False,
+            "systems": {
+                "mapping": {
+                    "system": {"DEMO-SITE": "default_system"},
+                    "skip": {
+                        "stage": ["stage1", "stage2"],
+                        "system": ["DEMO-SITE", "SYSTEM2"],
                     },
-                    "cleanup": {
-                        "enabled": True,
-                        "tags": ["Jupyter-JSC"],
-                        "max_per_start": 2,
+                    "replace": {
+                        "stage": {
+                            "stage1": {"stage_stuff": "stage1"},
+                            "stage2": {"stage_stuff": "stage2"},
+                        },
+                        "system": {"DEMO-SITE": {}, "SYSTEM2": {}},
                     },
-                    "job_description": {
-                        "base_directory": "web/tests/config/job_descriptions",
-                        "template_filename": "job_description.json.template",
-                        "replace_indicators": ["<", ">"],
-                        "input": {
-                            "directory_name": "input",
-                            "skip_prefixs": ["skip_"],
-                            "skip_suffixs": [".swp"],
+                },
+                "DEMO-SITE": {
+                    "site_url": "https://localhost:8080/DEMO-SITE/rest/core",
+                    "interactive_partitions": {"LoginNode": "localost"},
+                    "hooks": {
+                        "load_project_specific_kernel": {
+                            "project": ["training1904"],
+                            "partition": ["devel"],
+                        }
+                    },
+                },
+                "default_system": {
+                    "backend_id_env_name": "JUPYTER_BACKEND_ID",
+                    "remote_nodes": ["demo_site"],
+                    "max_start_attempts": 3,
+                    "pyunicore": {
+                        "job_archive": "/tmp/job-archive",
+                        "transport": {
+                            "certificate_path": False,
+                            "oidc": False,
+                            "timeout": 120,
+                            "set_preferences": False,
                         },
-                        "input_directory_name": "input",
-                        "resource_mapping": {
-                            "resource_nodes": "Nodes",
-                            "resource_Runtime": "Runtime",
-                            "resource_gpus": "GPUs",
+                        "cleanup": {
+                            "enabled": True,
+                            "tags": ["Jupyter-JSC"],
+                            "max_per_start": 2,
                         },
-                        "unicore_keywords": {
-                            "type_key": "Job type",
-                            "interactive": {
-                                "type_value": "interactive",
-                                "node_key": "Login node",
+                        "job_description": {
+                            "base_directory": "web/tests/config/job_descriptions",
+                            "template_filename": "job_description.json.template",
+                            "replace_indicators": ["<", ">"],
+                            "input": {
+                                "directory_name": "input",
+                                "skip_prefixs": ["skip_"],
+                                "skip_suffixs": [".swp"],
                             },
-                            "normal": {
-                                "type_value": "normal",
-                                "resources_key": "Resources",
-                                "queue_key": "Queue",
-                                "set_queue": False,
+                            "input_directory_name": "input",
+                            "resource_mapping": {
+                                "resource_nodes": "Nodes",
+                                "resource_Runtime": "Runtime",
+                                "resource_gpus": "GPUs",
+                            },
+                            "unicore_keywords": {
+                                "type_key": "Job type",
+                                "interactive": {
+                                    "type_value": "interactive",
+                                    "node_key": "Login node",
+                                },
+                                "normal": {
+                                    "type_value": "normal",
+                                    "resources_key": "Resources",
+                                    "queue_key": "Queue",
+                                    "set_queue": False,
+                                },
                             },
                         },
                     },
                 },
             },
-        },
-        "credential_mapping": {"authorized": "default_credential"},
-    }
+            "credential_mapping": {"authorized": "default_credential"},
+        }
+    )
 
 
 def config_mock_prefix():
-    return {
-        "unicore_status_message_prefix": {
-            "MockException": "Prefix.",
-            "NewJob Exception.": "NewJobPrefix",
-        },
-        "systems": {
-            "mapping": {
-                "system": {"DEMO-SITE": "default_system"},
-                "skip": {
-                    "stage": ["stage1", "stage2"],
-                    "system": ["DEMO-SITE", "SYSTEM2"],
-                },
-                "replace": {
-                    "stage": {
-                        "stage1": {"stage_stuff": "stage1"},
-                        "stage2": {"stage_stuff": "stage2"},
-                    },
-                    "system": {"DEMO-SITE": {}, "SYSTEM2": {}},
-                },
-            },
-            "DEMO-SITE": {
-                "site_url": "https://localhost:8080/DEMO-SITE/rest/core",
-                "interactive_partitions": {"LoginNode": "localost"},
-                "hooks": {
-                    "load_project_specific_kernel": {
-                        "project": ["training1904"],
-                        "partition": ["devel"],
-                    }
-                },
+    return mock_config(
+        {
+            "unicore_status_message_prefix": {
+                "MockException": "Prefix.",
+                "NewJob Exception.": "NewJobPrefix",
             },
-            "default_system": {
-                "backend_id_env_name": "JUPYTER_BACKEND_ID",
-                "remote_nodes": ["demo_site"],
-                "max_start_attempts": 3,
-                "pyunicore": {
-                    "job_archive": "/tmp/job-archive",
-                    "transport": {
-                        "certificate_path": False,
-                        "oidc": False,
-                        "timeout": 120,
-                        "set_preferences": False,
+            "systems": {
+                "mapping": {
+                    "system": {"DEMO-SITE": "default_system"},
+                    "skip": {
+                        "stage": ["stage1", "stage2"],
+                        "system": ["DEMO-SITE", "SYSTEM2"],
                     },
-                    "cleanup": {
-                        "enabled": True,
-                        "tags": ["Jupyter-JSC"],
-                        "max_per_start": 2,
+                    "replace": {
+                        "stage": {
+                            "stage1": {"stage_stuff": "stage1"},
+                            "stage2": {"stage_stuff": "stage2"},
+                        },
+                        "system": {"DEMO-SITE": {}, "SYSTEM2": {}},
                     },
-                    "job_description": {
-                        "base_directory": "web/tests/config/job_descriptions",
-                        "template_filename": "job_description.json.template",
-                        "replace_indicators": ["<", ">"],
-                        "input": {
-                            "directory_name": "input",
-                            "skip_prefixs": ["skip_"],
-                            "skip_suffixs": [".swp"],
+                },
+                "DEMO-SITE": {
+                    "site_url": "https://localhost:8080/DEMO-SITE/rest/core",
+                    "interactive_partitions": {"LoginNode": "localost"},
+                    "hooks": {
+                        "load_project_specific_kernel": {
+                            "project": ["training1904"],
+                            "partition": ["devel"],
+                        }
+                    },
+                },
+                "default_system": {
+                    "backend_id_env_name": "JUPYTER_BACKEND_ID",
+                    "remote_nodes": ["demo_site"],
+                    "max_start_attempts": 3,
+                    "pyunicore": {
+                        "job_archive": "/tmp/job-archive",
+                        "transport": {
+                            "certificate_path": False,
+                            "oidc": False,
+                            "timeout": 120,
+                            "set_preferences": False,
                         },
-                        "input_directory_name": "input",
-                        "resource_mapping": {
-                            "resource_nodes": "Nodes",
-                            "resource_Runtime": "Runtime",
-                            "resource_gpus": "GPUs",
+                        "cleanup": {
+                            "enabled": True,
+                            "tags": ["Jupyter-JSC"],
+                            "max_per_start": 2,
                         },
-                        "unicore_keywords": {
-                            "type_key": "Job type",
-                            "interactive": {
-                                "type_value": "interactive",
-                                "node_key": "Login node",
+                        "job_description": {
+                            "base_directory": "web/tests/config/job_descriptions",
+                            "template_filename": "job_description.json.template",
+                            "replace_indicators": ["<", ">"],
+                            "input": {
+                                "directory_name": "input",
+                                "skip_prefixs": ["skip_"],
+                                "skip_suffixs": [".swp"],
                             },
-                            "normal": {
-                                "type_value": "normal",
-                                "resources_key": "Resources",
-                                "queue_key": "Queue",
-                                "set_queue": False,
+                            "input_directory_name": "input",
+                            "resource_mapping": {
+                                "resource_nodes": "Nodes",
+                                "resource_Runtime": "Runtime",
+                                "resource_gpus": "GPUs",
+                            },
+                            "unicore_keywords": {
+                                "type_key": "Job type",
+                                "interactive": {
+                                    "type_value": "interactive",
+                                    "node_key": "Login node",
+                                },
+                                "normal": {
+                                    "type_value": "normal",
+                                    "resources_key": "Resources",
+                                    "queue_key": "Queue",
+                                    "set_queue": False,
+                                },
                             },
                         },
                     },
                 },
             },
-        },
-        "credential_mapping": {"authorized": "default_credential"},
-    }
+            "credential_mapping": {"authorized": "default_credential"},
+        }
+    )
 
 
 def config_mock_mapped():
-    return {
-        "systems": {
-            "mapping": {
-                "replace_stage_specific": {
-                    "stage1": {"stage_stuff": "stage1"},
-                    "stage2": {"stage_stuff": "stage2"},
-                },
-                "replace_system_specific": {"DEMO-SITE": {}, "SYSTEM2": {}},
-            },
-            "DEMO-SITE": {
-                "backend_id_env_name": "JUPYTER_BACKEND_ID",
-                "site_url": "https://localhost:8080/DEMO-SITE/rest/core",
-                "remote_nodes": ["demo_site"],
-                "max_start_attempts": 3,
-                "pyunicore": {
-                    "job_archive": "/tmp/job-archive",
-                    "transport": {
-                        "certificate_path": False,
-                        "oidc": False,
-                        "timeout": 120,
-                        "set_preferences": False,
-                    },
-                    "cleanup": {
-                        "enabled": True,
-                        "tags": ["Jupyter-JSC"],
-                        "max_per_start": 2,
+    return mock_config(
+        {
+            "systems": {
+                "mapping": {
+                    "replace_stage_specific": {
+                        "stage1": {"stage_stuff": "stage1"},
+                        "stage2": {"stage_stuff": "stage2"},
                     },
-                    "job_description": {
-                        "base_directory": "web/tests/config/job_descriptions",
-                        "template_filename": "job_description.json.template",
-                        "replace_indicators": ["<", ">"],
-                        "input": {
-                            "directory_name": "input",
-                            "skip_prefixs": ["skip_"],
-                            "skip_suffixs": [".swp"],
-                        },
-                        "hooks": {
-                            "load_project_specific_kernel": {
-                                "project": ["training1904"],
-                                "partition": ["devel"],
-                            }
+                    "replace_system_specific": {"DEMO-SITE": {}, "SYSTEM2": {}},
+                },
+                "DEMO-SITE": {
+                    "backend_id_env_name": "JUPYTER_BACKEND_ID",
+                    "site_url": "https://localhost:8080/DEMO-SITE/rest/core",
+                    "remote_nodes": ["demo_site"],
+                    "max_start_attempts": 3,
+                    "pyunicore": {
+                        "job_archive": "/tmp/job-archive",
+                        "transport": {
+                            "certificate_path": False,
+                            "oidc": False,
+                            "timeout": 120,
+                            "set_preferences": False,
                         },
-                        "input_directory_name": "input",
-                        "resource_mapping": {
-                            "resource_nodes": "Nodes",
-                            "resource_Runtime": "Runtime",
-                            "resource_gpus": "GPUs",
+                        "cleanup": {
+                            "enabled": True,
+                            "tags": ["Jupyter-JSC"],
+                            "max_per_start": 2,
                         },
-                        "interactive_partitions": {"LoginNode": "localost"},
-                        "unicore_keywords": {
-                            "type_key": "Job type",
-                            "interactive": {
-                                "type_value": "interactive",
-                                "node_key": "Login node",
+                        "job_description": {
+                            "base_directory": "web/tests/config/job_descriptions",
+                            "template_filename": "job_description.json.template",
+                            "replace_indicators": ["<", ">"],
+                            "input": {
+                                "directory_name": "input",
+                                "skip_prefixs": ["skip_"],
+                                "skip_suffixs": [".swp"],
                             },
-                            "normal": {
-                                "type_value": "normal",
-                                "resources_key": "Resources",
-                                "queue_key": "Queue",
-                                "set_queue": False,
+                            "hooks": {
+                                "load_project_specific_kernel": {
+                                    "project": ["training1904"],
+                                    "partition": ["devel"],
+                                }
+                            },
+                            "input_directory_name": "input",
+                            "resource_mapping": {
+                                "resource_nodes": "Nodes",
+                                "resource_Runtime": "Runtime",
+                                "resource_gpus": "GPUs",
+                            },
+                            "interactive_partitions": {"LoginNode": "localost"},
+                            "unicore_keywords": {
+                                "type_key": "Job type",
+                                "interactive": {
+                                    "type_value": "interactive",
+                                    "node_key": "Login node",
+                                },
+                                "normal": {
+                                    "type_value": "normal",
+                                    "resources_key": "Resources",
+                                    "queue_key": "Queue",
+                                    "set_queue": False,
+                                },
                             },
                         },
                     },
                 },
             },
-        },
-        "credential_mapping": {"authorized": "mapped"},
-    }
+            "credential_mapping": {"authorized": "mapped"},
+        }
+    )
 
 
 class MockTransport:
@@ -429,13 +458,109 @@ def mocked_pyunicore_job_init(transport, resource_url):
     return MockJob(transport, resource_url)
 
 
-def mocked_pyunicore_client_newjob_fail(transport, resource_url):
+def mocked_pyunicore_client_newjob_fail(site_cache, transport, resource_url):
     return MockClientNewJobFail(transport, resource_url)
 
 
-def mocked_pyunicore_client_init(transport, site_url):
+def mocked_pyunicore_client_init(site_cache, transport, site_url):
     return MockClient(transport, site_url)
 
 
 def mocked_pass(*args, **kwargs):
     pass
+
+
+class MockUnicoreServer:
+    # Answers the UNICORE REST calls of services.utils.aio (httpx.MockTransport)
+    site_url = "https://localhost:8080/DEMO-SITE/rest/core"
+
+    def __init__(self, status="RUNNING", delay=0):
+        self.status = status
+        self.delay = delay
+        self.fail = False
+        # Rejects job submissions, like a site with an expired token
+        self.unauthorized = False
+        self.suffix_ranges = True
+        self.ignore_ranges = False
+        self.files = {"stdout": b"line1\nline2\n", "stderr": b""}
+        # Sites may put the job actions anywhere, see the job's links
+        self.actions_path = "actions"
+        self.requests = []
+
+    async def handler(self, request):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        url = str(request.url)
+        self.requests.append((request.method, url))
+        if self.fail:
+            return httpx.Response(503, json={"errorMessage": "Site unavailable"})
+        if url == self.site_url:
+            return httpx.Response(
+                200,
+                json={
+                    "client": {"role": {"selected": "user"}},
+                    "_links": {"jobs": {"href": f"{self.site_url}/jobs"}},
+                },
+            )
+        if request.method == "POST" and url == f"{self.site_url}/jobs":
+            if self.unauthorized:
+                return httpx.Response(401, json={"errorMessage": "Unauthorized"})
+            self.job_description = request.read()
+            return httpx.Response(
+                201, headers={"Location": f"{self.site_url}/jobs/{uuid.uuid4().hex}"}
+            )
+        if "/files/" in url:
+            content = self.files[url.rsplit("/", 1)[1]]
+            if self.ignore_ranges:
+                # The whole file, in chunks
+                return httpx.Response(200, content=self.chunks(content))
+            if request.headers["Accept"] == "application/octet-stream":
+                byte_range = request.headers.get("Range", "bytes=0-")[6:]
+                if byte_range.startswith("-"):
+                    if not self.suffix_ranges or not content:
+                        return httpx.Response(416)
+                    start = max(0, len(content) + int(byte_range))
+                    end = len(content) - 1
+                else:
+                    first, last = byte_range.split("-")
+                    start = int(first or 0)
+                    end = min(len(content) - 1, int(last or len(content)))
+                if start >= len(content):
+                    return httpx.Response(416)
+                content_range = f"bytes {start}-{end}/{len(content)}"
+                return httpx.Response(
+                    206,
+                    content=content[start : end + 1],
+                    headers={"Content-Range": content_range},
+                )
+            return httpx.Response(200, json={"size": len(content)})
+        if request.method == "GET" and url.endswith("/details"):
+            return httpx.Response(200, json={"partition": "batch"})
+        if request.method == "GET":
+            return httpx.Response(
+                200,
+                json={
+                    "status": self.status,
+                    "exitCode": 1,
+                    "statusMessage": "Job finished",
+                    "log": ["log1", "log2"],
+                    "_links": {
+                        "workingDirectory": {"href": f"{url}/storage"},
+                        "details": {"href": f"{url}/details"},
+                        "action:start": {"href": f"{url}/{self.actions_path}/start"},
+                        "action:abort": {"href": f"{url}/{self.actions_path}/abort"},
+                    },
+                },
+            )
+        if request.method == "POST" and url.rsplit("/", 1)[-1] in ("start", "abort"):
+            return httpx.Response(200, json={})
+        if request.method == "DELETE":
+            return httpx.Response(204)
+        return httpx.Response(404, json={"errorMessage": "Not found"})
+
+    async def chunks(self, content):
+        for i in range(0, len(content), 10):
+            yield content[i : i + 10]
+
+    def client(self, *args):
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
@@ -1,12 +1,61 @@
+import base64
 import copy
 import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import uuid
+from datetime import timedelta
 from unittest import mock
 
+import services.utils as services_utils
+import requests
+from pyunicore.credentials import AuthenticationFailedException
 from rest_framework.test import APITestCase
+from django.test import override_settings
+from django.utils import timezone
 from services.models import ServicesModel
+from services.models import StatusSnapshotModel
+from services.models import StopTaskModel
 from services.utils import common
 from services.utils import pyunicore
+from services.utils.batch import run_per_site
+from services.utils.breaker import CircuitBreaker
+from services.utils.breaker import CircuitOpen
+from services.utils.cache import directory_signature
+from services.utils.cache import FileCache
+from services.utils.cache import InputDirectory
+from services.utils.download import download_files
+from services.utils.logstream import log_stream_config
+from services.utils.logstream import LogTail
+from services.utils.logstream import sse_event
+from services.utils.logstream import stream_limiter
+from services.utils.config import Config
+from services.utils.config import get_input_files_config
+from services.utils.config import get_system_config
+from services.utils.deadline import deadline
+from services.utils.deadline import DeadlineExceeded
+from services.utils.deadline import remaining
+from services.utils.deadline import tictoc_extra
+from services.utils.placeholders import Placeholders
+from services.utils.poller import save_snapshot
+from services.utils.poller import StatusPoller
+from services.utils.poller import token_store
+from services.utils.sites import get_site_client
+from services.utils.sites import SiteCache
+from services.utils.sites import SiteUnavailable
+from services.utils.tail import keep_tail
+from services.utils.tail import last_lines
+from services.utils.tasks import decrypt_headers
+from services.utils.tasks import enqueue_stop
+from services.utils.tasks import StopTaskWorker
+from services.utils.transports import SessionTransport
+from services.utils.transports import ssl_contexts
+from services.utils.transports import SSLContextAdapter
+from services.utils.transports import token_expiry
+from services.utils.transports import TransportPool
 from tests.services.mocks import MockClient
 from tests.services.mocks import mocked_exception
 from tests.services.mocks import mocked_new_job
@@ -17,7 +66,10 @@ from tests.services.mocks import mocked_pyunicore_transport_init
 from tests.services.mocks import MockJob
 from tests.user_credentials import mocked_requests_post_running
 
+from .mocks import clear_unicore_state
 from .mocks import config_mock
+from .mocks import config_mock_data
+from .mocks import mock_config
 
 
 class JobDescriptionTests(APITestCase):
@@ -101,9 +153,12 @@ class JobDescriptionTests(APITestCase):
         }
     }
 
+    def setUp(self):
+        clear_unicore_state()
+
     def test__jd_template(self):
         jd_template = pyunicore._jd_template(
-            self.config, self.jhub_credential, self.request_data_simple
+            mock_config(self.config), self.jhub_credential, self.request_data_simple
         )
         with open(
             "web/tests/config/job_descriptions/default_credential/JupyterLab/simple/default_system/job_description.json.template",
@@ -116,10 +171,24 @@ class JobDescriptionTests(APITestCase):
         data = copy.deepcopy(self.request_data_simple)
         data["user_options"]["service"] = "JupyterLab/simple-replace"
         data["env"] = {"env_REPLACE_ME": "5"}
-        jd_template = pyunicore._jd_template(self.config, self.jhub_credential, data)
-        jd = pyunicore._jd_replace(self.config, data, jd_template)
+        jd_template = pyunicore._jd_template(
+            mock_config(self.config), self.jhub_credential, data
+        )
+        jd = pyunicore._jd_replace(mock_config(self.config), data, jd_template)
         self.assertEqual(jd["Arguments"], ["Hello World on DEMO-SITE - 5"])
 
+    def test__jd_replace_special_characters(self):
+        data = copy.deepcopy(self.request_data_simple)
+        data["user_options"]["service"] = "JupyterLab/simple-replace"
+        data["env"] = {"env_REPLACE_ME": 'a "quoted" C:\\path'}
+        jd_template = pyunicore._jd_template(
+            mock_config(self.config), self.jhub_credential, data
+        )
+        jd = pyunicore._jd_replace(mock_config(self.config), data, jd_template)
+        self.assertEqual(
+            jd["Arguments"], ['Hello World on DEMO-SITE - a "quoted" C:\\path']
+        )
+
     def test__jd_replace_custom_indicators(self):
         data = copy.deepcopy(self.request_data_simple)
         data["user_options"]["service"] = "JupyterLab/simple-replace-custom-indicators"
@@ -127,15 +196,19 @@ class JobDescriptionTests(APITestCase):
         config["systems"]["default_system"]["pyunicore"]["job_description"][
             "replace_indicators"
         ] = ["<??", "??>"]
-        jd_template = pyunicore._jd_template(config, self.jhub_credential, data)
-        jd = pyunicore._jd_replace(config, data, jd_template)
+        jd_template = pyunicore._jd_template(
+            mock_config(config), self.jhub_credential, data
+        )
+        jd = pyunicore._jd_replace(mock_config(config), data, jd_template)
         self.assertEqual(jd["Arguments"], ["Hello World on DEMO-SITE"])
 
     def test__jd_insert_job_type_interactive(self):
         data = copy.deepcopy(self.request_data_simple)
         data["user_options"]["partition"] = "LoginNode"
-        jd_template = pyunicore._jd_template(self.config, self.jhub_credential, data)
-        jd = pyunicore._jd_insert_job_type(self.config, data, jd_template)
+        jd_template = pyunicore._jd_template(
+            mock_config(self.config), self.jhub_credential, data
+        )
+        jd = pyunicore._jd_insert_job_type(mock_config(self.config), data, jd_template)
         job_type_key = self.config["systems"]["default_system"]["pyunicore"][
             "job_description"
         ]["unicore_keywords"]["type_key"]
@@ -157,20 +230,26 @@ class JobDescriptionTests(APITestCase):
         data = copy.deepcopy(self.request_data_simple)
         data["user_options"]["reservation"] = "None"
         data["user_options"]["partition"] = "batch"
-        jd_template = pyunicore._jd_template(self.config, self.jhub_credential, data)
-        jd = pyunicore._jd_insert_job_type(self.config, data, jd_template)
+        jd_template = pyunicore._jd_template(
+            mock_config(self.config), self.jhub_credential, data
+        )
+        jd = pyunicore._jd_insert_job_type(mock_config(self.config), data, jd_template)
         self.assertTrue("Reservation" not in jd["Resources"].keys())
         data["user_options"]["reservation"] = ""
-        jd_template = pyunicore._jd_template(self.config, self.jhub_credential, data)
-        jd = pyunicore._jd_insert_job_type(self.config, data, jd_template)
+        jd_template = pyunicore._jd_template(
+            mock_config(self.config), self.jhub_credential, data
+        )
+        jd = pyunicore._jd_insert_job_type(mock_config(self.config), data, jd_template)
         self.assertTrue("Reservation" not in jd["Resources"].keys())
 
     def test__jd_reservation_none1(self):
         data = copy.deepcopy(self.request_data_simple)
         data["user_options"]["reservation"] = "None1"
         data["user_options"]["partition"] = "batch"
-        jd_template = pyunicore._jd_template(self.config, self.jhub_credential, data)
-        jd = pyunicore._jd_insert_job_type(self.config, data, jd_template)
+        jd_template = pyunicore._jd_template(
+            mock_config(self.config), self.jhub_credential, data
+        )
+        jd = pyunicore._jd_insert_job_type(mock_config(self.config), data, jd_template)
         self.assertEqual(jd["Resources"]["Reservation"], "None1")
 
     def test__jd_insert_job_type_normal(self):
@@ -179,8 +258,10 @@ class JobDescriptionTests(APITestCase):
         jhub_resource_gpus_value = "4"
         data["user_options"]["partition"] = "devel"
         data["user_options"][jhub_resource_gpus_key] = jhub_resource_gpus_value
-        jd_template = pyunicore._jd_template(self.config, self.jhub_credential, data)
-        jd = pyunicore._jd_insert_job_type(self.config, data, jd_template)
+        jd_template = pyunicore._jd_template(
+            mock_config(self.config), self.jhub_credential, data
+        )
+        jd = pyunicore._jd_insert_job_type(mock_config(self.config), data, jd_template)
         job_type_key = self.config["systems"]["default_system"]["pyunicore"][
             "job_description"
         ]["unicore_keywords"]["type_key"]
@@ -214,8 +295,10 @@ class JobDescriptionTests(APITestCase):
         jhub_resource_gpus_value = "4"
         data["user_options"]["partition"] = "devel"
         data["user_options"][jhub_resource_gpus_key] = jhub_resource_gpus_value
-        jd_template = pyunicore._jd_template(config, self.jhub_credential, data)
-        jd = pyunicore._jd_insert_job_type(config, data, jd_template)
+        jd_template = pyunicore._jd_template(
+            mock_config(config), self.jhub_credential, data
+        )
+        jd = pyunicore._jd_insert_job_type(mock_config(config), data, jd_template)
         job_type_key = self.config["systems"]["default_system"]["pyunicore"][
             "job_description"
         ]["unicore_keywords"]["type_key"]
@@ -245,9 +328,11 @@ class JobDescriptionTests(APITestCase):
         config["systems"]["DEMO-SITE"]["hooks"]["project_kernel"] = {
             "project": "myproject"
         }
-        jd_template = pyunicore._jd_template(config, self.jhub_credential, data)
+        jd_template = pyunicore._jd_template(
+            mock_config(config), self.jhub_credential, data
+        )
         jd = pyunicore._jd_add_input_files(
-            config, self.jhub_credential, data, jd_template
+            mock_config(config), self.jhub_credential, data, jd_template
         )
         imports = jd[
             config["systems"]["default_system"]["pyunicore"]["job_description"][
@@ -275,9 +360,11 @@ class JobDescriptionTests(APITestCase):
         config["systems"]["DEMO-SITE"]["hooks"]["project_kernel"] = {
             "project": "myproject"
         }
-        jd_template = pyunicore._jd_template(config, self.jhub_credential, data)
+        jd_template = pyunicore._jd_template(
+            mock_config(config), self.jhub_credential, data
+        )
         jd = pyunicore._jd_add_input_files(
-            config, self.jhub_credential, data, jd_template
+            mock_config(config), self.jhub_credential, data, jd_template
         )
         imports = jd[
             config["systems"]["default_system"]["pyunicore"]["job_description"][
@@ -305,9 +392,11 @@ class JobDescriptionTests(APITestCase):
         config["systems"]["DEMO-SITE"]["hooks"]["project_kernel"] = {
             "project": "myproject"
         }
-        jd_template = pyunicore._jd_template(config, self.jhub_credential, data)
+        jd_template = pyunicore._jd_template(
+            mock_config(config), self.jhub_credential, data
+        )
         jd = pyunicore._jd_add_input_files(
-            config, self.jhub_credential, data, jd_template
+            mock_config(config), self.jhub_credential, data, jd_template
         )
         imports = jd[
             config["systems"]["default_system"]["pyunicore"]["job_description"][
@@ -338,9 +427,11 @@ class JobDescriptionTests(APITestCase):
         config["systems"]["DEMO-SITE"]["hooks"]["project_kernel"] = {
             "project": "myproject"
         }
-        jd_template = pyunicore._jd_template(config, self.jhub_credential, data)
+        jd_template = pyunicore._jd_template(
+            mock_config(config), self.jhub_credential, data
+        )
         jd = pyunicore._jd_add_input_files(
-            config, self.jhub_credential, data, jd_template
+            mock_config(config), self.jhub_credential, data, jd_template
         )
         imports = jd[
             config["systems"]["default_system"]["pyunicore"]["job_description"][
@@ -373,7 +464,9 @@ class JobDescriptionTests(APITestCase):
         config["systems"]["DEMO-SITE"]["hooks"]["project_kernel"] = {
             "project": "myproject"
         }
-        jd = pyunicore._get_job_description(config, self.jhub_credential, data, {})
+        jd = pyunicore._get_job_description(
+            mock_config(config), self.jhub_credential, data, {}
+        )
         imports = jd[
             config["systems"]["default_system"]["pyunicore"]["job_description"][
                 "unicore_keywords"
@@ -411,7 +504,9 @@ class JobDescriptionTests(APITestCase):
             },
             "credential_mapping": {"authorized": "default_credential"},
         }
-        jd = pyunicore._get_job_description(config, self.jhub_credential, data, {})
+        jd = pyunicore._get_job_description(
+            mock_config(config), self.jhub_credential, data, {}
+        )
         imports = jd["Imports"]
         self.assertEqual(len(imports), 1)
         self.assertEqual(imports[0]["From"], "inline://dummy")
@@ -461,7 +556,7 @@ class JobDescriptionTests(APITestCase):
             "credential_mapping": {"authorized": "default_credential"},
         }
         jd = pyunicore._get_job_description(
-            config, self.jhub_credential, simple_request_data, {}
+            mock_config(config), self.jhub_credential, simple_request_data, {}
         )
         imports = jd["Imports"]
         self.assertEqual(len(imports), 1)
@@ -484,7 +579,7 @@ class PyUnicoreTests(JobDescriptionTests):
         return data
 
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     def test__get_transport(self, mocked):
@@ -496,12 +591,14 @@ class PyUnicoreTests(JobDescriptionTests):
         data["auth_state"] = {"access_token": "123"}
         instance_dict = {"user_options": data["user_options"]}
         custom_headers = {"access-token": data["auth_state"]["access_token"]}
-        transport = pyunicore._get_transport(config, instance_dict, custom_headers, {})
+        transport = pyunicore._get_transport(
+            mock_config(config), instance_dict, custom_headers, {}
+        )
         self.assertTrue(mocked.called)
         self.assertIsNone(transport.preferences)
 
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     def test__get_transport_set_preferences(self, mocked):
@@ -513,7 +610,9 @@ class PyUnicoreTests(JobDescriptionTests):
         ] = True
         instance_dict = {"user_options": data["user_options"]}
         custom_headers = {"access-token": data["auth_state"]["access_token"]}
-        transport = pyunicore._get_transport(config, instance_dict, custom_headers, {})
+        transport = pyunicore._get_transport(
+            mock_config(config), instance_dict, custom_headers, {}
+        )
         self.assertTrue(mocked.called)
         self.assertEqual(
             transport.preferences,
@@ -521,11 +620,11 @@ class PyUnicoreTests(JobDescriptionTests):
         )
 
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     def test__get_client(self, mocked_client, mocked_transport):
@@ -534,7 +633,9 @@ class PyUnicoreTests(JobDescriptionTests):
 
         instance_dict = {"user_options": data["user_options"]}
         custom_headers = {"access-token": data["auth_state"]["access_token"]}
-        client = pyunicore._get_client(self.config, instance_dict, custom_headers, {})
+        client = pyunicore._get_client(
+            mock_config(self.config), instance_dict, custom_headers, {}
+        )
         self.assertTrue(mocked_transport.called)
         self.assertTrue(mocked_client.called)
         self.assertEqual(client.__class__.__name__, "MockClient")
@@ -564,11 +665,11 @@ class PyUnicoreTests(JobDescriptionTests):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        "services.utils.pyunicore.pyunicore.Client",
+        "services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        "services.utils.pyunicore.pyunicore.Transport",
+        "services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     def test__pyunicore_start_job(
@@ -595,7 +696,12 @@ class PyUnicoreTests(JobDescriptionTests):
         custom_headers = {"access-token": data["auth_state"]["access_token"]}
 
         result = pyunicore.start_service(
-            config, data, instance_dict, custom_headers, self.jhub_credential, {}
+            mock_config(config),
+            data,
+            instance_dict,
+            custom_headers,
+            self.jhub_credential,
+            {},
         )
         resource_url = result["resource_url"]
 
@@ -608,11 +714,11 @@ class PyUnicoreTests(JobDescriptionTests):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        "services.utils.pyunicore.pyunicore.Client",
+        "services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        "services.utils.pyunicore.pyunicore.Transport",
+        "services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -643,14 +749,19 @@ class PyUnicoreTests(JobDescriptionTests):
         custom_headers = {"access-token": data["auth_state"]["access_token"]}
 
         result = pyunicore.start_service(
-            config, data, instance_dict, custom_headers, self.jhub_credential, {}
+            mock_config(config),
+            data,
+            instance_dict,
+            custom_headers,
+            self.jhub_credential,
+            {},
         )
         resource_url = result["resource_url"]
         self.assertTrue(mocked_new_job.called)
         self.assertEqual(mocked_new_job.call_count, 1)
 
     def max_start_attempts_config():
-        config = config_mock()
+        config = config_mock_data()
         config["systems"]["DEMO-SITE"]["pyunicore"]["job_description"][
             "replace_indicators"
         ] = ["<??", "??>"]
@@ -658,36 +769,38 @@ class PyUnicoreTests(JobDescriptionTests):
             "project_kernel"
         ] = {"project": "myproject"}
         config["systems"]["DEMO-SITE"]["max_start_attempts"] = 5
-        return config
+        return mock_config(config)
 
     def get_minimal_config():
-        return {
-            "systems": {
-                "mapping": {"system": {"DEMO-SITE": "default_system"}},
-                "DEMO-SITE": {
-                    "site_url": "https://localhost:8080/DEMO-SITE/rest/core",
-                },
-                "default_system": {
-                    "pyunicore": {
-                        "job_description": {
-                            "base_directory": "web/tests/config/job_descriptions"
-                        }
+        return mock_config(
+            {
+                "systems": {
+                    "mapping": {"system": {"DEMO-SITE": "default_system"}},
+                    "DEMO-SITE": {
+                        "site_url": "https://localhost:8080/DEMO-SITE/rest/core",
+                    },
+                    "default_system": {
+                        "pyunicore": {
+                            "job_description": {
+                                "base_directory": "web/tests/config/job_descriptions"
+                            }
+                        },
                     },
                 },
-            },
-            "credential_mapping": {"authorized": "default_credential"},
-        }
+                "credential_mapping": {"authorized": "default_credential"},
+            }
+        )
 
     @mock.patch(
         "requests.post",
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=get_minimal_config)
@@ -725,7 +838,7 @@ class PyUnicoreTests(JobDescriptionTests):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -749,10 +862,1303 @@ class PyUnicoreTests(JobDescriptionTests):
             ],
         )
         data["resource_url"] = global_tmp_jobs[0].resource_url
-        # pyunicore._get_job(self.config, data["user_options"]["system"])
+        # pyunicore._get_job(mock_config(self.config), data["user_options"]["system"])
 
         j = pyunicore._get_job(
-            self.config, data, {"access-token": data["auth_state"]["access_token"]}, {}
+            mock_config(self.config),
+            data,
+            {"access-token": data["auth_state"]["access_token"]},
+            {},
         )
         self.assertEqual(j.__class__.__name__, "MockJob")
         self.assertEqual(j.resource_url, global_tmp_jobs[0].resource_url)
+
+
+def jwt(payload):
+    encoded = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+    return f"header.{encoded.rstrip('=')}.signature"
+
+
+class TransportPoolTests(APITestCase):
+    def setUp(self):
+        pyunicore.transport_pool.clear()
+        self.config = Config(JobDescriptionTests.config, version=1)
+        self.instance_dict = {
+            "user_options": {
+                "system": "DEMO-SITE",
+                "account": "demouser",
+                "project": "demoproject",
+            }
+        }
+
+    def tearDown(self):
+        pyunicore.transport_pool.clear()
+
+    def test_transport_reused(self):
+        custom_headers = {"access-token": "123"}
+        first = pyunicore._get_transport(
+            self.config, self.instance_dict, custom_headers, {}
+        )
+        second = pyunicore._get_transport(
+            self.config, self.instance_dict, custom_headers, {}
+        )
+        self.assertIsInstance(first, SessionTransport)
+        self.assertIsNot(first, second)
+        self.assertIs(first.session, second.session)
+        self.assertIs(first._clone().session, first.session)
+        other = pyunicore._get_transport(
+            self.config, self.instance_dict, {"access-token": "456"}, {}
+        )
+        self.assertIsNot(first.session, other.session)
+        self.assertEqual(pyunicore.transport_pool.stats()["hits"], 1)
+        self.assertEqual(pyunicore.transport_pool.stats()["size"], 2)
+
+    def test_expired_token(self):
+        token = jwt({"exp": time.time() - 10})
+        self.assertIsNotNone(token_expiry(token))
+        self.assertIsNone(token_expiry("not-a-jwt"))
+        custom_headers = {"access-token": token}
+        first = pyunicore._get_transport(
+            self.config, self.instance_dict, custom_headers, {}
+        )
+        second = pyunicore._get_transport(
+            self.config, self.instance_dict, custom_headers, {}
+        )
+        self.assertIsNot(first.session, second.session)
+        self.assertEqual(pyunicore.transport_pool.stats()["misses"], 2)
+
+    def test_lru_bound(self):
+        pool = TransportPool(maxsize=1)
+        factory = lambda: SessionTransport("token")  # noqa: E731
+        first = pool.get("a", factory)
+        pool.get("b", factory)
+        self.assertIsNot(pool.get("a", factory).session, first.session)
+        self.assertEqual(pool.stats()["size"], 1)
+
+    def test_session_used(self):
+        transport = SessionTransport("token", oidc=False)
+        transport.session = mock.Mock()
+        transport.session.get.return_value.status_code = 200
+        transport.session.get.return_value.json.return_value = {}
+        transport.get(url="https://localhost/rest/core")
+        self.assertTrue(transport.session.get.called)
+
+
+class SSLContextTests(APITestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bundle = os.path.join(self.tmp_dir, "ca.pem")
+        shutil.copy(requests.certs.where(), self.bundle)
+        ssl_contexts.clear()
+
+    def tearDown(self):
+        ssl_contexts.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_context_shared(self):
+        first = SessionTransport("token", verify=self.bundle)
+        second = SessionTransport("token", verify=self.bundle)
+        first_adapter = first.session.get_adapter("https://localhost")
+        second_adapter = second.session.get_adapter("https://localhost")
+        self.assertIsInstance(first_adapter, SSLContextAdapter)
+        self.assertIs(first_adapter.ssl_context, second_adapter.ssl_context)
+        self.assertEqual(ssl_contexts.stats()["misses"], 1)
+        # Without verification there's nothing to load
+        transport = SessionTransport("token", verify=False)
+        self.assertNotIsInstance(
+            transport.session.get_adapter("https://localhost"), SSLContextAdapter
+        )
+
+    def test_context_refreshed_on_change(self):
+        first = ssl_contexts.get(self.bundle)
+        self.assertIs(ssl_contexts.get(self.bundle), first)
+        stat_result = os.stat(self.bundle)
+        os.utime(self.bundle, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 1))
+        self.assertIsNot(ssl_contexts.get(self.bundle), first)
+
+    def test_bundle_not_loaded_per_connection(self):
+        adapter = SSLContextAdapter(self.bundle)
+        conn = mock.Mock()
+        adapter.cert_verify(conn, "https://localhost", self.bundle, None)
+        self.assertEqual(conn.cert_reqs, "CERT_REQUIRED")
+        self.assertIsNone(conn.ca_certs)
+        self.assertIs(
+            adapter.poolmanager.connection_pool_kw["ssl_context"],
+            adapter.ssl_context,
+        )
+
+
+class SiteCacheTests(APITestCase):
+    site_url = "https://localhost:8080/DEMO-SITE/rest/core"
+    properties = {
+        "_links": {"jobs": {"href": f"{site_url}/jobs"}},
+        "server": {"version": "9.0.0"},
+        "client": {"role": {"selected": "user"}},
+    }
+
+    def get_transport(self, role="user"):
+        properties = copy.deepcopy(self.properties)
+        properties["client"]["role"]["selected"] = role
+        transport = SessionTransport("token", oidc=False)
+        transport.session = mock.Mock()
+        transport.session.get.return_value.status_code = 200
+        transport.session.get.return_value.json.return_value = properties
+        return transport
+
+    def test_site_cached(self):
+        site_cache = SiteCache()
+        transport = self.get_transport()
+        client = get_site_client(site_cache, transport, self.site_url)
+        self.assertEqual(client.links["jobs"], f"{self.site_url}/jobs")
+        transport = self.get_transport()
+        client = get_site_client(site_cache, transport, self.site_url)
+        self.assertEqual(client.links["jobs"], f"{self.site_url}/jobs")
+        self.assertFalse(transport.session.get.called)
+        self.assertEqual(site_cache.stats()["hits"], 1)
+        self.assertNotIn("client", client.site.links)
+
+    def test_anonymous_user(self):
+        site_cache = SiteCache()
+        with self.assertRaises(Exception):
+            get_site_client(site_cache, self.get_transport("anonymous"), self.site_url)
+
+    def test_authentication_failed_cached_site(self):
+        site_cache = SiteCache()
+        get_site_client(site_cache, self.get_transport(), self.site_url)
+        # An expired token, the site is not fetched again
+        transport = self.get_transport()
+        transport.session.post.return_value.status_code = 401
+        client = get_site_client(site_cache, transport, self.site_url)
+        self.assertFalse(transport.session.get.called)
+        with self.assertRaises(AuthenticationFailedException) as cm:
+            client.new_job({"Executable": "sh"})
+        self.assertEqual(
+            str(cm.exception), f"Failure to authenticate at {self.site_url}"
+        )
+
+    def test_negative_cache(self):
+        site_cache = SiteCache(negative_ttl=60)
+        fetch = mock.Mock(side_effect=requests.ConnectionError("refused"))
+        with self.assertRaises(requests.ConnectionError):
+            site_cache.get(self.site_url, fetch)
+        with self.assertRaises(SiteUnavailable):
+            site_cache.get(self.site_url, fetch)
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_user_errors_not_cached(self):
+        site_cache = SiteCache(negative_ttl=60)
+        response = mock.Mock(status_code=403)
+        fetch = mock.Mock(side_effect=requests.HTTPError("403", response=response))
+        for _ in range(2):
+            with self.assertRaises(requests.HTTPError):
+                site_cache.get(self.site_url, fetch)
+        self.assertEqual(fetch.call_count, 2)
+
+
+class StatusJob:
+    resource_url = "https://localhost:8080/DEMO-SITE/rest/core/jobs/123"
+
+    def __init__(self, status, details=True):
+        self.calls = []
+        self.status = status
+        self.details = details
+        self.transport = mock.Mock()
+        self.transport.get.side_effect = self.transport_get
+
+    def transport_get(self, url):
+        self.calls.append(url)
+        return {"rawDetails": "bss"}
+
+    @property
+    def properties(self):
+        self.calls.append("properties")
+        links = {}
+        if self.details:
+            links["details"] = {"href": f"{self.resource_url}/details"}
+        return {"status": self.status, "exitCode": 0, "log": ["line"], "_links": links}
+
+    def is_running(self):
+        return self.status not in ("SUCCESSFUL", "FAILED")
+
+
+class StatusServiceTests(APITestCase):
+    def status(self, job):
+        config = copy.deepcopy(JobDescriptionTests.config)
+        config["systems"]["default_system"]["get_bss_details"] = True
+        instance_dict = {"user_options": {"system": "DEMO-SITE"}}
+        with mock.patch(
+            "services.utils.pyunicore._get_job", return_value=job
+        ), mock.patch(
+            "services.utils.pyunicore._get_file_output",
+            side_effect=lambda job, file, max_bytes: f"{file} output",
+        ):
+            return pyunicore.status_service(mock_config(config), instance_dict, {}, {})
+
+    def test_running(self):
+        job = StatusJob("RUNNING")
+        ret = self.status(job)
+        self.assertTrue(ret["running"])
+        self.assertEqual(ret["bss_details"], {"rawDetails": "bss"})
+        self.assertEqual(job.calls.count("properties"), 1)
+        self.assertIn(f"{job.resource_url}/details", job.calls)
+
+    def test_finished(self):
+        job = StatusJob("SUCCESSFUL")
+        ret = self.status(job)
+        self.assertFalse(ret["running"])
+        self.assertIn("stdout output", ret["details"]["detailed_error"])
+        self.assertIn("stderr output", ret["details"]["detailed_error"])
+        self.assertEqual(job.calls.count("properties"), 1)
+        self.assertIn(f"{job.resource_url}/details", job.calls)
+
+    def test_without_details_link(self):
+        job = StatusJob("RUNNING", details=False)
+        ret = self.status(job)
+        self.assertEqual(ret["bss_details"], {})
+        self.assertEqual(job.calls, ["properties"])
+
+
+class TailJob:
+    # A job whose working directory answers suffix byte ranges
+    def __init__(self, content, suffix_ranges=True):
+        self.content = content
+        self.suffix_ranges = suffix_ranges
+        self.requests = []
+        self.transport = mock.Mock()
+        self.transport.get.side_effect = self.transport_get
+        self.working_dir = mock.Mock(resource_url="https://localhost/storage")
+        self.working_dir.stat.side_effect = self.stat
+
+    def transport_get(self, to_json, url, headers, stream):
+        self.requests.append(headers["Range"])
+        if not self.suffix_ranges:
+            response = mock.Mock(status_code=416)
+            raise requests.HTTPError("416", response=response)
+        size = int(headers["Range"][7:])
+        return mock.Mock(
+            status_code=206,
+            iter_content=lambda chunk_size: [self.content[-size:]],
+        )
+
+    def stat(self, file):
+        self.requests.append("stat")
+        file_path = mock.Mock(properties={"size": len(self.content)})
+        file_path.raw.side_effect = lambda offset: mock.Mock(data=self.content[offset:])
+        return file_path
+
+
+class TailReadTests(APITestCase):
+    def test_suffix_range(self):
+        job = TailJob("line1\nline2\nünd".encode())
+        # The cut multibyte character is dropped
+        self.assertEqual(pyunicore._get_file_output(job, "stdout", 3), "nd")
+        self.assertEqual(pyunicore._get_file_output(job, "stdout", 4), "ünd")
+        self.assertEqual(job.requests, ["bytes=-3", "bytes=-4"])
+        self.assertEqual(
+            pyunicore._get_file_output(TailJob(b""), "stdout", 4), "stdout is empty"
+        )
+
+    def test_fallback(self):
+        job = TailJob(b"line1\nline2\n", suffix_ranges=False)
+        pyunicore.tail_stats.clear()
+        self.assertEqual(pyunicore._get_file_output(job, "stderr", 6), "line2\n")
+        self.assertEqual(job.requests, ["bytes=-6", "stat"])
+        stats = pyunicore.tail_stats.stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["fallbacks"], 1)
+        self.assertEqual(stats["bytes"], 6)
+
+    def test_last_lines(self):
+        for text in ["", "a", "a\nb\nc", "a\nb\n", "\n\n\n", "a\n\nb\nc\n"]:
+            for lines in range(1, 6):
+                split = text.split("\n")
+                self.assertEqual(
+                    last_lines(text, lines),
+                    (split[-lines:], lines < len(split)),
+                )
+        self.assertEqual(last_lines("a\nb", 0), (["a", "b"], False))
+        # Cut within "ü", the first line starts with its second byte
+        data = "ü1\nü2\nü3".encode()[1:]
+        self.assertEqual(last_lines(data, 3), (["1", "ü2", "ü3"], False))
+        self.assertEqual(last_lines(data, 2), (["ü2", "ü3"], True))
+
+    def test_prettify_error_logs(self):
+        output = "line1\n<line2>\nline3"
+        self.assertEqual(
+            pyunicore._prettify_error_logs(output, "<br>", 2, "Output"),
+            "<details><summary>Output</summary>...<br>&lt;line2&gt;<br>line3</details>",
+        )
+        self.assertEqual(
+            pyunicore._prettify_error_logs(["a", "b"], "<br>", 5, "Logs"),
+            "<details><summary>Logs</summary>a<br>b</details>",
+        )
+
+    def test_keep_tail(self):
+        chunks = [bytes([i]) * 10 for i in range(100)]
+        self.assertEqual(keep_tail(chunks, 15), bytes([98]) * 5 + bytes([99]) * 10)
+        self.assertEqual(keep_tail(chunks, 0), b"")
+
+
+class LogStreamTests(APITestCase):
+    def test_log_tail(self):
+        settings = log_stream_config(
+            {"log_stream": {"initial_bytes": 4, "chunk_bytes": 3, "interval_max": 5}}
+        )
+        tail = LogTail(settings)
+        self.assertEqual(tail.request_headers()["Range"], "bytes=-4")
+        # The tail starts within the first "ü"
+        self.assertEqual(tail.feed(206, "bytes 2-5/6", b"\xbc2\xc3\xbc"), "2ü")
+        self.assertEqual((tail.offset, tail.more), (6, False))
+        self.assertEqual(tail.request_headers()["Range"], "bytes=6-8")
+        self.assertEqual(tail.feed(416, None, b""), "")
+        # "é" is split between two ranges
+        self.assertEqual(tail.feed(206, "bytes 6-8/11", b"3\xc3\xbc"), "3ü")
+        self.assertEqual(tail.feed(206, "bytes 9-9/11", b"\xc3"), "")
+        self.assertEqual((tail.event_id, tail.more), (9, True))
+        self.assertEqual(tail.feed(206, "bytes 10-10/11", b"\xa9"), "é")
+        self.assertEqual((tail.event_id, tail.more), (11, False))
+
+        # Range header ignored
+        tail = LogTail(settings)
+        self.assertEqual(tail.feed(200, None, b"abcdef"), "cdef")
+        self.assertEqual(tail.feed(200, None, b"abcdefgh"), "gh")
+        # No suffix ranges
+        tail = LogTail(settings)
+        self.assertEqual(tail.feed(400, None, b""), "")
+        self.assertEqual(tail.request_headers()["Range"], "bytes=0-2")
+
+        self.assertEqual([tail.wait(False) for _ in range(4)], [1, 2, 4, 5])
+        self.assertEqual(tail.wait(True), 1)
+        self.assertEqual(tail.wait(False), 1)
+
+    def test_sse_event(self):
+        self.assertEqual(
+            sse_event("a\nb\r\n", event_id=3), b"id: 3\ndata: a\ndata: b\ndata: \n\n"
+        )
+        self.assertEqual(
+            sse_event("FAILED", event="end"), b"event: end\ndata: FAILED\n\n"
+        )
+
+    def test_stream_limiter(self):
+        self.assertTrue(stream_limiter.acquire("user1", 2, 10))
+        self.assertTrue(stream_limiter.acquire("user1", 2, 10))
+        self.assertFalse(stream_limiter.acquire("user1", 2, 10))
+        self.assertTrue(stream_limiter.acquire("user2", 2, 10))
+        stream_limiter.release("user1")
+        self.assertTrue(stream_limiter.acquire("user1", 2, 10))
+        # All users together
+        self.assertEqual(stream_limiter.streams(), 3)
+        self.assertFalse(stream_limiter.acquire("user3", 2, 3))
+        for user in ["user1", "user1", "user2"]:
+            stream_limiter.release(user)
+        self.assertEqual(stream_limiter.streams("user1"), 0)
+        self.assertEqual(stream_limiter.streams(), 0)
+
+
+class RunPerSiteTests(APITestCase):
+    def test_results_and_errors(self):
+        items = {f"item{i}": i for i in range(6)}
+
+        def func(item):
+            if item == 5:
+                raise Exception("failed")
+            return item * 2
+
+        results, errors, unfinished = run_per_site(
+            items, lambda item: item % 2, func, max_per_site=2
+        )
+        self.assertEqual(results, {f"item{i}": i * 2 for i in range(5)})
+        self.assertEqual(list(errors.keys()), ["item5"])
+        self.assertEqual(unfinished, [])
+
+    def test_deadline(self):
+        items = {f"item{i}": i for i in range(4)}
+
+        def func(item):
+            time.sleep(0.3)
+            return item
+
+        results, errors, unfinished = run_per_site(
+            items, lambda item: "site", func, max_per_site=1, deadline=0.1
+        )
+        self.assertEqual(len(results) + len(unfinished), 4)
+        self.assertGreaterEqual(len(unfinished), 3)
+
+    def test_close_old_connections(self):
+        # Before and after each item
+        with mock.patch("services.utils.batch.close_old_connections") as close:
+            run_per_site({i: i for i in range(3)}, lambda item: "site", str)
+        self.assertEqual(close.call_count, 6)
+
+    def test_item_deadline(self):
+        # The items share the deadline of the batch
+        def func(item):
+            return remaining()
+
+        results, errors, unfinished = run_per_site(
+            {"item": 0}, lambda item: "site", func, deadline=10
+        )
+        self.assertLessEqual(results["item"], 10)
+        self.assertGreater(results["item"], 9)
+
+    def test_per_site_limit(self):
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def func(item):
+            with lock:
+                running.append(item)
+                max_running.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(item)
+            return item
+
+        items = {i: i for i in range(8)}
+        run_per_site(items, lambda item: "site", func, max_per_site=2)
+        self.assertEqual(max(max_running), 2)
+
+
+class CircuitBreakerTests(APITestCase):
+    settings = {
+        "window": 60,
+        "min_calls": 4,
+        "error_rate": 0.5,
+        "slow_call": 0.05,
+        "open_seconds": 0.1,
+        "half_open_calls": 1,
+    }
+
+    def setUp(self):
+        pyunicore.circuit_breakers.clear()
+        pyunicore.transport_pool.clear()
+
+    def tearDown(self):
+        pyunicore.circuit_breakers.clear()
+        pyunicore.transport_pool.clear()
+
+    def site_down(self):
+        raise requests.ConnectionError("down")
+
+    def test_open_and_half_open(self):
+        breaker = CircuitBreaker("https://site", self.settings)
+        breaker.call(lambda: None)
+        for _ in range(3):
+            with self.assertRaises(requests.ConnectionError):
+                breaker.call(self.site_down)
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(CircuitOpen):
+            breaker.call(lambda: None)
+        self.assertEqual(breaker.stats()["rejected"], 1)
+        time.sleep(0.1)
+        # The probe fails, the circuit opens again
+        with self.assertRaises(requests.ConnectionError):
+            breaker.call(self.site_down)
+        self.assertTrue(breaker.is_open())
+        time.sleep(0.1)
+        self.assertEqual(breaker.call(lambda: "ok"), "ok")
+        self.assertEqual(breaker.state, "closed")
+        self.assertEqual(breaker.stats()["opened"], 2)
+
+    def test_user_errors_and_slow_calls(self):
+        breaker = CircuitBreaker("https://site", self.settings)
+        response = mock.Mock(status_code=403)
+        for _ in range(4):
+            with self.assertRaises(requests.HTTPError):
+                breaker.call(
+                    mock.Mock(side_effect=requests.HTTPError(response=response))
+                )
+        self.assertEqual(breaker.state, "closed")
+        for _ in range(4):
+            breaker.call(time.sleep, 0.06)
+        self.assertEqual(breaker.state, "open")
+
+    def test_fail_fast(self):
+        data = copy.deepcopy(JobDescriptionTests.config)
+        data["error_messages"] = {
+            "services.utils.pyunicore.circuit_open": "DEMO-SITE not available."
+        }
+        data["deadlines"] = {"retries": 0}
+        config = Config(data, version=1)
+        instance_dict = {
+            "user_options": {
+                "system": "DEMO-SITE",
+                "account": "demouser",
+                "project": "demoproject",
+            }
+        }
+        transport = pyunicore._get_transport(
+            config, instance_dict, {"access-token": "123"}, {}
+        )
+        transport.session = mock.Mock()
+        transport.session.get.side_effect = requests.ConnectionError("down")
+        for _ in range(5):
+            with self.assertRaises(requests.ConnectionError):
+                transport._clone().get(url="https://localhost/rest/core")
+        with self.assertRaises(services_utils.MgrException) as cm:
+            pyunicore._get_transport(config, instance_dict, {"access-token": "456"}, {})
+        self.assertEqual(cm.exception.args[0], "DEMO-SITE not available.")
+        stats = pyunicore.circuit_breakers.stats()
+        self.assertEqual(list(stats.values())[0]["state"], "open")
+
+    def test_opened_during_call(self):
+        # The circuit opens after the transport was created
+        data = copy.deepcopy(JobDescriptionTests.config)
+        data["error_messages"] = {
+            "services.utils.pyunicore.circuit_open": "DEMO-SITE not available."
+        }
+        config = mock_config(data)
+        instance_dict = {
+            "id": 1,
+            "servername": "circuit",
+            "resource_url": "https://localhost/rest/core/jobs/abc",
+            "user_options": {"system": "DEMO-SITE"},
+        }
+        circuit_open = CircuitOpen("Circuit breaker for DEMO-SITE is open")
+        job = mock.Mock()
+        job.abort.side_effect = circuit_open
+        type(job).properties = mock.PropertyMock(side_effect=circuit_open)
+        client = mock.Mock()
+        client.new_job.side_effect = circuit_open
+        with mock.patch(
+            "services.utils.pyunicore._get_job", return_value=job
+        ), mock.patch(
+            "services.utils.pyunicore._get_client", return_value=client
+        ), mock.patch(
+            "services.utils.pyunicore._get_job_description", return_value={}
+        ), mock.patch(
+            "services.utils.common._config", return_value=config
+        ):
+            calls = [
+                lambda: pyunicore.start_service(
+                    config, {}, instance_dict, {}, "authorized", {}
+                ),
+                lambda: common.status_service(instance_dict, {}, {}),
+                lambda: pyunicore.stop_service(config, instance_dict, {}, {}),
+            ]
+            for call in calls:
+                with self.assertRaises(services_utils.MgrException) as cm:
+                    call()
+                self.assertEqual(cm.exception.args[0], "DEMO-SITE not available.")
+
+
+class DeadlineTests(APITestCase):
+    def transport(self, *status_codes):
+        transport = SessionTransport("token", oidc=False)
+        transport.retries = 3
+        transport.backoff = 0
+        transport.session = mock.Mock()
+        responses = []
+        for status_code in status_codes:
+            response = mock.Mock(status_code=status_code, headers={})
+            response.json.return_value = {}
+            responses.append(response)
+        transport.session.get.side_effect = responses
+        transport.session.post.side_effect = responses
+        return transport
+
+    def test_retry_get(self):
+        transport = self.transport(503, 502, 200)
+        self.assertEqual(transport.get(url="https://localhost/rest/core"), {})
+        self.assertEqual(transport.session.get.call_count, 3)
+
+    def test_no_retry(self):
+        transport = self.transport(503, 200)
+        with self.assertRaises(requests.HTTPError):
+            transport.post(url="https://localhost/rest/core/jobs", json={})
+        self.assertEqual(transport.session.post.call_count, 1)
+        transport = self.transport(404, 200)
+        with self.assertRaises(requests.HTTPError):
+            transport.get(url="https://localhost/rest/core")
+        self.assertEqual(transport.session.get.call_count, 1)
+
+    def test_timeout_limited_by_deadline(self):
+        transport = self.transport(200)
+        with deadline(10):
+            with deadline(30):
+                transport.get(url="https://localhost/rest/core")
+                self.assertIn("remaining", tictoc_extra("job.properties", 0))
+        self.assertLessEqual(transport.session.get.call_args[1]["timeout"], 10)
+        self.assertNotIn("remaining", tictoc_extra("job.properties", 0))
+
+    def test_deadline_exceeded(self):
+        transport = self.transport(503, 200)
+        with deadline(0.01):
+            with mock.patch(
+                "services.utils.transports.retry_delay", return_value=1
+            ), self.assertRaises(requests.HTTPError):
+                # No time left for a retry
+                transport.get(url="https://localhost/rest/core")
+            time.sleep(0.02)
+            with self.assertRaises(DeadlineExceeded):
+                transport.get(url="https://localhost/rest/core")
+        self.assertEqual(transport.session.get.call_count, 1)
+
+
+class DownloadPath:
+    def __init__(self, storage, name, content=None):
+        self.storage = storage
+        self.name = name
+        self.content = content
+
+    def isfile(self):
+        return self.content is not None
+
+    def isdir(self):
+        return self.content is None
+
+    def download(self, file):
+        self.storage.downloads.append(self.name)
+        if isinstance(self.content, Exception):
+            file.write(b"partial")
+            raise self.content
+        for i in range(0, len(self.content), 4):
+            file.write(self.content[i : i + 4])
+
+
+class DownloadStorage:
+    # Like pyunicore's Storage.listdir(): keys are relative to "/"
+    def __init__(self, files):
+        self.listed = []
+        self.downloads = []
+        self.dirs = {}
+        for name, content in files.items():
+            parts = name.split("/")
+            for i in range(len(parts)):
+                base = "/" + "".join(f"{part}/" for part in parts[:i])
+                key = "/".join(parts[: i + 1])
+                if i < len(parts) - 1:
+                    key = f"{key}/"
+                    value = DownloadPath(self, key)
+                else:
+                    value = DownloadPath(self, key, content)
+                self.dirs.setdefault(base, {})[key] = value
+
+    def listdir(self, base="/"):
+        self.listed.append(base)
+        return self.dirs.get(base, {})
+
+
+class DownloadTests(APITestCase):
+    def setUp(self):
+        self.destination = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.destination)
+
+    def test_download(self):
+        storage = DownloadStorage(
+            {
+                "stdout": b"out",
+                "stderr": b"error output",
+                "input.ipynb": b"no",
+                "logs/start.log": b"log",
+                "logs/sub/more.log": b"more",
+                "home/big/data": b"no",
+            }
+        )
+        ret = download_files(
+            storage, self.destination, ["stdout", "stderr", "std", "logs/"]
+        )
+        self.assertEqual(ret["files"], 4)
+        self.assertEqual(ret["bytes"], 3 + 12 + 3 + 4)
+        # Each file once, directories without allowed files are not listed
+        self.assertEqual(
+            sorted(storage.downloads),
+            ["logs/start.log", "logs/sub/more.log", "stderr", "stdout"],
+        )
+        self.assertEqual(sorted(storage.listed), ["/", "/logs/", "/logs/sub/"])
+        with open(os.path.join(self.destination, "stderr"), "rb") as f:
+            self.assertEqual(f.read(), b"error output")
+        with open(os.path.join(self.destination, "logs/sub/more.log"), "rb") as f:
+            self.assertEqual(f.read(), b"more")
+
+    def test_nested_prefix(self):
+        storage = DownloadStorage({"a/b/c.log": b"c", "a/x/d.log": b"d"})
+        download_files(storage, self.destination, ["a/b/"])
+        self.assertEqual(storage.downloads, ["a/b/c.log"])
+        self.assertEqual(sorted(storage.listed), ["/", "/a/", "/a/b/"])
+
+    def test_failed_download_leaves_no_file(self):
+        storage = DownloadStorage({"stdout": b"out", "stderr": Exception("failed")})
+        with self.assertRaises(Exception):
+            download_files(storage, self.destination, ["std"])
+        self.assertEqual(os.listdir(self.destination), ["stdout"])
+
+
+def poller_config_mock():
+    return {"status_poller": {"enabled": True, "lease": 60}}
+
+
+@mock.patch("services.utils.poller._config", side_effect=poller_config_mock)
+class StatusPollerTests(APITestCase):
+    def setUp(self):
+        self.instance = ServicesModel.objects.create(
+            servername="poller",
+            start_id="abc",
+            user_options={"system": "DEMO-SITE"},
+            jhub_user_id=17,
+        )
+        StatusSnapshotModel.objects.create(
+            service=self.instance, next_poll=timezone.now()
+        )
+        token_store.set(self.instance.id, {"access-token": "secret"}, ttl=60)
+
+    def tearDown(self):
+        token_store.discard(self.instance.id)
+
+    def snapshot(self):
+        return StatusSnapshotModel.objects.get(service=self.instance)
+
+    def make_due(self):
+        StatusSnapshotModel.objects.filter(service=self.instance).update(
+            next_poll=timezone.now()
+        )
+
+    @mock.patch("services.utils.poller.status_service")
+    def test_run_once(self, status_mocked, config_mocked):
+        status_mocked.return_value = {"running": True, "status": "RUNNING"}
+        self.assertEqual(StatusPoller("a").run_once(), 1)
+        snapshot = self.snapshot()
+        self.assertEqual(snapshot.status, {"running": True, "status": "RUNNING"})
+        self.assertFalse(snapshot.terminal)
+        self.assertGreater(snapshot.next_poll, timezone.now() + timedelta(seconds=200))
+        # Not due yet
+        self.assertEqual(StatusPoller("a").run_once(), 0)
+        self.assertEqual(status_mocked.call_count, 1)
+
+    @mock.patch("services.utils.poller.status_service")
+    def test_lease(self, status_mocked, config_mocked):
+        status_mocked.return_value = {"running": True, "status": "QUEUED"}
+        self.assertEqual(StatusPoller("a").run_once(), 1)
+        self.make_due()
+        self.assertEqual(StatusPoller("b").run_once(), 0)
+        self.assertEqual(StatusPoller("a").run_once(), 1)
+        self.make_due()
+        StatusSnapshotModel.objects.filter(service=self.instance).update(
+            lease_until=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertEqual(StatusPoller("b").run_once(), 1)
+        self.assertEqual(self.snapshot().lease_owner, "b")
+
+    @mock.patch("services.utils.poller.status_service")
+    def test_terminal(self, status_mocked, config_mocked):
+        status_mocked.return_value = {"running": False, "status": "SUCCESSFUL"}
+        self.assertEqual(StatusPoller("a").run_once(), 1)
+        self.assertTrue(self.snapshot().terminal)
+        self.assertIsNone(self.snapshot().next_poll)
+        self.assertEqual(StatusPoller("a").run_once(), 0)
+
+    @mock.patch("services.utils.poller.status_service")
+    def test_no_token(self, status_mocked, config_mocked):
+        token_store.discard(self.instance.id)
+        self.assertEqual(StatusPoller("a").run_once(), 0)
+        self.assertFalse(status_mocked.called)
+
+    @mock.patch("services.utils.poller.status_service")
+    def test_skip_without_token(self, status_mocked, config_mocked):
+        # Due services without a token here don't fill the batch
+        config_mocked.side_effect = lambda: {
+            "status_poller": {"enabled": True, "batch_size": 2}
+        }
+        for i in range(3):
+            instance = ServicesModel.objects.create(
+                servername=f"other{i}", start_id="abc", jhub_user_id=17
+            )
+            StatusSnapshotModel.objects.create(
+                service=instance, next_poll=timezone.now() - timedelta(minutes=1)
+            )
+        status_mocked.return_value = {"running": True, "status": "RUNNING"}
+        self.assertEqual(StatusPoller("a").run_once(), 1)
+        self.assertEqual(status_mocked.call_count, 1)
+
+    @mock.patch("services.utils.poller.status_service")
+    def test_failed_poll(self, status_mocked, config_mocked):
+        status_mocked.side_effect = services_utils.MgrException("error", "details")
+        self.assertEqual(StatusPoller("a").run_once(), 0)
+        snapshot = self.snapshot()
+        self.assertIsNone(snapshot.updated)
+        self.assertGreater(snapshot.next_poll, timezone.now())
+
+    def test_save_snapshot(self, config_mocked):
+        save_snapshot(
+            poller_config_mock(), self.instance, {"running": True, "status": "READY"}
+        )
+        snapshot = self.snapshot()
+        self.assertEqual(snapshot.unicore_status, "READY")
+        self.assertLess(snapshot.next_poll, timezone.now() + timedelta(seconds=20))
+
+
+def stop_queue_config_mock():
+    return {"stop_queue": {"max_attempts": 2, "backoff": 30}}
+
+
+@mock.patch("services.utils.tasks._config", side_effect=stop_queue_config_mock)
+class StopTaskTests(APITestCase):
+    def setUp(self):
+        instance = ServicesModel.objects.create(
+            servername="stopme",
+            start_id="abc",
+            user_options={"system": "DEMO-SITE"},
+            jhub_user_id=17,
+            resource_url="https://unicore/jobs/abc",
+        )
+        self.task = enqueue_stop(
+            instance, {"access-token": "secret", "uuidcode": "abc", "other": "x"}
+        )
+        instance.delete()
+
+    def task_state(self):
+        return StopTaskModel.objects.get(id=self.task.id)
+
+    @mock.patch("services.utils.tasks.stop_service")
+    def test_run_once(self, stop_mocked, config_mocked):
+        self.assertTrue(StopTaskWorker("a").run_once())
+        instance_dict, custom_headers, logs_extra = stop_mocked.call_args.args
+        self.assertEqual(instance_dict["resource_url"], "https://unicore/jobs/abc")
+        self.assertEqual(custom_headers, {"access-token": "secret", "uuidcode": "abc"})
+        task = self.task_state()
+        self.assertEqual(task.state, StopTaskModel.DONE)
+        self.assertEqual(task.attempts, 1)
+        self.assertEqual(task.custom_headers, {})
+        self.assertIsNotNone(task.finished)
+        self.assertFalse(StopTaskWorker("a").run_once())
+
+    def test_encrypted_headers(self, config_mocked):
+        # Only the headers a stop needs, the access token encrypted
+        task = self.task_state()
+        self.assertEqual(set(task.custom_headers), {"access-token", "uuidcode"})
+        self.assertNotIn("secret", json.dumps(task.custom_headers))
+        self.assertEqual(decrypt_headers(task.custom_headers)["access-token"], "secret")
+
+    @mock.patch("services.utils.tasks.stop_service")
+    def test_other_secret_key(self, stop_mocked, config_mocked):
+        with override_settings(SECRET_KEY="other"):
+            self.assertTrue(StopTaskWorker("a").run_once())
+        self.assertFalse(stop_mocked.called)
+        task = self.task_state()
+        self.assertEqual(task.state, StopTaskModel.PENDING)
+        self.assertIn("Could not read the access token.", task.last_error)
+
+    def test_heartbeat(self, config_mocked):
+        # A long stop keeps its task hidden from the other workers
+        worker = StopTaskWorker("a")
+        with mock.patch.object(worker, "_update") as update_mocked:
+            with worker.heartbeat({"visibility_timeout": 0.03}, self.task):
+                time.sleep(0.1)
+        self.assertGreaterEqual(update_mocked.call_count, 2)
+        self.assertIn("available_at", update_mocked.call_args.kwargs)
+
+    @mock.patch("services.utils.tasks.stop_service")
+    def test_retry(self, stop_mocked, config_mocked):
+        stop_mocked.side_effect = services_utils.MgrException("error", "details")
+        self.assertTrue(StopTaskWorker("a").run_once())
+        task = self.task_state()
+        self.assertEqual(task.state, StopTaskModel.PENDING)
+        self.assertEqual(task.last_error, "error details")
+        self.assertGreater(task.available_at, timezone.now() + timedelta(seconds=10))
+        # Not before the backoff is over
+        self.assertFalse(StopTaskWorker("a").run_once())
+        StopTaskModel.objects.filter(id=self.task.id).update(
+            available_at=timezone.now()
+        )
+        self.assertTrue(StopTaskWorker("a").run_once())
+        task = self.task_state()
+        self.assertEqual(task.state, StopTaskModel.FAILED)
+        self.assertEqual(task.attempts, 2)
+        self.assertEqual(task.custom_headers, {})
+
+    @mock.patch("services.utils.tasks.stop_service")
+    def test_visibility_timeout(self, stop_mocked, config_mocked):
+        worker_a = StopTaskWorker("a")
+        qconfig = {"visibility_timeout": 300}
+        task_a = worker_a.claim(qconfig)
+        self.assertEqual(task_a.locked_by, "a")
+        self.assertIsNone(StopTaskWorker("b").claim(qconfig))
+        # Worker a did not finish in time
+        StopTaskModel.objects.filter(id=self.task.id).update(
+            available_at=timezone.now()
+        )
+        self.assertTrue(StopTaskWorker("b").run_once())
+        self.assertEqual(self.task_state().state, StopTaskModel.DONE)
+        # Worker a's late result is ignored
+        worker_a._finish(task_a, StopTaskModel.FAILED, "late")
+        self.assertEqual(self.task_state().state, StopTaskModel.DONE)
+
+
+class SystemConfigTests(APITestCase):
+    def test_defaults_applied(self):
+        system_config = get_system_config(mock_config({}), "DEMO-SITE")
+        self.assertEqual(system_config.mapped_system, "DEMO-SITE")
+        self.assertEqual(
+            system_config.site_url, "https://localhost:8080/DEMO-SITE/rest/core"
+        )
+        self.assertEqual(system_config.transport.timeout, 120)
+        self.assertEqual(system_config.job_description.replace_indicators, ("<", ">"))
+        self.assertEqual(system_config.unicore_stdout.max_bytes, 4096)
+
+    def test_mapped_and_unmapped_keys(self):
+        config = Config(config_mock_data())
+        system_config = config.system("DEMO-SITE")
+        self.assertEqual(system_config.mapped_system, "default_system")
+        # site_url and hooks are read from the unmapped system
+        self.assertEqual(
+            system_config.site_url, "https://localhost:8080/DEMO-SITE/rest/core"
+        )
+        self.assertIn("load_project_specific_kernel", system_config.hooks)
+        # pyunicore settings are read from the mapped system
+        self.assertEqual(system_config.job_archive, "/tmp/job-archive")
+        self.assertFalse(system_config.job_description.set_queue)
+        self.assertIs(system_config, get_system_config(config, "DEMO-SITE"))
+
+    def test_hooks_compiled(self):
+        data = config_mock_data()
+        data["systems"]["DEMO-SITE"]["hooks"] = {
+            "many_projects": {
+                "project": [f"project{i}" for i in range(500)],
+                "partition": ["LoginNode"],
+            },
+            "substring": {"project": "myproject"},
+        }
+        hooks = Config(data).system("DEMO-SITE").hooks
+        self.assertIsInstance(hooks["many_projects"].conditions[0][1], frozenset)
+        self.assertTrue(
+            hooks["many_projects"].evaluate(
+                {"project": "project499", "partition": "LoginNode"}
+            )
+        )
+        self.assertFalse(
+            hooks["many_projects"].evaluate(
+                {"project": "project499", "partition": "batch"}
+            )
+        )
+        self.assertFalse(hooks["many_projects"].evaluate({"project": ["project1"]}))
+        # Strings keep their substring semantic
+        self.assertTrue(hooks["substring"].evaluate({"project": "project"}))
+
+    def test_config_is_read_only(self):
+        config = Config(config_mock_data(), version=3)
+        self.assertEqual(config.version, 3)
+        with self.assertRaises(TypeError):
+            config["systems"] = {}
+        with self.assertRaises(TypeError):
+            config["systems"]["DEMO-SITE"] = {}
+        self.assertIs(copy.deepcopy(config), config)
+
+    def test_input_files_precomputed(self):
+        data = config_mock_data()
+        data["systems"]["mapping"]["skip"] = {
+            "credential": ["jupyter-jsc", "other"],
+            "system": ["DEMO-SITE", "JUWELS"],
+        }
+        data["systems"]["mapping"]["replace"] = {
+            "credential_system": {"jupyter-jsc": {"DEMO-SITE": {"key": "specific"}}},
+            "system": {"DEMO-SITE": {"key": "general", "other": "value"}},
+        }
+        config = Config(data)
+        input_files = config.input_files_config(
+            config.stage, "jupyter-jsc", "DEMO-SITE"
+        )
+        self.assertIs(
+            input_files, config.input_files[(config.stage, "jupyter-jsc", "DEMO-SITE")]
+        )
+        self.assertEqual(
+            input_files.replacements, {"key": "specific", "other": "value"}
+        )
+        self.assertTrue(input_files.skip("other_file.sh"))
+        self.assertTrue(input_files.skip("JUWELS_file.sh"))
+        self.assertTrue(input_files.skip("jupyter-jsc_JUWELS_file.sh"))
+        self.assertFalse(input_files.skip("jupyter-jsc_DEMO-SITE_file.sh"))
+        self.assertEqual(input_files.rename("jupyter-jsc_DEMO-SITE_file.sh"), "file.sh")
+        self.assertIs(
+            get_input_files_config(config, config.stage, "jupyter-jsc", "DEMO-SITE"),
+            input_files,
+        )
+        # Only compiled snapshots are accepted
+        with self.assertRaises(TypeError):
+            get_input_files_config(data, config.stage, "jupyter-jsc", "DEMO-SITE")
+
+
+class ConfigReloadTests(APITestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.tmp_dir, "config.json")
+        with open(self.config_path, "w") as f:
+            json.dump(config_mock_data(), f)
+        self.env_patch = mock.patch.dict(os.environ, {"CONFIG_PATH": self.config_path})
+        self.env_patch.start()
+        services_utils.global_config = (None, None)
+
+    def tearDown(self):
+        self.env_patch.stop()
+        services_utils.global_config = (None, None)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reload_only_on_change(self):
+        config = services_utils._config()
+        self.assertIs(services_utils._config(), config)
+        # ConfigMaps are updated by swapping a symlink, i.e. a new inode
+        new_path = os.path.join(self.tmp_dir, "config.json.new")
+        data = config_mock_data()
+        data["error_messages"] = {"key": "value"}
+        with open(new_path, "w") as f:
+            json.dump(data, f)
+        os.replace(new_path, self.config_path)
+        new_config = services_utils._config()
+        self.assertGreater(new_config.version, config.version)
+        self.assertEqual(new_config["error_messages"]["key"], "value")
+
+    def test_keep_last_config_on_error(self):
+        config = services_utils._config()
+        with open(self.config_path, "w") as f:
+            f.write("{ no json")
+        with mock.patch("services.utils.log.critical") as critical:
+            self.assertIs(services_utils._config(), config)
+            self.assertIs(services_utils._config(), config)
+            self.assertEqual(critical.call_count, 1)
+
+    def test_pinned_config(self):
+        with services_utils.pinned_config() as config:
+            with open(self.config_path, "w") as f:
+                json.dump({}, f)
+            self.assertIs(services_utils._config(), config)
+        self.assertIsNot(services_utils._config(), config)
+
+
+class TemplateCacheTests(APITestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "job_description.json.template")
+        with open(self.path, "w") as f:
+            json.dump({"Executable": "bash", "Arguments": ["start.sh"]}, f)
+        pyunicore.template_cache.clear()
+
+    def tearDown(self):
+        pyunicore.template_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_template_cached(self):
+        first = pyunicore.template_cache.get(self.path)
+        second = pyunicore.template_cache.get(self.path)
+        self.assertIs(first, second)
+        self.assertEqual(pyunicore.template_cache.stats()["hits"], 1)
+        self.assertEqual(pyunicore.template_cache.stats()["misses"], 1)
+
+    def test_template_reloaded_on_change(self):
+        pyunicore.template_cache.get(self.path)
+        with open(self.path, "w") as f:
+            json.dump({"Executable": "sh"}, f)
+        stat_result = os.stat(self.path)
+        os.utime(self.path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 1))
+        template = pyunicore.template_cache.get(self.path)
+        self.assertEqual(template, {"Executable": "sh"})
+        self.assertEqual(pyunicore.template_cache.stats()["misses"], 2)
+
+    def test_jd_template_returns_copy(self):
+        data = copy.deepcopy(JobDescriptionTests.request_data_simple)
+        config = mock_config(JobDescriptionTests.config)
+        jd = pyunicore._jd_template(config, "authorized", data)
+        jd["Arguments"].append("modified")
+        jd = pyunicore._jd_template(config, "authorized", data)
+        self.assertNotIn("modified", jd.get("Arguments", []))
+        self.assertEqual(pyunicore.template_cache.stats()["hits"], 1)
+
+    def test_lru_bound(self):
+        cache = FileCache(lambda path: path, maxsize=1)
+        other_path = os.path.join(self.tmp_dir, "other")
+        with open(other_path, "w") as f:
+            f.write("{}")
+        cache.get(self.path)
+        cache.get(other_path)
+        self.assertEqual(cache.stats()["size"], 1)
+        cache.get(self.path)
+        self.assertEqual(cache.stats()["misses"], 3)
+
+
+class JobDescriptionSkeletonTests(APITestCase):
+    def setUp(self):
+        pyunicore.skeleton_cache.clear()
+
+    def tearDown(self):
+        pyunicore.skeleton_cache.clear()
+
+    def test_skeleton_reused(self):
+        config = Config(JobDescriptionTests.config, version=1)
+        data = copy.deepcopy(JobDescriptionTests.request_data_simple)
+        data["env"] = {"JUPYTERHUB_USER_ID": "1"}
+        data["user_options"]["partition"] = "devel"
+        data["user_options"]["project"] = "demoproject2"
+        jd = pyunicore._get_job_description(config, "authorized", data, {})
+        data["env"] = {"JUPYTERHUB_USER_ID": "2"}
+        jd2 = pyunicore._get_job_description(config, "authorized", data, {})
+        self.assertEqual(pyunicore.skeleton_cache.stats()["hits"], 1)
+        self.assertEqual(pyunicore.skeleton_cache.stats()["misses"], 1)
+        self.assertNotEqual(jd, jd2)
+        # Same result as the build for a new configuration
+        self.assertEqual(
+            jd2,
+            pyunicore._get_job_description(
+                mock_config(JobDescriptionTests.config), "authorized", data, {}
+            ),
+        )
+
+    def test_configured_replacements(self):
+        data = copy.deepcopy(JobDescriptionTests.config)
+        data["systems"]["mapping"]["replace"] = {
+            "system": {"DEMO-SITE": {"stage_stuff": "configured"}}
+        }
+        config = mock_config(data)
+        initial_data = copy.deepcopy(JobDescriptionTests.request_data_simple)
+        initial_data["env"] = {"JUPYTERHUB_USER_ID": "1"}
+        initial_data["user_options"]["partition"] = "devel"
+        skeleton = pyunicore._jd_skeleton(config, "authorized", initial_data)
+        # Applied once per skeleton, the hooks are left for the start
+        rendered = dict(skeleton.rendered_files)["start.sh"]
+        self.assertIn("#StageSpecific: configured", rendered)
+        self.assertIn("<hook_project_kernel>", rendered)
+
+        def start_sh(initial_data):
+            jd = pyunicore._get_job_description(config, "authorized", initial_data, {})
+            return jd["Imports"][0]["Data"]
+
+        def start_sh_unrendered(initial_data):
+            jd = pyunicore._jd_add_input_files(
+                config,
+                "authorized",
+                initial_data,
+                {},
+                input_files=skeleton.input_files,
+            )
+            return jd["Imports"][0]["Data"]
+
+        self.assertEqual(start_sh(initial_data), start_sh_unrendered(initial_data))
+        self.assertIn("#StageSpecific: configured", start_sh(initial_data))
+        # A value of env or user_options with the same key comes first
+        initial_data["env"]["stage_stuff"] = "user"
+        self.assertEqual(start_sh(initial_data), start_sh_unrendered(initial_data))
+        self.assertIn("#StageSpecific: user", start_sh(initial_data))
+
+    def test_configured_replacements_with_placeholders(self):
+        # Could be filled by a value of env or user_options, so not applied
+        data = copy.deepcopy(JobDescriptionTests.config)
+        data["systems"]["mapping"]["replace"] = {
+            "system": {"DEMO-SITE": {"stage_stuff": "<JUPYTERHUB_USER_ID>"}}
+        }
+        initial_data = copy.deepcopy(JobDescriptionTests.request_data_simple)
+        initial_data["env"] = {"JUPYTERHUB_USER_ID": "1"}
+        initial_data["user_options"]["partition"] = "devel"
+        config = mock_config(data)
+        skeleton = pyunicore._jd_skeleton(config, "authorized", initial_data)
+        self.assertIsNone(skeleton.rendered_files)
+        jd = pyunicore._get_job_description(config, "authorized", initial_data, {})
+        self.assertIn("#StageSpecific: <JUPYTERHUB_USER_ID>", jd["Imports"][0]["Data"])
+
+    def test_job_types(self):
+        config = Config(JobDescriptionTests.config, version=1)
+        data = copy.deepcopy(JobDescriptionTests.request_data_simple)
+        data["env"] = {"JUPYTERHUB_USER_ID": "1"}
+        data["user_options"]["partition"] = "LoginNode"
+        jd = pyunicore._get_job_description(config, "authorized", data, {})
+        self.assertEqual(jd["Job type"], "interactive")
+        self.assertEqual(jd["Login node"], "localhost")
+        data["user_options"]["partition"] = "devel"
+        jd = pyunicore._get_job_description(config, "authorized", data, {})
+        self.assertEqual(jd["Job type"], "normal")
+        self.assertNotIn("Login node", jd)
+        self.assertEqual(pyunicore.skeleton_cache.stats()["size"], 2)
+
+    def test_warm_job_descriptions(self):
+        config = Config(JobDescriptionTests.config, version=1)
+        self.assertGreater(pyunicore.warm_job_descriptions(config), 0)
+        data = copy.deepcopy(JobDescriptionTests.request_data_simple)
+        data["env"] = {"JUPYTERHUB_USER_ID": "1"}
+        data["user_options"]["partition"] = "devel"
+        pyunicore._get_job_description(config, "authorized", data, {})
+        self.assertEqual(pyunicore.skeleton_cache.stats()["hits"], 1)
+
+
+class InputDirectoryCacheTests(APITestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmp_dir, "start.sh"), "w") as f:
+            f.write("echo start")
+        self.cache = FileCache(InputDirectory, signature=directory_signature)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_files_read_once(self):
+        input_directory = self.cache.get(self.tmp_dir)
+        self.assertEqual(input_directory.filenames, ("start.sh",))
+        self.assertEqual(input_directory.read("start.sh"), "echo start")
+        with mock.patch("builtins.open", side_effect=mocked_exception):
+            input_directory = self.cache.get(self.tmp_dir)
+            self.assertEqual(input_directory.read("start.sh"), "echo start")
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_new_file_invalidates(self):
+        self.cache.get(self.tmp_dir)
+        with open(os.path.join(self.tmp_dir, "env.sh"), "w") as f:
+            f.write("export A=1")
+        input_directory = self.cache.get(self.tmp_dir)
+        self.assertEqual(sorted(input_directory.filenames), ["env.sh", "start.sh"])
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+
+class PlaceholdersTests(APITestCase):
+    pairs = [
+        ("project", "demoproject"),
+        ("system", "DEMO-SITE"),
+        ("project", "ignored"),
+        ("stage_stuff", "stage1"),
+    ]
+
+    def assertSameAsSequential(self, indicators, pairs, text):
+        placeholders = Placeholders(indicators, pairs)
+        self.assertEqual(
+            placeholders.render(text), placeholders.render_sequential(text)
+        )
+        return placeholders.render(text)
+
+    def test_single_pass(self):
+        text = "<project> on <system> (<stage_stuff>) <unknown> <<system>> <>"
+        placeholders = Placeholders(["<", ">"], self.pairs)
+        self.assertTrue(placeholders.single_pass)
+        self.assertEqual(
+            self.assertSameAsSequential(["<", ">"], self.pairs, text),
+            "demoproject on DEMO-SITE (stage1) <unknown> <DEMO-SITE> <>",
+        )
+
+    def test_render_json(self):
+        placeholders = Placeholders(["<", ">"], self.pairs)
+        document = {"<system>": ["<project>", 1, None, {"key": "<unknown>"}]}
+        self.assertEqual(
+            placeholders.render_json(document),
+            {"DEMO-SITE": ["demoproject", 1, None, {"key": "<unknown>"}]},
+        )
+        self.assertEqual(document["<system>"][0], "<project>")
+
+    def test_custom_indicators(self):
+        text = "<??project??> <project> <??system??>??>"
+        self.assertEqual(
+            self.assertSameAsSequential(["<??", "??>"], self.pairs, text),
+            "demoproject <project> DEMO-SITE??>",
+        )
+
+    def test_cascading_replacements(self):
+        # A value containing a placeholder of a later pass is replaced again
+        pairs = [("a", "<b>"), ("b", "B")]
+        self.assertEqual(self.assertSameAsSequential(["<", ">"], pairs, "<a>"), "B")
+        # A value and the surrounding text may create a new placeholder
+        pairs = [("x", "a"), ("ab", "AB")]
+        self.assertEqual(self.assertSameAsSequential(["<", ">"], pairs, "<<x>b>"), "AB")
+        # Earlier passes do not see placeholders created by later ones
+        pairs = [("b", "B"), ("a", "<b>")]
+        self.assertEqual(self.assertSameAsSequential(["<", ">"], pairs, "<a>"), "<b>")
+
+    def test_overlapping_indicators(self):
+        pairs = [("b", "B"), ("a", "A")]
+        placeholders = Placeholders(["%%", "%%"], pairs)
+        self.assertFalse(placeholders.single_pass)
+        self.assertEqual(placeholders.render("%%a%%b%%"), "%%aB")
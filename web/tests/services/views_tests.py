@@ -1,12 +1,17 @@
+import json
 import os
 from unittest import mock
 
 from django.http.response import HttpResponse
+from django.urls.base import resolve
 from django.urls.base import reverse
 from services.models import ServicesModel
+from services.models import StopTaskModel
+from services.utils.tasks import decrypt_headers
 from tests.user_credentials import mocked_requests_post_running
 from tests.user_credentials import UserCredentials
 
+from .mocks import clear_unicore_state
 from .mocks import config_mock
 from .mocks import config_mock_mapped
 from .mocks import config_mock_prefix
@@ -21,6 +26,10 @@ from .mocks import mocked_pyunicore_transport_init
 
 
 class ServiceViewTests(UserCredentials):
+    def setUp(self):
+        super().setUp()
+        clear_unicore_state()
+
     def test_health(self):
         url = "/api/health/"
         r = self.client.get(url, format="json")
@@ -68,11 +77,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=config_mock)
@@ -91,11 +100,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_newjob_fail,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=config_mock)
@@ -114,11 +123,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_newjob_fail,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=config_mock_prefix)
@@ -151,11 +160,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_newjob_fail,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=config_mock_suffix)
@@ -188,11 +197,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=config_mock)
@@ -211,11 +220,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=config_mock)
@@ -239,11 +248,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=config_mock)
@@ -270,11 +279,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -300,17 +309,127 @@ class ServiceViewTests(UserCredentials):
         self.assertEqual(r.status_code, 200)
         self.assertTrue(r.data["running"])
 
+    @mock.patch(
+        target="requests.post",
+        side_effect=mocked_requests_post_running,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.get_site_client",
+        side_effect=mocked_pyunicore_client_init,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.SessionTransport",
+        side_effect=mocked_pyunicore_transport_init,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.pyunicore.Job",
+        side_effect=mocked_pyunicore_job_init,
+    )
+    @mock.patch(target="services.utils.common._config", side_effect=config_mock)
+    @mock.patch("services.views._config")
+    @mock.patch("services.serializers._config")
+    @mock.patch("services.serializers.status_service")
+    def test_get_job_status_snapshot(
+        self,
+        status_mocked,
+        serializer_config,
+        views_config,
+        config_mocked,
+        job_mocked,
+        transport_mocked,
+        client_mocked,
+        mocked_requests,
+    ):
+        config = config_mock(status_poller={"enabled": True, "max_age": 60})
+        serializer_config.return_value = config
+        views_config.return_value = config
+        status_mocked.return_value = {"running": True, "status": "RUNNING"}
+        url = reverse("services-list")
+        r = self.client.post(
+            url, data=self.simple_request_data, headers=self.headers, format="json"
+        )
+        self.assertEqual(r.status_code, 201)
+        service = ServicesModel.objects.get(servername=r.data["servername"])
+        self.assertIsNone(service.status_snapshot.updated)
+        service_url = f"{url}{r.data['servername']}/"
+        r = self.client.get(service_url, headers=self.headers)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data["status"], "RUNNING")
+        self.assertEqual(status_mocked.call_count, 1)
+        # The second request is answered from the stored status
+        status_mocked.return_value = {"running": False, "status": "FAILED"}
+        r = self.client.get(service_url, headers=self.headers)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data["status"], "RUNNING")
+        self.assertEqual(status_mocked.call_count, 1)
+
+    @mock.patch(
+        target="requests.post",
+        side_effect=mocked_requests_post_running,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.get_site_client",
+        side_effect=mocked_pyunicore_client_init,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.SessionTransport",
+        side_effect=mocked_pyunicore_transport_init,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.pyunicore.Job",
+        side_effect=mocked_pyunicore_job_init,
+    )
+    @mock.patch(target="services.utils.common._config", side_effect=config_mock)
+    @mock.patch("services.views._config", side_effect=config_mock)
+    @mock.patch("services.serializers._config", side_effect=config_mock)
+    @mock.patch("services.serializers.status_service")
+    def test_get_job_status_terminal(
+        self,
+        status_mocked,
+        serializer_config,
+        views_config,
+        config_mocked,
+        job_mocked,
+        transport_mocked,
+        client_mocked,
+        mocked_requests,
+    ):
+        # Without status poller, the final status is stored anyway
+        status_mocked.return_value = {"running": True, "status": "RUNNING"}
+        url = reverse("services-list")
+        r = self.client.post(
+            url, data=self.simple_request_data, headers=self.headers, format="json"
+        )
+        self.assertEqual(r.status_code, 201)
+        service_url = f"{url}{r.data['servername']}/"
+        r = self.client.get(service_url, headers=self.headers)
+        self.assertEqual(r.data["status"], "RUNNING")
+        status_mocked.return_value = {
+            "running": False,
+            "status": "FAILED",
+            "details": {"error": "Failed", "detailed_error": "stderr"},
+        }
+        r = self.client.get(service_url, headers=self.headers)
+        self.assertEqual(r.data["status"], "FAILED")
+        self.assertEqual(status_mocked.call_count, 2)
+        for _ in range(2):
+            r = self.client.get(service_url, headers=self.headers)
+            self.assertEqual(r.status_code, 200)
+            self.assertFalse(r.data["running"])
+            self.assertEqual(r.data["details"]["detailed_error"], "stderr")
+        self.assertEqual(status_mocked.call_count, 2)
+
     @mock.patch(target="services.views.log.critical", side_effect=mocked_pass)
     @mock.patch(
         target="requests.post",
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -336,17 +455,69 @@ class ServiceViewTests(UserCredentials):
         r = self.client.delete(service_url, headers=self.headers)
         self.assertEqual(r.status_code, 204)
         self.assertFalse(mocked_log_critical.called)
+        # Stopped within the request, the stop queue is opt-in
+        self.assertFalse(
+            StopTaskModel.objects.filter(servername=service_url.split("/")[-2]).exists()
+        )
+
+    @mock.patch(
+        "services.views._config",
+        side_effect=lambda: config_mock(stop_queue={"enabled": True}),
+    )
+    @mock.patch(
+        target="requests.post",
+        side_effect=mocked_requests_post_running,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.get_site_client",
+        side_effect=mocked_pyunicore_client_init,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.SessionTransport",
+        side_effect=mocked_pyunicore_transport_init,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.pyunicore.Job",
+        side_effect=mocked_pyunicore_job_init,
+    )
+    @mock.patch(target="services.utils.common._config", side_effect=config_mock)
+    def test_delete_job_queue(
+        self,
+        config_mocked,
+        job_mocked,
+        transport_mocked,
+        client_mocked,
+        mocked_requests,
+        views_config_mocked,
+    ):
+        url = reverse("services-list")
+        r = self.client.post(
+            url, data=self.simple_request_data, headers=self.headers, format="json"
+        )
+        self.assertEqual(r.status_code, 201)
+        service_url = f"{url}{r.data['servername']}/"
+        job_mocked.reset_mock()
+        r = self.client.delete(service_url, headers=self.headers)
+        self.assertEqual(r.status_code, 204)
+        self.assertFalse(job_mocked.called)
+        task = StopTaskModel.objects.get(servername=service_url.split("/")[-2])
+        self.assertEqual(task.state, StopTaskModel.PENDING)
+        # The access token is not stored in plain text
+        token = self.headers["access-token"]
+        self.assertNotEqual(task.custom_headers["access-token"], token)
+        self.assertNotIn(token, json.dumps(task.custom_headers))
+        self.assertEqual(decrypt_headers(task.custom_headers)["access-token"], token)
 
     @mock.patch(
         target="requests.post",
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -383,11 +554,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -408,8 +579,10 @@ class ServiceViewTests(UserCredentials):
             url, data=self.simple_request_data, headers=self.headers, format="json"
         )
         service_url = f"{url}{r.data['servername']}/"
+        # Otherwise the transport of the start is reused
+        clear_unicore_state()
         patch = mock.patch(
-            "services.utils.pyunicore.pyunicore.Transport", mocked_exception
+            "services.utils.pyunicore.SessionTransport", mocked_exception
         )
         patch.start()
         r = self.client.get(service_url, headers=self.headers)
@@ -429,11 +602,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -459,8 +632,10 @@ class ServiceViewTests(UserCredentials):
             url, data=self.simple_request_data, headers=self.headers, format="json"
         )
         service_url = f"{url}{r.data['servername']}/"
+        # Otherwise the transport of the start is reused
+        clear_unicore_state()
         patch = mock.patch(
-            "services.utils.pyunicore.pyunicore.Transport", mocked_exception
+            "services.utils.pyunicore.SessionTransport", mocked_exception
         )
         patch.start()
         r = self.client.get(service_url, headers=self.headers)
@@ -485,11 +660,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -515,8 +690,10 @@ class ServiceViewTests(UserCredentials):
             url, data=self.simple_request_data, headers=self.headers, format="json"
         )
         service_url = f"{url}{r.data['servername']}/"
+        # Otherwise the transport of the start is reused
+        clear_unicore_state()
         patch = mock.patch(
-            "services.utils.pyunicore.pyunicore.Transport", mocked_exception
+            "services.utils.pyunicore.SessionTransport", mocked_exception
         )
         patch.start()
         r = self.client.get(service_url, headers=self.headers)
@@ -541,11 +718,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -585,11 +762,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -629,11 +806,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=config_mock)
@@ -664,11 +841,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(target="services.utils.common._config", side_effect=config_mock)
@@ -696,11 +873,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -733,11 +910,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -777,11 +954,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -827,11 +1004,11 @@ class ServiceViewTests(UserCredentials):
         side_effect=mocked_requests_post_running,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Client",
+        target="services.utils.pyunicore.get_site_client",
         side_effect=mocked_pyunicore_client_init,
     )
     @mock.patch(
-        target="services.utils.pyunicore.pyunicore.Transport",
+        target="services.utils.pyunicore.SessionTransport",
         side_effect=mocked_pyunicore_transport_init,
     )
     @mock.patch(
@@ -860,3 +1037,80 @@ class ServiceViewTests(UserCredentials):
             x["Data"] for x in job_args["Imports"] if x["To"] == "SYSTEM2_file.txt"
         ]
         self.assertEqual(len(file_txt), 0)
+
+    @mock.patch(
+        target="requests.post",
+        side_effect=mocked_requests_post_running,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.get_site_client",
+        side_effect=mocked_pyunicore_client_init,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.SessionTransport",
+        side_effect=mocked_pyunicore_transport_init,
+    )
+    @mock.patch(
+        target="services.utils.pyunicore.pyunicore.Job",
+        side_effect=mocked_pyunicore_job_init,
+    )
+    @mock.patch(target="services.utils.common._config", side_effect=config_mock)
+    def test_status_batch(
+        self,
+        config_mocked,
+        job_mocked,
+        transport_mocked,
+        client_mocked,
+        mocked_requests,
+    ):
+        url = reverse("services-list")
+        servernames = []
+        for _ in range(3):
+            r = self.client.post(
+                url, data=self.simple_request_data, headers=self.headers, format="json"
+            )
+            self.assertEqual(r.status_code, 201)
+            servernames.append(r.data["servername"])
+        status_url = reverse("services-status")
+        r = self.client.post(
+            status_url,
+            data={"servernames": servernames + ["unknown"]},
+            headers=self.headers,
+            format="json",
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(set(r.data["services"].keys()), set(servernames))
+        for servername in servernames:
+            self.assertEqual(r.data["services"][servername]["servername"], servername)
+            self.assertIn("running", r.data["services"][servername])
+        self.assertEqual(list(r.data["errors"].keys()), ["unknown"])
+
+    def test_status_batch_url(self):
+        # A service may be called "status"
+        self.assertEqual(reverse("services-status"), "/api/status/")
+        match = resolve("/api/services/status/")
+        self.assertEqual(match.url_name, "services-detail")
+        self.assertEqual(match.kwargs, {"servername": "status"})
+
+    def test_status_batch_invalid_input(self):
+        status_url = reverse("services-status")
+        r = self.client.post(
+            status_url, data={"servernames": "abc"}, headers=self.headers, format="json"
+        )
+        self.assertEqual(r.status_code, 400)
+
+    def test_logs(self):
+        ServicesModel.objects.create(
+            servername="logs",
+            jhub_user_id=17,
+            jhub_credential=self.user_authorized_username,
+            resource_url="https://localhost/job",
+            user_options=self.simple_request_data["user_options"],
+        )
+        url = reverse("services-logs", args=["logs"])
+        # Streams are only served by the async views
+        r = self.client.get(url, {"stream": "stderr"}, headers=self.headers)
+        self.assertEqual(r.status_code, 501)
+        self.assertEqual(
+            r.json()["detailed_error"], "Log streams need ASYNC_VIEWS=true"
+        )